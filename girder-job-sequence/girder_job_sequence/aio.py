@@ -0,0 +1,561 @@
+"""asyncio versions of Job and Sequence, built on a shared httpx.AsyncClient
+
+Requires the optional "async" dependencies:
+
+    pip install girder-job-sequence[async]
+"""
+
+import json
+import asyncio
+import weakref
+from time import perf_counter
+from typing_extensions import Union
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from .job import Job, status_from_code, ACTIVE_STATUS_CODES, FINISHED_STATUS_CODES
+from .sequence import Sequence
+from .cache import WildcardCache
+from .utils import resolve_jobs
+from .transport import RETRY_STATUS_CODES, RETRY_POST_STATUS_CODES
+from .wait import FINISHED_STATUSES
+from . import metrics
+
+
+class AsyncTransport:
+    """Async keep-alive connection pool for one DSA instance, with the same token header and
+    retry/backoff behavior as girder_job_sequence.transport.Transport
+    """
+    def __init__(self,
+                 gc,
+                 max_connections: int = 100,
+                 max_keepalive_connections: int = 20,
+                 max_retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 timeout: Union[float,None] = 60
+                 ):
+
+        if httpx is None:
+            raise ImportError('httpx is required for asyncio support, install with: pip install girder-job-sequence[async]')
+
+        self.gc = gc
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+
+        self.client = httpx.AsyncClient(
+            limits = httpx.Limits(
+                max_connections = max_connections,
+                max_keepalive_connections = max_keepalive_connections
+            ),
+            timeout = timeout
+        )
+        self.notifications = AsyncNotificationHub(self)
+
+    def url(self, path: str)->str:
+        return self.gc.urlBase + path.lstrip('/')
+
+    def headers(self)->dict:
+        if self.gc.token:
+            return {'Girder-Token': self.gc.token}
+        return {}
+
+    async def request(self, method: str, path: str, parameters: Union[dict,None] = None, data = None, retry: bool = True):
+        """Send a request relative to the API url and return the raw httpx response
+
+        :param method: HTTP method
+        :type method: str
+        :param path: Path relative to the API url (e.g. "/job/{id}")
+        :type path: str
+        :param parameters: Query parameters, defaults to None
+        :type parameters: Union[dict,None], optional
+        :param data: Form data, defaults to None
+        :param retry: Whether to retry on connection errors and 429/5xx responses, defaults to True
+        :type retry: bool, optional
+        :return: Response
+        :rtype: httpx.Response
+        """
+        if not metrics.enabled():
+            return await self.send_with_retries(method, path, parameters, data, retry)
+
+        start = perf_counter()
+        try:
+            response = await self.send_with_retries(method, path, parameters, data, retry)
+        except Exception as e:
+            metrics.record_request(method, path, perf_counter() - start, error = type(e).__name__)
+            raise
+
+        metrics.record_request(
+            method,
+            path,
+            perf_counter() - start,
+            status = response.status_code,
+            bytes_sent = len(response.request.content),
+            bytes_received = len(response.content)
+        )
+
+        return response
+
+    async def send_with_retries(self, method: str, path: str, parameters: Union[dict,None] = None, data = None, retry: bool = True):
+        retry_codes = RETRY_POST_STATUS_CODES if method.upper()=='POST' else RETRY_STATUS_CODES
+        attempt = 0
+        while True:
+            try:
+                response = await self.client.request(
+                    method,
+                    self.url(path),
+                    params = parameters,
+                    data = data,
+                    headers = self.headers()
+                )
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                # The request was never sent so this is safe to retry for any method
+                if not retry or attempt>=self.max_retries:
+                    raise
+                delay = self.backoff_factor * (2**attempt)
+            else:
+                if not retry or not response.status_code in retry_codes or attempt>=self.max_retries:
+                    return response
+
+                retry_after = response.headers.get('Retry-After')
+                delay = float(retry_after) if not retry_after is None and retry_after.isdigit() else self.backoff_factor * (2**attempt)
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def send(self, method: str, path: str, parameters: Union[dict,None] = None, data = None):
+        """Send a request and return the decoded JSON response, raising for error statuses
+        """
+        response = await self.request(method, path, parameters = parameters, data = data)
+        response.raise_for_status()
+
+        return response.json()
+
+    async def get(self, path: str, parameters: Union[dict,None] = None):
+        return await self.send('GET', path, parameters = parameters)
+
+    async def put(self, path: str, parameters: Union[dict,None] = None, data = None):
+        return await self.send('PUT', path, parameters = parameters, data = data)
+
+    async def aclose(self):
+        await self.notifications.aclose()
+        await self.client.aclose()
+
+
+class AsyncNotificationHub:
+    """One Girder notification stream per AsyncTransport, dispatching job status events to every
+    coroutine waiting on a job. If the stream is not enabled on the server, waiters get None and fall back to polling.
+    The latest status of each job seen on the stream is kept in "statuses" so AsyncJob.get_status can skip a request.
+    """
+    def __init__(self, transport: AsyncTransport, stream_timeout: float = 60):
+        self.transport = transport
+        self.stream_timeout = stream_timeout
+        self.available = None
+        self.since = None
+        self.waiters = {}
+        # {job id: latest status seen on the stream}
+        self.statuses = {}
+        self.task = None
+
+    def register(self, job_id: str)->asyncio.Future:
+        """Get a future that resolves with the job's status once it finishes (or None if the stream is unavailable)
+        """
+        future = asyncio.get_running_loop().create_future()
+        if self.available is False:
+            future.set_result(None)
+            return future
+
+        self.waiters.setdefault(job_id, []).append(future)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.listen())
+
+        return future
+
+    def unregister(self, job_id: str, future: asyncio.Future):
+        if job_id in self.waiters and future in self.waiters[job_id]:
+            self.waiters[job_id].remove(future)
+            if len(self.waiters[job_id])==0:
+                del self.waiters[job_id]
+
+    def resolve(self, job_id: str, status: Union[str,None]):
+        for future in self.waiters.pop(job_id, []):
+            if not future.done():
+                future.set_result(status)
+
+    async def listen(self):
+        """Read the notification stream for as long as any coroutine is waiting on a job
+        """
+        while len(self.waiters)>0:
+            # Girder takes whole seconds and closes the stream right away with a timeout of 0
+            parameters = {'timeout': max(int(self.stream_timeout), 1)}
+            if not self.since is None:
+                parameters['since'] = self.since
+
+            try:
+                async with self.transport.client.stream(
+                    'GET',
+                    self.transport.url('/notification/stream'),
+                    params = parameters,
+                    headers = self.transport.headers(),
+                    timeout = httpx.Timeout(self.transport.timeout, read = self.stream_timeout+30)
+                ) as response:
+
+                    if not response.status_code==200:
+                        await response.aread()
+                        print(f'Notification stream unavailable ({response.status_code}: {response.text}), falling back to polling')
+                        self.available = False
+                        for job_id in list(self.waiters.keys()):
+                            self.resolve(job_id, None)
+                        return
+
+                    self.available = True
+                    async for line in response.aiter_lines():
+                        if not line.startswith('data:'):
+                            continue
+
+                        event = json.loads(line[len('data:'):])
+                        if '_girderTime' in event:
+                            self.since = event['_girderTime']
+
+                        if event.get('type')=='job_status':
+                            job_status = status_from_code(event['data']['status'])
+                            self.statuses[event['data']['_id']] = job_status
+                            if job_status in FINISHED_STATUSES:
+                                self.resolve(event['data']['_id'], job_status)
+
+                        if len(self.waiters)==0:
+                            break
+
+            except httpx.HTTPError as e:
+                print(f'Notification stream interrupted: {e}')
+                await asyncio.sleep(1)
+
+    async def aclose(self):
+        if not self.task is None and not self.task.done():
+            self.task.cancel()
+
+
+_async_transports = weakref.WeakKeyDictionary()
+
+def get_async_transport(gc)->AsyncTransport:
+    """Get the shared AsyncTransport for this Girder client, creating one with default settings if needed.
+    The transport belongs to the event loop it is first used on.
+
+    :param gc: Girder client handler
+    :type gc: None
+    :return: AsyncTransport shared by every AsyncJob using this Girder client
+    :rtype: AsyncTransport
+    """
+    transport = _async_transports.get(gc)
+    if transport is None:
+        transport = AsyncTransport(gc)
+        _async_transports[gc] = transport
+
+    return transport
+
+def configure_async_transport(gc, **kwargs)->AsyncTransport:
+    """Replace the shared AsyncTransport for this Girder client, e.g. to change connection limits
+    """
+    transport = AsyncTransport(gc, **kwargs)
+    _async_transports[gc] = transport
+
+    return transport
+
+
+class AsyncJob:
+    """Awaitable interface to a Job
+    """
+    def __init__(self, job: Job):
+        self.job = job
+        self.gc = job.gc
+
+    @classmethod
+    async def create(cls, gc, **kwargs):
+        """Create a Job (arguments are the same as Job) without blocking the event loop while its plugin is looked up
+        """
+        job = await asyncio.to_thread(Job, gc, **kwargs)
+        return cls(job)
+
+    @property
+    def job_id(self):
+        return self.job.job_id
+
+    @property
+    def executable_dict(self):
+        return self.job.executable_dict
+
+    async def start(self):
+        """Send start request for this job
+
+        :return: Response to the start request
+        :rtype: httpx.Response
+        """
+        # Wildcard lookups use the synchronous client
+        self.job.inputs = await asyncio.to_thread(self.job.parse_input_args)
+
+        start_request = await get_async_transport(self.gc).request(
+            'POST',
+            f'/slicer_cli_web/cli/{self.job.plugin_id}/run',
+            parameters = {
+                # Matching how requests encodes non-string parameters (e.g. True -> "True")
+                i['name']: i['value'] if isinstance(i['value'], str) else str(i['value'])
+                for i in self.job.inputs
+            }
+        )
+
+        if start_request.status_code==200:
+            self.job.job_info = start_request.json()
+            self.job.job_id = self.job.job_info['_id']
+
+        return start_request
+
+    async def get_status(self, light: bool = False)->str:
+        """Get the status of the current job. Statuses already seen on the notification stream are used without a request
+        (finished ones even if the stream has stopped since).
+
+        :param light: Whether to avoid downloading the job log when a request is needed, see Job.fetch_status_info, defaults to False
+        :type light: bool, optional
+        """
+        if self.job.job_id is None:
+            return 'INACTIVE'
+
+        hub = get_async_transport(self.gc).notifications
+        notified_status = hub.statuses.get(self.job.job_id)
+        if not notified_status is None and (hub.available or notified_status in FINISHED_STATUSES):
+            return notified_status
+
+        job_info = await self.fetch_status_info(light)
+        return status_from_code(job_info['status'])
+
+    async def fetch_status_info(self, light: bool = False)->dict:
+        """Get this job's document for checking its status, searching the /job listing (which never includes logs) first if light is True.
+        See Job.fetch_status_info
+
+        :param light: Whether to avoid downloading the job log, defaults to False
+        :type light: bool, optional
+        :return: Job document (without "log" if found through the listing)
+        :rtype: dict
+        """
+        transport = get_async_transport(self.gc)
+
+        job_type = getattr(self.job, 'job_info', {}).get('type')
+        if light and not job_type is None:
+            for statuses in [ACTIVE_STATUS_CODES, FINISHED_STATUS_CODES]:
+                jobs_page = await transport.get(
+                    '/job',
+                    parameters = {
+                        'types': json.dumps([job_type]),
+                        'statuses': json.dumps(statuses),
+                        'sort': 'updated',
+                        'sortdir': -1,
+                        'limit': self.job.status_page_size
+                    }
+                )
+                for j in jobs_page:
+                    if j['_id']==self.job.job_id:
+                        return j
+
+                if len(jobs_page)>=self.job.status_page_size:
+                    # More active jobs of this type than fit in one page, the job could be in either listing
+                    break
+
+        return await transport.get(f'/job/{self.job.job_id}')
+
+    async def get_logs(self)->list:
+        """Get logs of this job
+        """
+        if self.job.job_id is None:
+            return ['Job has not started yet']
+
+        job_info = await get_async_transport(self.gc).get(f'/job/{self.job.job_id}')
+        return [i.split('\n') for i in job_info['log']]
+
+    async def cancel(self):
+        """Send cancel request for this job
+        """
+        if self.job.job_id is None:
+            return {'message': 'Job has not started yet'}
+
+        return await get_async_transport(self.gc).put(f'/job/{self.job.job_id}/cancel')
+
+    async def wait(self, check_interval: float = 5, timeout: Union[float,None] = None)->str:
+        """Wait for the job to finish using the shared notification stream, or exponential backoff polling
+        (up to check_interval seconds) if the stream is unavailable
+
+        :param check_interval: Maximum number of seconds between status checks when polling, defaults to 5
+        :type check_interval: float, optional
+        :param timeout: Maximum number of seconds to wait, defaults to None
+        :type timeout: Union[float,None], optional
+        :return: Last status of the job
+        :rtype: str
+        """
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        hub = get_async_transport(self.gc).notifications
+        interval = min(0.5, check_interval)
+
+        current_status = None
+        while not current_status in FINISHED_STATUSES:
+            if not timeout is None and loop.time()-start_time>timeout:
+                break
+
+            # Registering before checking the status so a notification sent in between is not missed
+            future = hub.register(self.job.job_id)
+            try:
+                current_status = await self.get_status()
+                if current_status in FINISHED_STATUSES:
+                    break
+
+                wait_time = hub.stream_timeout if hub.available is not False else interval
+                if not timeout is None:
+                    wait_time = min(wait_time, max(timeout-(loop.time()-start_time), 0))
+
+                try:
+                    notified_status = await asyncio.wait_for(asyncio.shield(future), wait_time)
+                except asyncio.TimeoutError:
+                    notified_status = None
+
+                if not notified_status is None:
+                    current_status = notified_status
+                elif hub.available is False:
+                    await asyncio.sleep(interval)
+                    interval = min(interval*2, check_interval)
+            finally:
+                hub.unregister(self.job.job_id, future)
+
+        return current_status
+
+
+class AsyncSequence:
+    """Awaitable interface to a Sequence. Many AsyncSequences can run on one event loop, optionally sharing
+    an asyncio.Semaphore (job_slots) to cap the number of in-flight DSA jobs.
+    """
+    def __init__(self,
+                 gc,
+                 jobs: list = [],
+                 job_slots: Union[asyncio.Semaphore,None] = None
+                 ):
+
+        self.gc = gc
+        self.jobs = [j if isinstance(j, AsyncJob) else AsyncJob(j) for j in jobs]
+        self.job_slots = job_slots
+        self.sequence = Sequence(gc, [j.job for j in self.jobs])
+        self.id = self.sequence.id
+
+    @classmethod
+    def from_sequence(cls, sequence: Sequence, job_slots: Union[asyncio.Semaphore,None] = None):
+        async_sequence = cls(sequence.gc, sequence.jobs, job_slots = job_slots)
+        async_sequence.sequence = sequence
+        async_sequence.id = sequence.id
+        return async_sequence
+
+    async def get_status(self)->list:
+        """Get the statuses of all jobs in a sequence
+
+        :return: List of {'Job Name': '', 'Status': ''} dictionaries
+        :rtype: list
+        """
+        statuses = await asyncio.gather(*[j.get_status() for j in self.jobs])
+        return [
+            {'Job Name': j.executable_dict["title"], 'Status': s}
+            for j,s in zip(self.jobs, statuses)
+        ]
+
+    async def cancel(self, type: str = 'all')->list:
+        """Cancel either all, running, queued, or inactive jobs in a sequence, sending cancellations concurrently
+        """
+        assert type in ['all','running','queued','inactive']
+
+        current_job_statuses = await self.get_status()
+        to_cancel = []
+        for j,status in zip(self.jobs, current_job_statuses):
+            if type=='all' and not status['Status'] in FINISHED_STATUSES:
+                to_cancel.append(j)
+            elif status['Status']==type.upper():
+                to_cancel.append(j)
+
+        return list(await asyncio.gather(*[j.cancel() for j in to_cancel]))
+
+    async def run_job(self, job: AsyncJob, check_interval: float = 5, verbose: bool = False)->str:
+        """Start a job and wait for it to finish, holding one of the shared job slots (if any) while it is in flight
+        """
+        if not self.job_slots is None:
+            await self.job_slots.acquire()
+
+        try:
+            job_request = await job.start()
+            if not job_request.status_code==200:
+                print('Error submitting job request')
+                print(f'Status Code: {job_request.status_code}')
+                print(job_request.content)
+                return 'ERROR'
+
+            current_status = await job.wait(check_interval)
+        finally:
+            if not self.job_slots is None:
+                self.job_slots.release()
+
+        if verbose:
+            print(f'{job.executable_dict["title"]}: {current_status}')
+
+        return current_status
+
+    async def run(self, check_interval: float = 5, cancel_on_error: bool = True, verbose: bool = False, mode: str = 'linear', max_concurrent: int = 4)->list:
+        """Run the job sequence, see Sequence.start
+
+        :return: Final state of each job, SUCCESS, ERROR, CANCELED, INACTIVE (not started), or SKIPPED ("dag" mode)
+        :rtype: list
+        """
+        # Requests made while running are tagged with this sequence's id (see girder_job_sequence.metrics)
+        with metrics.tags(sequence_id = self.id):
+            return await self.run_jobs(check_interval, cancel_on_error, verbose, mode, max_concurrent)
+
+    async def run_jobs(self, check_interval: float = 5, cancel_on_error: bool = True, verbose: bool = False, mode: str = 'linear', max_concurrent: int = 4)->list:
+        assert check_interval>0
+        assert mode in ['linear','dag']
+
+        # Plugin specifications of lazily constructed jobs are fetched concurrently without blocking the event loop
+        await asyncio.to_thread(resolve_jobs, [j.job for j in self.jobs])
+
+        wildcard_cache = self.sequence.wildcard_cache if not self.sequence.wildcard_cache is None else WildcardCache()
+        for job in self.jobs:
+            job.job.wildcard_cache = wildcard_cache
+
+        job_states = ['INACTIVE']*len(self.jobs)
+        if mode=='linear':
+            for job_idx, job in enumerate(self.jobs):
+                job_states[job_idx] = await self.run_job(job, check_interval, verbose)
+                if job_states[job_idx] in ['ERROR','CANCELED'] and cancel_on_error:
+                    if verbose:
+                        print('Canceling remaining jobs in sequence')
+                    await self.cancel()
+                    break
+
+            return job_states
+
+        dependencies = self.sequence.get_dependencies()
+        ready_states = ['SUCCESS'] if cancel_on_error else ['SUCCESS','ERROR','CANCELED']
+        job_states = ['PENDING']*len(self.jobs)
+        concurrency = asyncio.Semaphore(max_concurrent)
+        finished = {i: asyncio.get_running_loop().create_future() for i in range(len(self.jobs))}
+
+        async def run_node(job_idx):
+            upstream = await asyncio.gather(*[finished[d] for d in dependencies[job_idx]])
+            if not all([s in ready_states for s in upstream]):
+                job_states[job_idx] = 'SKIPPED'
+            else:
+                async with concurrency:
+                    try:
+                        job_states[job_idx] = await self.run_job(self.jobs[job_idx], check_interval, verbose)
+                    except Exception as e:
+                        print(f'Job: {job_idx} failed with: {e}')
+                        job_states[job_idx] = 'ERROR'
+
+            finished[job_idx].set_result(job_states[job_idx])
+
+        await asyncio.gather(*[run_node(i) for i in range(len(self.jobs))])
+
+        return job_states
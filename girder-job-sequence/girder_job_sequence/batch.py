@@ -0,0 +1,260 @@
+"""Running one sequence template over many items
+"""
+
+import json
+import threading
+import itertools
+from time import time
+from collections import deque
+from string import Template
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing_extensions import Union
+
+from .sequence import Sequence
+from .cache import WildcardCache, ResultCache
+from .utils import from_dict, check_wildcard, prefetch_item_paths
+from .manifest import iter_manifest
+
+
+def fill_template(template, variables: dict):
+    """Replace "${variable}" references in every string of a (nested) list/dict template
+
+    :param template: Sequence template (list of job dictionaries) or part of one
+    :type template: Union[list,dict,str]
+    :param variables: Values for each variable name
+    :type variables: dict
+    :return: Copy of the template with variables filled in
+    :rtype: Union[list,dict,str]
+    """
+    if isinstance(template, str):
+        return Template(template).safe_substitute(variables)
+    elif isinstance(template, list):
+        return [fill_template(i, variables) for i in template]
+    elif isinstance(template, dict):
+        return {k: fill_template(v, variables) for k,v in template.items()}
+
+    return template
+
+
+class BatchRunner:
+    """Run one sequence template for each item in an iterable, many sequences at a time.
+
+    Strings in the template can reference the current item as "${item}" (or the name given by "variable"),
+    including inside of wildcard inputs. Items can also be dictionaries of variable names and values.
+    Without a template, items are sequence definitions read from a manifest (see BatchRunner.from_manifest).
+
+    Items are read "prefetch_size" at a time and the item paths in all of their wildcards are looked up together,
+    listing each parent folder once (see utils.resolve_item_paths). Set "prefetch_size" to 0 to look them up per sequence.
+    """
+    def __init__(self,
+                 gc,
+                 template: Union[list,None],
+                 items,
+                 variable: str = 'item',
+                 max_sequences: int = 8,
+                 max_jobs_in_flight: int = 8,
+                 start_kwargs: Union[dict,None] = None,
+                 wildcard_cache: Union[WildcardCache,None] = None,
+                 result_cache: Union[ResultCache,None] = None,
+                 job_slots = None,
+                 prefetch_size: int = 256
+                 ):
+
+        assert max_sequences>0 and max_jobs_in_flight>0 and prefetch_size>=0
+
+        self.gc = gc
+        self.template = template
+        self.items = items
+        self.variable = variable
+        self.max_sequences = max_sequences
+        self.max_jobs_in_flight = max_jobs_in_flight
+        self.start_kwargs = start_kwargs if not start_kwargs is None else {}
+        self.prefetch_size = prefetch_size
+
+        # Shared by all sequences in this batch, or slots from a PriorityScheduler shared with other batches and sequences
+        self.job_slots = job_slots if not job_slots is None else threading.BoundedSemaphore(max_jobs_in_flight)
+        # Items and folders referenced by every sequence (e.g. a shared model folder) are only looked up once
+        self.wildcard_cache = wildcard_cache if not wildcard_cache is None else WildcardCache()
+        # Re-running a batch with a persistent ResultCache only runs the jobs that did not succeed before
+        self.result_cache = result_cache
+        self.results = []
+
+    @classmethod
+    def from_manifest(cls, gc, path: str, format: Union[str,None] = None, **kwargs):
+        """Run every sequence defined in a manifest (JSON, JSONL, or YAML). Records are read as slots free up,
+        so sequences start before the whole manifest is read.
+
+        :param gc: Girder client handler
+        :type gc: None
+        :param path: Path to the manifest, see girder_job_sequence.manifest
+        :type path: str
+        :param format: One of "json", "jsonl", or "yaml", defaults to detecting it from the file extension
+        :type format: Union[str,None], optional
+        :return: BatchRunner over the manifest's records
+        :rtype: BatchRunner
+        """
+        return cls(gc, None, iter_manifest(path, format), **kwargs)
+
+    def item_label(self, item):
+        """Name of an item in results and validation errors (the name or index of a manifest record)
+        """
+        if self.template is None:
+            return item['name'] if not item.get('name') is None else item['index']
+
+        return item if not isinstance(item, dict) else json.dumps(item, sort_keys = True)
+
+    def job_dicts(self, item)->list:
+        """Job dictionaries of one item's sequence (the template with the item filled in)
+        """
+        if self.template is None:
+            return item['jobs']
+
+        variables = item if isinstance(item, dict) else {self.variable: item}
+        return fill_template(self.template, variables)
+
+    def build_sequence(self, item)->Sequence:
+        """Create the Sequence for one item of the batch
+
+        :param item: Item id, path, or dictionary of variables
+        :type item: Union[str,dict]
+        :return: Sequence with the item filled into the template
+        :rtype: Sequence
+        """
+        return Sequence(
+            self.gc,
+            [from_dict(self.gc, j, lazy = True) for j in self.job_dicts(item)],
+            job_slots = self.job_slots,
+            wildcard_cache = self.wildcard_cache,
+            result_cache = self.result_cache,
+            name = item.get('name') if self.template is None else None
+        )
+
+    def validate(self, items = None)->dict:
+        """Check the inputs of every item's sequence without submitting anything
+
+        :param items: Items to check, defaults to the batch's items (iterators can only be read once)
+        :return: Dictionary of item: list of error messages for each invalid item
+        :rtype: dict
+        """
+        invalid = {}
+        for item in (items if not items is None else self.items):
+            try:
+                errors = self.build_sequence(item).validate(raise_error = False)
+            except Exception as e:
+                errors = [f'{type(e).__name__}: {e}']
+
+            if len(errors)>0:
+                invalid[self.item_label(item)] = errors
+
+        return invalid
+
+    def prefetch_paths(self, items: list)->int:
+        """Look up the item paths referenced by wildcards in the sequences of many items at once, storing them
+        in the batch's wildcard cache. Lookups that fail here are made again when each sequence starts.
+
+        :param items: Items of the batch
+        :type items: list
+        :return: Number of item paths found
+        :rtype: int
+        """
+        wildcard_args_list = []
+        for item in items:
+            try:
+                job_dicts = self.job_dicts(item)
+            except Exception:
+                continue
+
+            for job_dict in job_dicts:
+                for i in (job_dict.get('input_args') or []) if isinstance(job_dict, dict) else []:
+                    if isinstance(i, dict) and isinstance(i.get('value'), str) and check_wildcard(i['value']):
+                        try:
+                            wildcard_args_list.append(json.loads(i['value'][1:-1].replace("'",'"')))
+                        except ValueError:
+                            continue
+
+        try:
+            return prefetch_item_paths(self.gc, wildcard_args_list, self.wildcard_cache)
+        except Exception as e:
+            print(f'Unable to prefetch item paths: {e}')
+            return 0
+
+    def run_item(self, item)->dict:
+        """Build and run the sequence for one item. Exceptions are recorded in the result instead of stopping the batch.
+        """
+        result = {
+            'Item': self.item_label(item),
+            'Sequence ID': None,
+            'States': [],
+            'Error': None,
+            'Started': time(),
+            'Finished': None
+        }
+        try:
+            sequence = self.build_sequence(item)
+            result['Sequence ID'] = sequence.id
+            result['States'] = sequence.start(**self.start_kwargs)
+        except Exception as e:
+            result['Error'] = f'{type(e).__name__}: {e}'
+
+        result['Finished'] = time()
+        result['Succeeded'] = result['Error'] is None and len(result['States'])>0 and all([s=='SUCCESS' for s in result['States']])
+
+        return result
+
+    def run(self, verbose: bool = False)->dict:
+        """Run the whole batch, keeping at most "max_sequences" sequences and "max_jobs_in_flight" DSA jobs active at once.
+        Items are read from the iterable as slots free up (at most "prefetch_size" ahead) so very large iterables are not loaded all at once.
+
+        :param verbose: Whether to print each finished item
+        :type verbose: bool, optional
+        :return: Aggregate counts and throughput, per-item results are in BatchRunner.results
+        :rtype: dict
+        """
+        start_time = time()
+        self.results = []
+        items = iter(self.items)
+        buffered = deque()
+        running = set()
+        items_left = True
+
+        with ThreadPoolExecutor(max_workers = self.max_sequences) as executor:
+            while True:
+                while items_left and len(running)<self.max_sequences:
+                    if len(buffered)==0:
+                        chunk = list(itertools.islice(items, max(self.prefetch_size, 1)))
+                        if len(chunk)==0:
+                            items_left = False
+                            break
+                        if self.prefetch_size>0:
+                            self.prefetch_paths(chunk)
+                        buffered.extend(chunk)
+
+                    running.add(executor.submit(self.run_item, buffered.popleft()))
+
+                if len(running)==0:
+                    break
+
+                finished, running = wait(running, return_when = FIRST_COMPLETED)
+                for future in finished:
+                    result = future.result()
+                    self.results.append(result)
+                    if verbose:
+                        print(f'{result["Item"]}: {"SUCCESS" if result["Succeeded"] else result["Error"] or result["States"]}')
+
+        return self.summary(time() - start_time)
+
+    def summary(self, elapsed: float)->dict:
+        """Aggregate counts and throughput of the finished batch
+        """
+        n_jobs = sum([len([s for s in r['States'] if not s in ['INACTIVE','SKIPPED']]) for r in self.results])
+        n_succeeded = len([r for r in self.results if r['Succeeded']])
+
+        return {
+            'Sequences': len(self.results),
+            'Succeeded': n_succeeded,
+            'Failed': len(self.results) - n_succeeded,
+            'Jobs Run': n_jobs,
+            'Elapsed': elapsed,
+            'Sequences per Second': len(self.results)/elapsed if elapsed>0 else 0,
+            'Jobs per Second': n_jobs/elapsed if elapsed>0 else 0
+        }
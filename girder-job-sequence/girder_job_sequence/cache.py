@@ -0,0 +1,556 @@
+"""Caching utilities used by girder-job-sequence
+"""
+
+import os
+import json
+import hashlib
+import threading
+from time import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing_extensions import Union
+
+from .transport import get_transport
+
+
+class CLICatalog:
+    """Process-wide cache of the slicer_cli_web plugins available on one or more DSA instances.
+
+    Holds an indexed (docker_image, cli) -> plugin info map for each API url and the parsed
+    executable dictionary for each plugin id. Executables are evicted least-recently-used once
+    there are more than "max_size" of them, and are re-validated against the plugin's "updated"
+    timestamp after "ttl" seconds.
+    """
+    def __init__(self,
+                 ttl: float = 300,
+                 max_size: int = 256,
+                 cache_dir: Union[str,None] = None
+                 ):
+
+        self.ttl = ttl
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+
+        self._lock = threading.RLock()
+        # {api_url: {'fetched': float, 'index': {image+cli key: plugin info}, 'updated': {plugin_id: updated}}}
+        self._listings = {}
+        # {(api_url, plugin_id): {'fetched': float, 'updated': str, 'executable': dict}}
+        self._executables = OrderedDict()
+        self._loaded_urls = set()
+
+    @staticmethod
+    def _index_key(docker_image: str, cli: str)->str:
+        return f'{docker_image}|{cli}'
+
+    def _expired(self, fetched: float)->bool:
+        return time() - fetched > self.ttl
+
+    def _disk_path(self, api_url: str)->Union[str,None]:
+        if self.cache_dir is None:
+            return None
+        url_hash = hashlib.sha1(api_url.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f'cli_catalog_{url_hash}.json')
+
+    def _load(self, api_url: str):
+        """Read previously persisted listing and executables for this API url (once per process)
+        """
+        if api_url in self._loaded_urls:
+            return
+        self._loaded_urls.add(api_url)
+
+        disk_path = self._disk_path(api_url)
+        if disk_path is None or not os.path.exists(disk_path):
+            return
+
+        try:
+            with open(disk_path, 'r') as f:
+                disk_data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if not disk_data.get('api_url')==api_url:
+            return
+
+        if not disk_data.get('listing') is None and not api_url in self._listings:
+            self._listings[api_url] = disk_data['listing']
+
+        for plugin_id, entry in disk_data.get('executables',{}).items():
+            if not (api_url, plugin_id) in self._executables:
+                self._executables[(api_url, plugin_id)] = entry
+
+        self._trim()
+
+    def _save(self, api_url: str):
+        """Persist the listing and executables for this API url, if a cache_dir is set
+        """
+        disk_path = self._disk_path(api_url)
+        if disk_path is None:
+            return
+
+        disk_data = {
+            'api_url': api_url,
+            'listing': self._listings.get(api_url),
+            'executables': {
+                plugin_id: entry
+                for (url, plugin_id), entry in self._executables.items()
+                if url==api_url
+            }
+        }
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = disk_path+f'.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(disk_data, f)
+            os.replace(tmp_path, disk_path)
+        except OSError as e:
+            print(f'Unable to save CLI catalog to {disk_path}: {e}')
+
+    def _trim(self):
+        while len(self._executables)>self.max_size:
+            self._executables.popitem(last=False)
+
+    def refresh(self, gc)->dict:
+        """Download the full plugin list for this DSA instance and rebuild the index. Cached executables for
+        plugins whose "updated" timestamp changed (or that were removed) are dropped.
+
+        :param gc: Girder client handler
+        :type gc: None
+        :return: Listing containing the (docker_image, cli) index and "updated" timestamps
+        :rtype: dict
+        """
+        api_url = gc.urlBase
+        plugin_list = get_transport(gc).get('/slicer_cli_web/cli')
+
+        listing = {
+            'fetched': time(),
+            'index': {},
+            'updated': {}
+        }
+        for p in plugin_list:
+            listing['index'][self._index_key(p.get('image'), p.get('name'))] = p
+            listing['updated'][p['_id']] = p.get('updated')
+
+        with self._lock:
+            self._load(api_url)
+            self._listings[api_url] = listing
+
+            for key in list(self._executables.keys()):
+                if key[0]==api_url:
+                    entry = self._executables[key]
+                    if not key[1] in listing['updated']:
+                        del self._executables[key]
+                    elif entry['updated'] is None:
+                        # Executable was fetched by id before any listing was available
+                        entry['updated'] = listing['updated'][key[1]]
+                    elif not listing['updated'][key[1]]==entry['updated']:
+                        del self._executables[key]
+
+            self._save(api_url)
+
+        return listing
+
+    def get_listing(self, gc, force: bool = False)->dict:
+        """Get the (possibly cached) plugin listing for this DSA instance
+
+        :param gc: Girder client handler
+        :type gc: None
+        :param force: Whether to ignore the cached listing, defaults to False
+        :type force: bool, optional
+        :return: Listing containing the (docker_image, cli) index and "updated" timestamps
+        :rtype: dict
+        """
+        api_url = gc.urlBase
+        with self._lock:
+            self._load(api_url)
+            listing = self._listings.get(api_url)
+
+        if force or listing is None or self._expired(listing['fetched']):
+            listing = self.refresh(gc)
+
+        return listing
+
+    def get_plugin_info(self, gc, docker_image: str, cli: str)->Union[dict,None]:
+        """Find a plugin's info from the name of the Docker image and CLI name using the cached index.
+        The listing is re-downloaded once if the plugin is not found in a cached copy.
+
+        :param gc: Girder client handler
+        :type gc: None
+        :param docker_image: Name of the Docker image that has that CLI (image/name:tag)
+        :type docker_image: str
+        :param cli: Name of the CLI
+        :type cli: str
+        :return: Plugin info or None if not found
+        :rtype: Union[dict,None]
+        """
+        key = self._index_key(docker_image, cli)
+        listing = self.get_listing(gc)
+        plugin_info = listing['index'].get(key)
+
+        if plugin_info is None and time() - listing['fetched'] > 1:
+            listing = self.refresh(gc)
+            plugin_info = listing['index'].get(key)
+
+        return plugin_info
+
+    def get_executable(self, gc, plugin_id: str, loader)->Union[dict,None]:
+        """Get the parsed executable dictionary for a plugin, calling "loader" on a cache miss.
+
+        :param gc: Girder client handler
+        :type gc: None
+        :param plugin_id: Id of the plugin
+        :type plugin_id: str
+        :param loader: Function with no arguments returning the executable dictionary (or None)
+        :type loader: Callable
+        :return: Executable dictionary (shared between Jobs, do not modify) or None
+        :rtype: Union[dict,None]
+        """
+        api_url = gc.urlBase
+        key = (api_url, plugin_id)
+
+        with self._lock:
+            self._load(api_url)
+            entry = self._executables.get(key)
+            if not entry is None:
+                self._executables.move_to_end(key)
+
+        if not entry is None:
+            if not self._expired(entry['fetched']):
+                return entry['executable']
+
+            # Re-validating against the plugin listing (one request for all plugins) instead of re-fetching XML
+            listing = self.get_listing(gc)
+            with self._lock:
+                if self._executables.get(key) is entry:
+                    entry['fetched'] = time()
+                    return entry['executable']
+
+        executable_dict = loader()
+        if not executable_dict is None:
+            listing = self._listings.get(api_url)
+            with self._lock:
+                self._executables[key] = {
+                    'fetched': time(),
+                    'updated': listing['updated'].get(plugin_id) if not listing is None else None,
+                    'executable': executable_dict
+                }
+                self._executables.move_to_end(key)
+                self._trim()
+                self._save(api_url)
+
+        return executable_dict
+
+    def invalidate(self, gc = None, plugin_id: Union[str,None] = None):
+        """Drop cached data, either everything, everything for one DSA instance, or a single plugin
+
+        :param gc: Girder client handler, if None then all instances are cleared, defaults to None
+        :type gc: None, optional
+        :param plugin_id: Id of a single plugin to drop, defaults to None
+        :type plugin_id: Union[str,None], optional
+        """
+        with self._lock:
+            if gc is None:
+                self._listings = {}
+                self._executables = OrderedDict()
+                return
+
+            api_url = gc.urlBase
+            if plugin_id is None:
+                self._listings.pop(api_url, None)
+                for key in list(self._executables.keys()):
+                    if key[0]==api_url:
+                        del self._executables[key]
+            else:
+                self._executables.pop((api_url, plugin_id), None)
+
+            self._save(api_url)
+
+
+# Shared by all Jobs in this process. Set CLI_CATALOG.cache_dir to persist between runs.
+CLI_CATALOG = CLICatalog(
+    cache_dir = os.environ.get('GIRDER_JOB_SEQUENCE_CACHE_DIR')
+)
+
+
+class WildcardCache:
+    """Memoized wildcard lookups, keyed by DSA instance and the normalized wildcard arguments.
+
+    Concurrent requests for the same wildcard wait for a single lookup. Failed lookups are not cached.
+    Only the wildcard types in "types" are cached, by default items and folders since files and annotations
+    may be created (or replaced) by earlier jobs in a sequence. Item lookups made while finding a file or
+    annotation are still cached, as are the file and annotation names read from each item (see ItemIndex).
+    """
+    def __init__(self,
+                 ttl: Union[float,None] = None,
+                 types: list = ['item','folder']
+                 ):
+
+        self.ttl = ttl
+        self.types = types
+
+        self._lock = threading.Lock()
+        # {(api_url, key): {'fetched': float, 'future': Future}}
+        self._entries = {}
+        # {(api_url, item id, "file" or "annotation"): ItemIndex}
+        self._item_indexes = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(wildcard_args: dict)->str:
+        """Key for a wildcard that is the same regardless of key order, whitespace, and trailing slashes in paths
+        """
+        normalized = {}
+        for key, val in wildcard_args.items():
+            if isinstance(val, str):
+                val = val.strip()
+                if key.endswith('_query') and wildcard_args.get(key.replace('_query','_type'))=='path':
+                    val = val.rstrip('/')
+            normalized[key] = val
+
+        return json.dumps(normalized, sort_keys = True)
+
+    def get_or_resolve(self, gc, wildcard_args: dict, resolver):
+        """Get the value of a wildcard, calling "resolver" on a cache miss
+
+        :param gc: Girder client handler
+        :type gc: None
+        :param wildcard_args: Parsed wildcard arguments
+        :type wildcard_args: dict
+        :param resolver: Function with no arguments returning the wildcard value
+        :type resolver: Callable
+        :return: Wildcard value
+        """
+        if not wildcard_args.get('type') in self.types:
+            return resolver()
+
+        key = (gc.urlBase, self.normalize(wildcard_args))
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry is None and not self.ttl is None and time()-entry['fetched']>self.ttl:
+                entry = None
+
+            if entry is None:
+                entry = {'fetched': time(), 'future': Future()}
+                self._entries[key] = entry
+                owner = True
+                self.misses += 1
+            else:
+                owner = False
+                self.hits += 1
+
+        if not owner:
+            return entry['future'].result()
+
+        try:
+            value = resolver()
+        except BaseException as e:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            entry['future'].set_exception(e)
+            raise
+
+        entry['future'].set_result(value)
+        return value
+
+    def contains(self, gc, wildcard_args: dict)->bool:
+        """Whether a wildcard's value is cached (or being looked up)
+        """
+        key = (gc.urlBase, self.normalize(wildcard_args))
+        with self._lock:
+            entry = self._entries.get(key)
+            return not entry is None and (self.ttl is None or time()-entry['fetched']<=self.ttl)
+
+    def put(self, gc, wildcard_args: dict, value):
+        """Store a wildcard value looked up elsewhere (e.g. by utils.resolve_item_paths)
+        """
+        if not wildcard_args.get('type') in self.types:
+            return
+
+        future = Future()
+        future.set_result(value)
+        with self._lock:
+            self._entries[(gc.urlBase, self.normalize(wildcard_args))] = {'fetched': time(), 'future': future}
+
+    def item_index(self, gc, item_id: str, kind: str):
+        """Index of the files or annotations of one item, shared by every wildcard using this cache
+
+        :param gc: Girder client handler
+        :type gc: None
+        :param item_id: Id of the item
+        :type item_id: str
+        :param kind: Either "file" or "annotation"
+        :type kind: str
+        :return: Index for this item
+        :rtype: ItemIndex
+        """
+        key = (gc.urlBase, item_id, kind)
+        with self._lock:
+            index = self._item_indexes.get(key)
+            if index is None or (not self.ttl is None and time()-index.created>self.ttl):
+                index = ItemIndex()
+                self._item_indexes[key] = index
+
+        return index
+
+    def mark_stale(self):
+        """Record that jobs finished (and may have added or replaced files and annotations), so item indexes are
+        checked against the server again before names read earlier are used
+        """
+        with self._lock:
+            for index in self._item_indexes.values():
+                index.stale = True
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = {}
+            self._item_indexes = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ItemIndex:
+    """Names and ids of the files (or annotations) of one item read so far.
+
+    Files are listed in pages in creation order (by "_id"), so "offset" is where the next lookup continues
+    and files uploaded later (e.g. by the next job in a sequence) are picked up without reading earlier pages again.
+    Annotations are looked up by name on the server and only the matches are kept.
+
+    Once "stale" is set (see WildcardCache.mark_stale), names are not taken from the index until it has been
+    checked against the server again.
+    """
+    def __init__(self):
+        self.created = time()
+        self.lock = threading.Lock()
+        # {name: id}, later documents replace earlier ones with the same name
+        self.ids = {}
+        self.offset = 0
+        self.stale = False
+        self.n_requests = 0
+
+    def get(self, name: str):
+        if self.stale:
+            return None
+        return self.ids.get(name)
+
+    def add(self, name: str, doc_id: str):
+        self.ids[name] = doc_id
+
+
+class ResultCache:
+    """Index of submitted jobs by a hash of their plugin, plugin specification version, and resolved inputs.
+
+    Jobs with a matching key whose previous job finished with SUCCESS reuse that job instead of being submitted again.
+    The server's job endpoints do not allow storing arbitrary metadata on jobs, so the index is kept locally,
+    in memory or in a JSON file ("path") to reuse results between processes. Entries are checked against the
+    server before being reused and are dropped if that job did not succeed or no longer exists.
+    """
+    # Inputs that do not change a job's results
+    ignored_inputs = ['girderToken','girderApiUrl']
+
+    def __init__(self, path: Union[str,None] = None):
+
+        self.path = path
+        self._lock = threading.Lock()
+        # {key: {'job_id': str, 'plugin_id': str, 'submitted': float}}
+        self._index = {}
+        self.hits = 0
+        self.misses = 0
+
+        if not path is None and os.path.exists(path):
+            try:
+                with open(path,'r') as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+
+    def _save(self):
+        if self.path is None:
+            return
+
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path,'w') as f:
+            json.dump(self._index, f)
+        os.replace(temp_path, self.path)
+
+    def key(self, gc, plugin_id: str, executable_dict: Union[dict,None], inputs: list)->str:
+        """Content hash of a job submission
+
+        :param gc: Girder client handler
+        :type gc: None
+        :param plugin_id: Id of the plugin
+        :type plugin_id: str
+        :param executable_dict: Parsed plugin specification, changes to it (or to the plugin's "updated" time) change the key
+        :type executable_dict: Union[dict,None]
+        :param inputs: Resolved inputs (output of Job.parse_input_args)
+        :type inputs: list
+        :return: Hex digest
+        :rtype: str
+        """
+        listing = CLI_CATALOG.get_listing(gc)
+        spec_version = {
+            'updated': listing['updated'].get(plugin_id),
+            'spec': hashlib.sha256(json.dumps(executable_dict, sort_keys = True, default = str).encode()).hexdigest()
+        }
+        key_inputs = sorted([
+            [str(i['name']), str(i['value'])]
+            for i in inputs
+            if not i['name'] in self.ignored_inputs
+        ])
+
+        return hashlib.sha256(json.dumps({
+            'api_url': gc.urlBase,
+            'plugin_id': plugin_id,
+            'spec_version': spec_version,
+            'inputs': key_inputs
+        }, sort_keys = True).encode()).hexdigest()
+
+    def lookup(self, gc, key: str):
+        """Find a previous successful job for this key
+
+        :param gc: Girder client handler
+        :type gc: None
+        :param key: Output of ResultCache.key
+        :type key: str
+        :return: Response to requesting the previous job's document, or None if there isn't a successful one
+        :rtype: Union[requests.Response,None]
+        """
+        with self._lock:
+            entry = self._index.get(key)
+
+        if not entry is None:
+            response = get_transport(gc).request('GET', f'/job/{entry["job_id"]}')
+            if response.status_code==200 and response.json().get('status')==3:
+                with self._lock:
+                    self.hits += 1
+                return response
+
+            with self._lock:
+                if self._index.get(key) is entry:
+                    del self._index[key]
+                    self._save()
+
+        with self._lock:
+            self.misses += 1
+
+        return None
+
+    def store(self, key: str, job_id: str, plugin_id: Union[str,None] = None):
+        """Record a submitted job for this key (it is only reused once it has succeeded)
+        """
+        with self._lock:
+            self._index[key] = {'job_id': job_id, 'plugin_id': plugin_id, 'submitted': time()}
+            self._save()
+
+    def invalidate(self, key: Union[str,None] = None):
+        with self._lock:
+            if key is None:
+                self._index = {}
+            else:
+                self._index.pop(key, None)
+            self._save()
+
+    def __len__(self):
+        return len(self._index)
@@ -2,12 +2,18 @@
 Defining Job class
 """
 from typing_extensions import Union
-import requests
+from collections import deque
+from time import sleep
 
 import json
+import threading
 import lxml.etree as ET
 
-from .utils import id_from_info, get_text_key_vals, check_wildcard, parse_wildcard
+from .cache import CLI_CATALOG
+from .transport import get_transport
+from . import metrics
+from .schema import CLISchema, ValidationError, get_schema
+from .utils import id_from_info, get_text_key_vals, check_wildcard, resolve_wildcards, parse_wildcard, WildcardNotFound
 
 
 PARAMETER_TAGS = ['integer','float','double','boolean','string','integer-vector','float-vector','double-vector','string-vector',
@@ -23,6 +29,42 @@ JOB_STATUS_KEY = [
     'CANCELED'
 ]
 
+ACTIVE_STATUS_CODES = [0, 1, 2, 820, 821, 822, 823, 824]
+FINISHED_STATUS_CODES = [3, 4, 5]
+
+# Statuses added by girder_worker while a job is transferring data (FETCHING_INPUT, CONVERTING_INPUT,
+# CONVERTING_OUTPUT, PUSHING_OUTPUT, CANCELING)
+WORKER_STATUS_KEY = {
+    820: 'RUNNING',
+    821: 'RUNNING',
+    822: 'RUNNING',
+    823: 'RUNNING',
+    824: 'RUNNING'
+}
+
+
+def status_from_code(status_code: int)->str:
+    """Convert a Girder job status code to its name
+
+    :param status_code: Value of "status" in the job document
+    :type status_code: int
+    :return: One of JOB_STATUS_KEY
+    :rtype: str
+    """
+    if 0<=status_code<len(JOB_STATUS_KEY):
+        return JOB_STATUS_KEY[status_code]
+
+    return WORKER_STATUS_KEY.get(status_code, 'RUNNING')
+
+
+def get_wildcard_type(wildcard_str: str)->Union[str,None]:
+    """Type ("item", "folder", "file", or "annotation") of a wildcard string or None if it cannot be read
+    """
+    try:
+        return json.loads(wildcard_str[1:-1].replace("'",'"')).get('type')
+    except ValueError:
+        return None
+
 
 class Job:
     """Base class of Job
@@ -32,7 +74,10 @@ class Job:
                  plugin_id:Union[str,None] = None,
                  docker_image: Union[str,None] = None,
                  cli: Union[str,None] = None,
-                 input_args: Union[list,None] = None
+                 input_args: Union[list,None] = None,
+                 name: Union[str,None] = None,
+                 depends_on: Union[list,None] = None,
+                 lazy: bool = False
                  ):
         
         self.gc = gc
@@ -40,12 +85,69 @@ class Job:
         self.docker_image = docker_image
         self.cli = cli
         self.input_args = input_args
+        # Used by Sequence DAG mode, depends_on contains names or indices of other jobs in the same Sequence
+        self.name = name
+        self.depends_on = depends_on
         self.job_id = None
 
+        # Number of jobs per listing request when checking status without downloading logs
+        self.status_page_size = 20
+        # When True, the bytes downloaded by each get_status call are appended to status_bytes
+        self.measure_bytes = False
+        self.status_bytes = []
+        # WildcardCache shared with other jobs (e.g. set by Sequence.start for each run)
+        self.wildcard_cache = None
+        # Seconds to keep checking for the targets of file and annotation wildcards (see Job.dependent_wildcards) that do not exist yet when the job starts
+        self.wildcard_timeout = 0
+        # ReadinessProbe started by Sequence while the upstream job runs, see girder_job_sequence.readiness
+        self.readiness_probe = None
+        # Values of wildcard inputs looked up ahead of time by Job.prepare, {wildcard string: value}
+        self.prepared_values = {}
+        # ResultCache used to reuse a previous successful job with the same plugin and inputs
+        self.result_cache = None
+        # True if start() reused a previous job instead of submitting a new one
+        self.reused = False
+
+        # Incremental log tailing state, see Job.tail_logs
+        self.log_buffer = deque(maxlen = 1000)
+        self.log_offset = 0
+        self.log_updated = None
+        self.partial_log_line = ''
+
         # Either id is defined or both docker_image and cli have to be defined
         assert any([not self.plugin_id is None, all([not j is None for j in [self.docker_image, self.cli]])])
 
-        self.executable_dict = self.get_plugin_info()
+        # The plugin is looked up and its XML specification fetched on first use of executable_dict
+        # (or by Job.resolve) when lazy is True, otherwise while constructing the Job
+        self._executable_dict = None
+        self.resolved = False
+        self._resolve_lock = threading.Lock()
+        if not lazy:
+            self.resolve()
+
+    @property
+    def executable_dict(self)->Union[dict,None]:
+        if not self.resolved:
+            self.resolve()
+        return self._executable_dict
+
+    @executable_dict.setter
+    def executable_dict(self, value: Union[dict,None]):
+        self._executable_dict = value
+        self.resolved = True
+
+    def resolve(self)->Union[dict,None]:
+        """Look up the plugin (for docker_image/cli jobs) and get its executable dictionary, if that has not been done yet
+
+        :return: Executable dictionary or None if the plugin was not found
+        :rtype: Union[dict,None]
+        """
+        with self._resolve_lock:
+            if not self.resolved:
+                self._executable_dict = self.get_plugin_info()
+                self.resolved = True
+
+        return self._executable_dict
 
 
     def get_plugin_info(self):
@@ -67,14 +169,27 @@ class Job:
 
     def get_executable(self)->dict:
         """Create the executable dictionary for this plugin. Finds plugin descriptive information and organizes inputs in a ready-to-use format.
+        Parsed executables are shared between Jobs through the CLI catalog.
+
+        :return: Executable dictionary with descriptive information, parameter groups, and each parameter groups inputs
+        :rtype: dict
+        """
+        if self.plugin_id is None:
+            return None
+
+        return CLI_CATALOG.get_executable(self.gc, self.plugin_id, self.fetch_executable)
+
+    def fetch_executable(self)->dict:
+        """Download and parse this plugin's XML specification, bypassing the CLI catalog
 
         :return: Executable dictionary with descriptive information, parameter groups, and each parameter groups inputs
         :rtype: dict
         """
         executable_dict = None
         if not self.plugin_id is None:
-            plugin_xml_req = requests.get(
-                self.gc.urlBase+f'slicer_cli_web/cli/{self.plugin_id}/xml?token={self.gc.token}'
+            plugin_xml_req = get_transport(self.gc).request(
+                'GET',
+                f'/slicer_cli_web/cli/{self.plugin_id}/xml'
             )
 
             if plugin_xml_req.status_code==200:
@@ -108,7 +223,8 @@ class Job:
                                 'name': sub_el.find('name'),
                                 'channel': sub_el.find('channel'),
                                 'description': sub_el.find('description'),
-                                'default': sub_el.find('default')
+                                'default': sub_el.find('default'),
+                                'index': sub_el.find('index')
                             }
                             input_dict = get_text_key_vals(input_dict)
 
@@ -144,144 +260,139 @@ class Job:
 
         return executable_dict
 
+    @property
+    def schema(self)->Union[CLISchema,None]:
+        """Compiled parameter schema of this plugin (compiled once per executable dictionary and shared between Jobs)
+        """
+        if self.executable_dict is None:
+            return None
+
+        return get_schema(self.executable_dict)
+
     def get_defaults(self)->list:
         """Method for finding all of the default values for the current plugin
 
         :return: List of {'name': 'default'} or {'label': 'default'} values for each input
         :rtype: list
         """
-        defaults_list = []
-        if not self.executable_dict is None:
-            for p in self.executable_dict['parameters']:
-                for i in p['inputs']:
-                    if i['type']=='region':
-                        # The default region is usually "-1,-1,-1,-1" which does not meet it's own spec
-                        fixed_region = i['default'].replace('[','').replace(']','').replace(' ','')
-                        fixed_region = [float(i) for i in fixed_region.split(',')]
-                        defaults_list.append({
-                            'name': i['name'],
-                            'default': json.dumps(fixed_region)
-                        })
-                    
-                    elif 'vector' in i['type']:
-                        fixed_vector = i['default'].replace('[','').replace(']','').replace(' ','').split(',')
-                        if not 'string' in i['type']:
-                            if any([j in i['type'] for j in ['float','double']]):
-                                fixed_vector = [float(i) for i in fixed_vector]
-                            elif 'integer' in i['type']:
-                                fixed_vector = [int(i) for i in fixed_vector]
-                        
-                        defaults_list.append({
-                            'name': i['name'],
-                            'default':json.dumps(fixed_vector)
-                        })
+        if self.executable_dict is None:
+            return []
 
-                    else:
-                        defaults_list.append({
-                            'name': i['name'],
-                            'default': i['default']
-                        })
-
-        return defaults_list
+        return self.schema.defaults()
 
     def find_input(self, input_name):
 
-        exe_input = None
-        for p in self.executable_dict['parameters']:
-            for inp in p['inputs']:
-                if inp['name']==input_name:
-                    exe_input = inp
-                    break
-        
+        exe_input = self.schema.find(input_name)
+        if not exe_input is None:
+            return exe_input.info
+
         return exe_input
 
+    def validate(self, raise_error: bool = False)->list:
+        """Check this job's inputs against the plugin's types, options, constraints, and required inputs before it is submitted.
+        Wildcard inputs are not checked since they are only looked up when the job starts.
+
+        :param raise_error: Whether to raise a ValidationError if any inputs are invalid, defaults to False
+        :type raise_error: bool, optional
+        :return: List of error messages (empty if all inputs are valid)
+        :rtype: list
+        """
+        if self.executable_dict is None:
+            errors = [f'Plugin not found: {self.plugin_id or f"{self.docker_image} {self.cli}"}']
+        else:
+            errors = self.schema.validate(self.input_args)
+
+        if raise_error and len(errors)>0:
+            raise ValidationError(errors)
+
+        return errors
+
+    def prepare(self, dependent_types: list = ['file','annotation'])->list:
+        """Do the work of starting this job that does not depend on earlier jobs, so Sequence can do it while they run:
+        fetch the plugin specification, compile its schema, and look up wildcard inputs of types other than "dependent_types"
+        (by default items and folders, which earlier jobs do not create). Targets that do not exist yet are looked up when the job starts.
+
+        :param dependent_types: Wildcard types that may be created by earlier jobs, defaults to ['file','annotation']
+        :type dependent_types: list, optional
+        :return: Wildcard strings left to look up when the job starts
+        :rtype: list
+        """
+        self.resolve()
+        if self.executable_dict is None:
+            return []
+        # Compiled once and cached for the executable dictionary
+        self.schema
+
+        remaining = []
+        for i in (self.input_args or []):
+            if not type(i['value'])==str or not check_wildcard(i['value']) or i['value'] in self.prepared_values:
+                continue
+            wildcard_type = get_wildcard_type(i['value'])
+            if wildcard_type is None or wildcard_type in dependent_types:
+                remaining.append(i['value'])
+                continue
+
+            try:
+                self.prepared_values[i['value']] = parse_wildcard(self.gc, i['value'], self.wildcard_cache)
+            except WildcardNotFound:
+                remaining.append(i['value'])
+
+        return remaining
+
+    def dependent_wildcards(self, dependent_types: list = ['file','annotation'])->list:
+        """Wildcard inputs that may point at the outputs of earlier jobs. Only these are checked for up to "wildcard_timeout"
+        seconds when the job starts, any other wildcard whose target does not exist (e.g. a typo in an item path) fails right away.
+
+        :param dependent_types: Wildcard types that may be created by earlier jobs, defaults to ['file','annotation']
+        :type dependent_types: list, optional
+        :return: Wildcard strings
+        :rtype: list
+        """
+        wildcard_strs = [i['value'] for i in (self.input_args or []) if type(i['value'])==str and check_wildcard(i['value'])]
+        return [w for w in dict.fromkeys(wildcard_strs) if get_wildcard_type(w) in dependent_types]
+
     def parse_input_args(self):
         """Method for organizing user-provided job input values. Only non-default valued inputs are required.
         """
 
         if not self.input_args is None:
-            user_input_names = [i['name'] for i in self.input_args]
-            
+            # Looking up all wildcards at once, sharing results with other jobs through the wildcard cache
+            wildcard_strs = [i['value'] for i in self.input_args if type(i['value'])==str and check_wildcard(i['value'])]
+            # Only the wildcards that were not looked up by Job.prepare
+            prepared_vals = {w: self.prepared_values[w] for w in wildcard_strs if w in self.prepared_values}
+            wildcard_strs = [w for w in wildcard_strs if not w in prepared_vals]
+            if len(wildcard_strs)==0:
+                wildcard_vals = {}
+            else:
+                # Wildcards that cannot refer to an earlier job's outputs are looked up first and fail without waiting
+                waiting = [w for w in self.dependent_wildcards() if w in wildcard_strs] if self.wildcard_timeout>0 else []
+                wildcard_vals = resolve_wildcards(self.gc, [w for w in wildcard_strs if not w in waiting], cache = self.wildcard_cache)
+                if len(waiting)==0:
+                    pass
+                elif not self.readiness_probe is None and set(waiting)<=set(self.readiness_probe.wildcard_strs):
+                    wildcard_vals.update(self.readiness_probe.wait())
+                else:
+                    wildcard_vals.update(resolve_wildcards(self.gc, waiting, cache = self.wildcard_cache, wait_timeout = self.wildcard_timeout))
+            wildcard_vals = dict(wildcard_vals, **prepared_vals)
             for i in self.input_args:
                 if type(i['value'])==str:
                     if check_wildcard(i['value']):
-                        i['value'] = parse_wildcard(self.gc, i['value'])
-        
-        else:
-            user_input_names = []
-
-        inputs_list = []
-        input_names = []
-        # Replacing default values
-        plugin_defaults = self.get_defaults()
-        for p_d in plugin_defaults:
-            if 'name' in p_d:
-                if p_d['name'] in user_input_names:
-                    inputs_list.append({
-                        'name': p_d['name'],
-                        'value': self.input_args[user_input_names.index(p_d['name'])]['value']
-                    })
-                else:
-                    inputs_list.append({
-                        'name': p_d['name'],
-                        'value': p_d['default']
-                    })
-                
-                input_names.append(p_d['name'])
-            elif 'label' in p_d:
-                # This is for non-named inputs which are defined by index
-                # Ideally, every input parameter would have a name for reference but some may just have
-                # an index.
-                inputs_list.append({
-                    'name': None,
-                    'value': p_d['default']
-                })
-                input_names.append(p_d['label'])
-
-        # Non-default value-having inputs have to be defined in input_args or they'll be missing
-        if not self.input_args is None:
-            for i in self.input_args:
-                if not i['name'] in input_names:
-                    inputs_list.append({
-                        'name': i['name'],
-                        'value': i['value']
-                    })
-        
-        # Adding girderApiUrl and girderToken
-        inputs_list.extend([
-            {
-                'name': 'girderApiUrl',
-                'value': self.gc.urlBase
-            },
-            {
-                'name': 'girderToken',
-                'value': self.gc.token
-            }
-        ])
-        input_names.extend(['girderApiUrl','girderToken'])
-
-        # Checking that all inputs are present
-        required_inputs = []
-        for p in self.executable_dict['parameters']:
-            for i in p['inputs']:
-                if not i['name'] is None:
-                    required_inputs.append(i['name'])
-                elif not i['label'] is None:
-                    required_inputs.append(i['label'])
-
-        if not all([i in input_names for i in required_inputs]):
-            print(f'Missing required inputs')
-            for i in required_inputs:
-                if not i in input_names:
-                    print(f'{i} is missing')
-            
-            print(f'Provided inputs: {input_names}')
-
-        # Removing null inputs
-        for input_pair in inputs_list:
-            if input_pair['value'] is None:
-                inputs_list.remove(input_pair)
-
+                        i['value'] = wildcard_vals[i['value']]
+
+        # Replacing default values, adding girderApiUrl and girderToken, and removing null inputs
+        inputs_list = self.schema.merge(
+            self.input_args,
+            extra_inputs = [
+                {
+                    'name': 'girderApiUrl',
+                    'value': self.gc.urlBase
+                },
+                {
+                    'name': 'girderToken',
+                    'value': self.gc.token
+                }
+            ]
+        )
 
         return inputs_list
 
@@ -290,7 +401,7 @@ class Job:
         """
 
         if not self.job_id is None:
-            cancel_response = self.gc.put(
+            cancel_response = get_transport(self.gc).put(
                 f'/job/{self.job_id}/cancel'
             )
 
@@ -299,15 +410,31 @@ class Job:
             return {'message': 'Job has not started yet'}
 
     def start(self):
-        """Send start request for this job
+        """Send start request for this job. If a ResultCache is set (Job.result_cache) and a previous job with the same
+        plugin, plugin version, and inputs succeeded, that job is reused and the response to requesting it is returned instead.
         """
+        self.resolve()
         # Moving input parsing here to account for wildcard inputs that are created prior to execution of 
         # a job sequence
         self.inputs = self.parse_input_args()
-
-        start_request = requests.post(
-            url = self.gc.urlBase+f'slicer_cli_web/cli/{self.plugin_id}/run?token={self.gc.token}',
-            params = {
+        self.prepared_values = {}
+        self.reused = False
+
+        result_key = None
+        if not self.result_cache is None:
+            result_key = self.result_cache.key(self.gc, self.plugin_id, self.executable_dict, self.inputs)
+            previous_request = self.result_cache.lookup(self.gc, result_key)
+            if not previous_request is None:
+                self.job_info = previous_request.json()
+                self.job_id = self.job_info['_id']
+                self.reused = True
+
+                return previous_request
+
+        start_request = get_transport(self.gc).request(
+            'POST',
+            f'/slicer_cli_web/cli/{self.plugin_id}/run',
+            parameters = {
                 i['name']: i['value']
                 for i in self.inputs
             }
@@ -317,33 +444,144 @@ class Job:
             self.job_info = start_request.json()
             self.job_id = self.job_info['_id']
 
+            if not result_key is None:
+                self.result_cache.store(result_key, self.job_id, self.plugin_id)
+
         return start_request
 
-    def get_status(self):
+    def fetch_status_info(self, light: bool = False)->tuple:
+        """Get this job's document for checking its status.
+
+        The light path searches the /job listing, which never includes logs, for recently updated jobs of the
+        same type (active jobs first, then finished ones) and falls back to the full job document if it is not found.
+        Listing pages are usually larger than one job document unless the log is long, so this is only worth it for
+        jobs writing large logs. Checking many jobs at once is done with utils.get_jobs_info instead.
+
+        :param light: Whether to avoid downloading the job log, defaults to False
+        :type light: bool, optional
+        :return: Job document (without "log" if found through the listing) and the number of bytes downloaded
+        :rtype: tuple
+        """
+        transport = get_transport(self.gc)
+        n_bytes = 0
+
+        job_type = getattr(self, 'job_info', {}).get('type')
+        if light and not job_type is None:
+            for statuses in [ACTIVE_STATUS_CODES, FINISHED_STATUS_CODES]:
+                response = transport.request(
+                    'GET',
+                    '/job',
+                    parameters = {
+                        'types': json.dumps([job_type]),
+                        'statuses': json.dumps(statuses),
+                        'sort': 'updated',
+                        'sortdir': -1,
+                        'limit': self.status_page_size
+                    }
+                )
+                response.raise_for_status()
+                n_bytes += len(response.content)
+
+                jobs_page = response.json()
+                for j in jobs_page:
+                    if j['_id']==self.job_id:
+                        return j, n_bytes
+
+                if len(jobs_page)>=self.status_page_size:
+                    # More active jobs of this type than fit in one page, the job could be in either listing
+                    break
+
+        response = transport.request('GET', f'/job/{self.job_id}')
+        response.raise_for_status()
+        n_bytes += len(response.content)
+
+        return response.json(), n_bytes
+
+    def get_status(self, light: bool = False):
         """Get the status of the current job
+
+        :param light: Whether to avoid downloading the job log, see Job.fetch_status_info, defaults to False
+        :type light: bool, optional
         """
 
         if not self.job_id is None:
-            job_info = self.gc.get(f'/job/{self.job_id}')
+            job_info, n_bytes = self.fetch_status_info(light)
+            if self.measure_bytes:
+                self.status_bytes.append(n_bytes)
+
             job_status_idx = job_info['status']
 
-            return JOB_STATUS_KEY[job_status_idx]
+            return status_from_code(job_status_idx)
         else:
             return JOB_STATUS_KEY[0]
 
+    def compare_status_bytes(self)->dict:
+        """Measure the bytes downloaded by one status check with the full job document and with the light path
+
+        :return: {'Full': bytes, 'Light': bytes}
+        :rtype: dict
+        """
+        if self.job_id is None:
+            return {'Full': 0, 'Light': 0}
+
+        return {
+            'Full': self.fetch_status_info(light = False)[1],
+            'Light': self.fetch_status_info(light = True)[1]
+        }
+
     def get_logs(self):
         """Get logs of this job
         """
 
         if not self.job_id is None:
-            job_info = self.gc.get(f'/job/{self.job_id}')
+            with metrics.tags(operation = 'logs'):
+                job_info = get_transport(self.gc).get(f'/job/{self.job_id}')
             job_logs = job_info['log']
 
             log_list = [i.split('\n') for i in job_logs]
         else:
-            lob_list = ['Job has not started yet']
+            log_list = ['Job has not started yet']
 
         return log_list
 
+    def add_log_text(self, text: str, flush: bool = False)->list:
+        """Split new log text into complete lines, keeping any unfinished line for the next chunk.
+        Lines are also added to the job's ring buffer (log_buffer, last 1000 lines by default).
+
+        :param text: New log text
+        :type text: str
+        :param flush: Whether to also return the unfinished line (e.g. when the job is done), defaults to False
+        :type flush: bool, optional
+        :return: New complete lines
+        :rtype: list
+        """
+        lines = (self.partial_log_line + text).split('\n')
+        self.partial_log_line = lines.pop(-1)
+        if flush and not self.partial_log_line=='':
+            lines.append(self.partial_log_line)
+            self.partial_log_line = ''
+
+        self.log_buffer.extend(lines)
+
+        return lines
+
+    def tail_logs(self, poll_interval: float = 2, use_notifications: bool = True):
+        """Generator of new log lines from this job as they are written, ending when the job finishes.
+        Uses job_log events from the notification stream so that only new text is downloaded.
+
+        :param poll_interval: Seconds between checks if the notification stream is unavailable or the job has not started, defaults to 2
+        :type poll_interval: float, optional
+        :param use_notifications: Whether to use the notification stream, defaults to True
+        :type use_notifications: bool, optional
+        """
+        from .logs import LogTailer
+
+        while self.job_id is None:
+            sleep(poll_interval)
+
+        tailer = LogTailer(self.gc, [self], poll_interval = poll_interval, use_notifications = use_notifications)
+        for _, line in tailer.tail():
+            yield line
+
 
 
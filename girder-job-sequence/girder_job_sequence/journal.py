@@ -0,0 +1,178 @@
+"""Append-only run journals for resuming a Sequence after the orchestrating process restarts
+"""
+
+import os
+import json
+import sqlite3
+import threading
+from time import time
+from typing_extensions import Union
+
+
+FINAL_JOURNAL_STATES = ['SUCCESS','ERROR','CANCELED','SKIPPED']
+
+
+class RunJournal:
+    """Base class of run journals. Every event is a dictionary with "event", "sequence_id", and "time" keys.
+
+    Events written by Sequence:
+        "sequence_started": {"jobs": [job specifications], "mode": str}
+        "job_submitted": {"job_index": int, "job_id": str}
+        "job_status": {"job_index": int, "job_id": str, "status": str}
+        "sequence_finished": {"states": [final state of each job]}
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def append(self, event: dict):
+        raise NotImplementedError
+
+    def events(self, sequence_id: Union[str,None] = None)->list:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def record(self, sequence_id: str, event: str, **data):
+        """Durably write one event to the journal
+
+        :param sequence_id: Id of the Sequence (Sequence.id)
+        :type sequence_id: str
+        :param event: Type of event
+        :type event: str
+        """
+        with self._lock:
+            self.append(dict(data, event = event, sequence_id = sequence_id, time = time()))
+
+    def last_sequence_id(self)->Union[str,None]:
+        """Id of the most recently started sequence in the journal
+        """
+        started = [e for e in self.events() if e['event']=='sequence_started']
+        if len(started)==0:
+            return None
+
+        return started[-1]['sequence_id']
+
+    def state(self, sequence_id: Union[str,None] = None)->Union[dict,None]:
+        """Replay the events of one sequence (the most recent one by default)
+
+        :param sequence_id: Id of the Sequence, defaults to None
+        :type sequence_id: Union[str,None], optional
+        :return: {'sequence_id': str, 'jobs': [job specifications], 'mode': str, 'job_ids': {job index: job id},
+            'states': {job index: last status}, 'finished': bool}, or None if the sequence is not in the journal
+        :rtype: Union[dict,None]
+        """
+        if sequence_id is None:
+            sequence_id = self.last_sequence_id()
+            if sequence_id is None:
+                return None
+
+        events = self.events(sequence_id)
+        if len(events)==0:
+            return None
+
+        state = {
+            'sequence_id': sequence_id,
+            'jobs': [],
+            'mode': 'linear',
+            'job_ids': {},
+            'states': {},
+            'finished': False
+        }
+        for e in events:
+            if e['event']=='sequence_started':
+                state['jobs'] = e.get('jobs', [])
+                state['mode'] = e.get('mode', 'linear')
+                state['finished'] = False
+            elif e['event']=='job_submitted':
+                state['job_ids'][e['job_index']] = e['job_id']
+                state['states'][e['job_index']] = 'QUEUED'
+            elif e['event']=='job_status':
+                if not e.get('job_id') is None:
+                    state['job_ids'][e['job_index']] = e['job_id']
+                state['states'][e['job_index']] = e['status']
+            elif e['event']=='sequence_finished':
+                state['finished'] = True
+
+        return state
+
+
+class JSONLJournal(RunJournal):
+    """Journal stored as one JSON object per line. Each event is flushed and fsync'd before returning,
+    and a partially written last line (from a crash while writing) is ignored when reading.
+    """
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.file = open(path, 'a', encoding = 'utf-8')
+
+    def append(self, event: dict):
+        self.file.write(json.dumps(event) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def events(self, sequence_id: Union[str,None] = None)->list:
+        events = []
+        with open(self.path, 'r', encoding = 'utf-8') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if sequence_id is None or event.get('sequence_id')==sequence_id:
+                    events.append(event)
+
+        return events
+
+    def close(self):
+        self.file.close()
+
+
+class SQLiteJournal(RunJournal):
+    """Journal stored in an SQLite database (write-ahead logging, one transaction per event)
+    """
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=FULL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS events '
+            '(id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL, sequence_id TEXT, event TEXT, data TEXT)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS events_sequence ON events (sequence_id)')
+        self.connection.commit()
+
+    def append(self, event: dict):
+        with self.connection:
+            self.connection.execute(
+                'INSERT INTO events (time, sequence_id, event, data) VALUES (?, ?, ?, ?)',
+                (event['time'], event['sequence_id'], event['event'], json.dumps(event))
+            )
+
+    def events(self, sequence_id: Union[str,None] = None)->list:
+        with self._lock:
+            if sequence_id is None:
+                rows = self.connection.execute('SELECT data FROM events ORDER BY id').fetchall()
+            else:
+                rows = self.connection.execute('SELECT data FROM events WHERE sequence_id = ? ORDER BY id', (sequence_id,)).fetchall()
+
+        return [json.loads(r[0]) for r in rows]
+
+    def close(self):
+        self.connection.close()
+
+
+def open_journal(path: str)->RunJournal:
+    """Open (or create) a journal, using SQLite for ".db", ".sqlite", and ".sqlite3" files and JSONL otherwise
+
+    :param path: Path to the journal file
+    :type path: str
+    :return: Journal
+    :rtype: RunJournal
+    """
+    if os.path.splitext(path)[-1].lower() in ['.db','.sqlite','.sqlite3']:
+        return SQLiteJournal(path)
+
+    return JSONLJournal(path)
@@ -0,0 +1,156 @@
+"""Incremental log tailing for one or more running jobs
+"""
+
+from time import time, sleep
+
+import requests
+
+from .transport import get_transport
+from . import metrics
+from .utils import parse_girder_time
+from .wait import NotificationWaiter, FINISHED_STATUSES
+
+
+class LogTailer:
+    """Yield new log lines from a group of jobs as they are written.
+
+    New log text is read from "job_log" events on Girder's notification stream (one stream for all jobs), so
+    only new text is transferred. Each job's log document is downloaded once when tailing starts to catch up on
+    earlier lines. If the notification stream is unavailable, the job documents are polled instead and only
+    chunks after each job's offset are processed.
+    """
+    def __init__(self,
+                 gc,
+                 jobs: list,
+                 poll_interval: float = 2,
+                 stream_timeout: float = 5,
+                 use_notifications: bool = True,
+                 is_active = None
+                 ):
+
+        self.gc = gc
+        self.jobs = jobs
+        self.poll_interval = poll_interval
+        self.stream_timeout = stream_timeout
+        self.use_notifications = use_notifications
+        # Function returning whether more jobs may still be started (e.g. while a Sequence is running)
+        self.is_active = is_active if not is_active is None else (lambda: False)
+
+        self.waiter = NotificationWaiter(gc, stream_timeout = stream_timeout)
+        self.caught_up = {}
+        self.finished = set()
+
+    def catch_up(self, job)->list:
+        """Download the job document and process log chunks after the job's current offset
+
+        :param job: Job that has been started
+        :type job: Job
+        :return: New complete log lines
+        :rtype: list
+        """
+        from .job import status_from_code
+
+        with metrics.tags(operation = 'logs'):
+            job_info = get_transport(self.gc).get(f'/job/{job.job_id}')
+        job_logs = job_info.get('log', [])
+        if len(job_logs)<job.log_offset:
+            # Log was overwritten
+            job.log_offset = 0
+
+        new_lines = []
+        for chunk in job_logs[job.log_offset:]:
+            new_lines.extend(job.add_log_text(chunk))
+        job.log_offset = len(job_logs)
+
+        if 'updated' in job_info:
+            job.log_updated = parse_girder_time(job_info['updated'])
+
+        self.caught_up[job.job_id] = job
+        if status_from_code(job_info['status']) in FINISHED_STATUSES:
+            self.finish(job, new_lines)
+
+        return new_lines
+
+    def finish(self, job, new_lines: list):
+        self.finished.add(job.job_id)
+        new_lines.extend(job.add_log_text('', flush = True))
+
+    def done(self)->bool:
+        if self.is_active():
+            return False
+
+        started = [j for j in self.jobs if not j.job_id is None]
+        return all([j.job_id in self.finished for j in started])
+
+    def tail(self):
+        """Generator of (job, line) tuples, ending once every started job has finished and is_active() returns False
+        """
+        from .job import status_from_code
+
+        while True:
+            for job in self.jobs:
+                if not job.job_id is None and not job.job_id in self.caught_up:
+                    for line in self.catch_up(job):
+                        yield job, line
+
+            if self.done():
+                break
+
+            if len(self.caught_up)==0:
+                sleep(self.poll_interval)
+                continue
+
+            if self.use_notifications and not self.waiter.available is False:
+                if self.waiter.since is None:
+                    self.waiter.since = int(min([
+                        j.log_updated.timestamp() for j in self.caught_up.values()
+                        if not j.log_updated is None
+                    ] or [time()]))
+
+                start_time = time()
+                events = self.waiter.stream_events(self.stream_timeout)
+                try:
+                    for event in events:
+                        event_data = event.get('data',{})
+                        job = self.caught_up.get(event_data.get('_id'))
+                        if not job is None and not job.job_id in self.finished:
+                            new_lines = []
+                            event_updated = parse_girder_time(event['updated']) if 'updated' in event else None
+                            if event.get('type')=='job_log':
+                                # Skipping events already included in the downloaded document (or re-delivered)
+                                if event_updated is None or job.log_updated is None or event_updated>job.log_updated:
+                                    if event_data.get('overwrite'):
+                                        job.log_offset = 0
+                                        job.log_buffer.clear()
+                                    new_lines.extend(job.add_log_text(event_data.get('text') or ''))
+                                    job.log_offset += 1
+                                    if not event_updated is None:
+                                        job.log_updated = event_updated
+
+                            elif event.get('type')=='job_status' and status_from_code(event_data['status']) in FINISHED_STATUSES:
+                                # Downloading the rest of the log once in case any events were missed
+                                new_lines.extend(self.catch_up(job))
+
+                            for line in new_lines:
+                                yield job, line
+
+                        # Returning regularly to pick up newly started jobs
+                        if time()-start_time>self.stream_timeout or self.done():
+                            break
+                except requests.RequestException as e:
+                    print(f'Notification stream interrupted: {e}')
+                finally:
+                    events.close()
+
+                # Checking for jobs that finished without their status event being seen
+                for job in list(self.caught_up.values()):
+                    if not job.job_id in self.finished and job.get_status() in FINISHED_STATUSES:
+                        for line in self.catch_up(job):
+                            yield job, line
+
+            else:
+                sleep(self.poll_interval)
+                for job in list(self.caught_up.values()):
+                    if not job.job_id in self.finished:
+                        for line in self.catch_up(job):
+                            yield job, line
@@ -0,0 +1,187 @@
+"""Streaming readers for manifests containing many sequence definitions (JSON, JSONL, or YAML)
+
+Each record in a manifest is one sequence, either a list of job dictionaries or a dictionary with a "jobs" list
+(and optionally a "name"). A single job dictionary is a sequence with one job.
+
+YAML manifests require the optional "yaml" dependencies:
+
+    pip install girder-job-sequence[yaml]
+"""
+
+import os
+import json
+from typing_extensions import Union
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from .sequence import Sequence
+from .utils import from_dict
+
+
+MANIFEST_FORMATS = {
+    '.json': 'json',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.yaml': 'yaml',
+    '.yml': 'yaml'
+}
+
+JOB_KEYS = ['plugin_id','docker_image','cli']
+
+
+def is_job(record)->bool:
+    return isinstance(record, dict) and any([k in record for k in JOB_KEYS])
+
+def normalize_record(record, index: int)->dict:
+    """Convert one manifest record to {'index': int, 'name': Union[str,None], 'jobs': list}
+    """
+    if isinstance(record, list):
+        return {'index': index, 'name': None, 'jobs': record}
+    elif is_job(record):
+        return {'index': index, 'name': None, 'jobs': [record]}
+    elif isinstance(record, dict) and isinstance(record.get('jobs'), list):
+        return dict(record, index = index, name = record.get('name'))
+
+    raise ValueError(f'Manifest record {index} is not a list of jobs, a job, or a dictionary with "jobs"')
+
+def iter_json_array(file, chunk_size: int = 65536):
+    """Yield the elements of a top-level JSON array one at a time, holding at most one element (plus one chunk) in memory.
+    A top-level value that is not an array is yielded as a single element.
+
+    :param file: Text file object
+    :param chunk_size: Number of characters read at a time, defaults to 65536
+    :type chunk_size: int, optional
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    at_eof = False
+
+    def fill():
+        nonlocal buffer, position, at_eof
+        chunk = file.read(chunk_size)
+        if chunk=='':
+            at_eof = True
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    def skip(characters):
+        nonlocal position
+        while True:
+            while position<len(buffer) and buffer[position] in characters:
+                position += 1
+            if position<len(buffer) or at_eof:
+                return
+            fill()
+
+    def decode():
+        nonlocal position
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if at_eof:
+                    raise
+                fill()
+                continue
+
+            # Numbers (and literals) could continue in the next chunk
+            if end==len(buffer) and not at_eof and not buffer[position] in '[{"':
+                fill()
+                continue
+
+            position = end
+            return value
+
+    fill()
+    skip(' \t\r\n')
+    if position>=len(buffer):
+        return
+
+    if not buffer[position]=='[':
+        yield decode()
+        return
+
+    position += 1
+    while True:
+        skip(' \t\r\n,')
+        if position>=len(buffer):
+            raise ValueError('Unterminated JSON array')
+        if buffer[position]==']':
+            return
+
+        yield decode()
+
+def iter_manifest(path: str, format: Union[str,None] = None):
+    """Yield normalized sequence definitions ({'index', 'name', 'jobs'}) from a manifest as it is read
+
+    JSONL manifests contain one record per line and YAML manifests one record per document (a document that is a
+    list of records is also accepted). JSON manifests are either one record or an array of records, read one element
+    at a time. A JSON array of job dictionaries (the format read by utils.from_json) is one sequence.
+
+    :param path: Path to the manifest
+    :type path: str
+    :param format: One of "json", "jsonl", or "yaml", defaults to detecting it from the file extension
+    :type format: Union[str,None], optional
+    """
+    if format is None:
+        format = MANIFEST_FORMATS.get(os.path.splitext(path)[-1].lower(), 'json')
+    assert format in ['json','jsonl','yaml']
+
+    if format=='yaml' and yaml is None:
+        raise ImportError('PyYAML is required for YAML manifests, install with: pip install girder-job-sequence[yaml]')
+
+    with open(path, 'r', encoding = 'utf-8') as f:
+        if format=='jsonl':
+            index = 0
+            for line_number, line in enumerate(f):
+                if line.strip()=='':
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    raise ValueError(f'Invalid JSON on line {line_number+1} of {path}: {e}')
+
+                yield normalize_record(record, index)
+                index += 1
+
+        elif format=='yaml':
+            index = 0
+            for document in yaml.safe_load_all(f):
+                if document is None:
+                    continue
+                records = document if isinstance(document, list) and not all([is_job(r) for r in document]) else [document]
+                for record in records:
+                    yield normalize_record(record, index)
+                    index += 1
+
+        else:
+            elements = iter_json_array(f)
+            first = next(elements, None)
+            if first is None:
+                return
+
+            if is_job(first):
+                yield normalize_record([first] + list(elements), 0)
+                return
+
+            yield normalize_record(first, 0)
+            for index, record in enumerate(elements, start = 1):
+                yield normalize_record(record, index)
+
+def iter_sequences(gc, path: str, format: Union[str,None] = None, **sequence_kwargs):
+    """Yield a Sequence for each record of a manifest as it is read. Plugin specifications are fetched when
+    each Sequence starts (or is validated), see Job.resolve.
+
+    :param gc: Girder client handler
+    :type gc: None
+    :param path: Path to the manifest
+    :type path: str
+    :param format: One of "json", "jsonl", or "yaml", defaults to detecting it from the file extension
+    :type format: Union[str,None], optional
+    """
+    for record in iter_manifest(path, format):
+        yield Sequence(gc, [from_dict(gc, j, lazy = True) for j in record['jobs']], name = record['name'], **sequence_kwargs)
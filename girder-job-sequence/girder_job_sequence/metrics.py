@@ -0,0 +1,288 @@
+"""Instrumentation hooks for REST calls made by Job, Sequence, and utility lookups
+"""
+
+import os
+import re
+import json
+import bisect
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from time import time, perf_counter
+from typing_extensions import Union
+
+
+# Called with one event dictionary per request (or timed span), nothing is recorded while this is empty
+_hooks = []
+_hooks_lock = threading.Lock()
+
+# Tags (e.g. "sequence_id", "operation") added to every event recorded in the current context
+_tags = contextvars.ContextVar('girder_job_sequence_tags', default = {})
+
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# (method or None for any, path pattern, operation), checked in order
+OPERATION_PATTERNS = [
+    ('GET', re.compile(r'^/?slicer_cli_web/cli/?$'), 'catalog'),
+    (None, re.compile(r'^/?slicer_cli_web/cli/[^/]+/xml$'), 'xml'),
+    ('POST', re.compile(r'^/?slicer_cli_web/cli/[^/]+/run$'), 'start'),
+    (None, re.compile(r'^/?job/[^/]+/cancel$'), 'cancel'),
+    (None, re.compile(r'^/?job/[^/]+/metadata$'), 'metadata'),
+    ('GET', re.compile(r'^/?job/[^/]+$'), 'status'),
+    ('GET', re.compile(r'^/?job/?$'), 'job_listing'),
+    (None, re.compile(r'^/?notification'), 'notification'),
+    (None, re.compile(r'^/?(resource/lookup|item|folder|annotation)'), 'wildcard')
+]
+
+
+def add_hook(hook):
+    """Start sending events to a hook (any callable taking one event dictionary, e.g. MetricsRecorder or JSONLogHook)
+
+    Events have the keys "kind" ("request" or "span"), "operation", "method", "path", "status", "error",
+    "seconds", "bytes_sent", "bytes_received", "time", and any tags set with girder_job_sequence.metrics.tags
+    (Sequence.start tags requests with "sequence_id").
+
+    :param hook: Callable taking one event dictionary
+    :type hook: Callable
+    :return: The hook
+    """
+    with _hooks_lock:
+        if not hook in _hooks:
+            _hooks.append(hook)
+
+    return hook
+
+def remove_hook(hook):
+    """Stop sending events to a hook
+    """
+    with _hooks_lock:
+        if hook in _hooks:
+            _hooks.remove(hook)
+
+def enabled()->bool:
+    return len(_hooks)>0
+
+@contextmanager
+def tags(**new_tags):
+    """Add tags to every event recorded in this context (including threads started with propagate_context).
+    An "operation" tag replaces the operation derived from the request path.
+    """
+    token = _tags.set(dict(_tags.get(), **new_tags))
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+def propagate_context(function):
+    """Wrap a function that will be run on another thread (e.g. by a ThreadPoolExecutor) so that
+    events it records keep the tags of the current context. Returns the function unchanged when no hooks are added.
+    """
+    if not enabled():
+        return function
+
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # One context can only be entered by one thread at a time
+        return context.copy().run(function, *args, **kwargs)
+
+    return run
+
+def classify_request(method: str, path: str)->str:
+    """Name of the operation a request is part of, e.g. "catalog", "xml", "start", "status", or "wildcard"
+    """
+    for pattern_method, pattern, operation in OPERATION_PATTERNS:
+        if (pattern_method is None or pattern_method==method.upper()) and pattern.search(path):
+            return operation
+
+    return 'other'
+
+def record(event: dict):
+    """Send an event to every hook, adding the current tags. Errors raised by hooks are logged and ignored.
+    """
+    event = dict(event, **_tags.get())
+    for hook in list(_hooks):
+        try:
+            hook(event)
+        except Exception:
+            logging.getLogger(__name__).exception('Instrumentation hook failed')
+
+def record_request(method: str, path: str, seconds: float, status: Union[int,None] = None, bytes_sent: int = 0, bytes_received: int = 0, error: Union[str,None] = None):
+    """Record one REST call
+    """
+    record({
+        'kind': 'request',
+        'operation': classify_request(method, path),
+        'method': method.upper(),
+        'path': path,
+        'status': status,
+        'error': error if not error is None else (None if status is None or status<400 else f'HTTP {status}'),
+        'seconds': seconds,
+        'bytes_sent': bytes_sent,
+        'bytes_received': bytes_received,
+        'time': time()
+    })
+
+@contextmanager
+def timed(operation: str):
+    """Record how long the code in this context takes as a "span" event (e.g. waiting for a job to finish)
+    """
+    if not enabled():
+        yield
+        return
+
+    start = perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        record({
+            'kind': 'span',
+            'operation': operation,
+            'method': None,
+            'path': None,
+            'status': None,
+            'error': error,
+            'seconds': perf_counter() - start,
+            'bytes_sent': 0,
+            'bytes_received': 0,
+            'time': time()
+        })
+
+
+class MetricsRecorder:
+    """Hook aggregating events into counts, latency histograms, and bytes per (kind, operation, sequence id).
+    Export with to_prometheus/write_prometheus (text exposition format) or to_dict.
+
+    recorder = add_hook(MetricsRecorder())
+    job_sequence.start()
+    recorder.write_prometheus('/var/lib/node_exporter/girder_job_sequence.prom')
+    """
+    def __init__(self, buckets: list = DEFAULT_BUCKETS, prefix: str = 'girder_job_sequence'):
+        self.buckets = sorted(buckets)
+        self.prefix = prefix
+
+        self._lock = threading.Lock()
+        # {(kind, operation, sequence_id): {'count', 'errors', 'seconds', 'bytes_sent', 'bytes_received', 'buckets'}}
+        self._series = {}
+
+    def __call__(self, event: dict):
+        key = (event['kind'], event['operation'], event.get('sequence_id') or '')
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = {
+                    'count': 0,
+                    'errors': 0,
+                    'seconds': 0.0,
+                    'bytes_sent': 0,
+                    'bytes_received': 0,
+                    # Non-cumulative counts, the last one is for latencies above the largest bucket
+                    'buckets': [0]*(len(self.buckets)+1)
+                }
+                self._series[key] = series
+
+            series['count'] += 1
+            series['errors'] += int(not event.get('error') is None)
+            series['seconds'] += event['seconds']
+            series['bytes_sent'] += event.get('bytes_sent') or 0
+            series['bytes_received'] += event.get('bytes_received') or 0
+            series['buckets'][bisect.bisect_left(self.buckets, event['seconds'])] += 1
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def to_dict(self)->list:
+        """Aggregated metrics
+
+        :return: List of {'kind', 'operation', 'sequence_id', 'count', 'errors', 'seconds', 'bytes_sent', 'bytes_received', 'buckets'}
+            dictionaries where "buckets" maps each upper bound (and "+Inf") to a cumulative count
+        :rtype: list
+        """
+        with self._lock:
+            series = [(k, dict(v, buckets = list(v['buckets']))) for k,v in self._series.items()]
+
+        summaries = []
+        for (kind, operation, sequence_id), values in sorted(series):
+            cumulative = 0
+            buckets = {}
+            for upper, n in zip(self.buckets + ['+Inf'], values['buckets']):
+                cumulative += n
+                buckets[str(upper)] = cumulative
+
+            summaries.append(dict(values, kind = kind, operation = operation, sequence_id = sequence_id, buckets = buckets))
+
+        return summaries
+
+    def to_prometheus(self)->str:
+        """Metrics in the Prometheus text exposition format
+        """
+        summaries = self.to_dict()
+        lines = []
+        for kind in sorted(set([s['kind'] for s in summaries])):
+            name = f'{self.prefix}_{kind}'
+            kind_summaries = [s for s in summaries if s['kind']==kind]
+
+            lines.append(f'# HELP {name}_seconds Duration of {kind}s by operation and sequence id')
+            lines.append(f'# TYPE {name}_seconds histogram')
+            for s in kind_summaries:
+                labels = f'operation="{s["operation"]}",sequence_id="{s["sequence_id"]}"'
+                for upper, n in s['buckets'].items():
+                    lines.append(f'{name}_seconds_bucket{{{labels},le="{upper}"}} {n}')
+                lines.append(f'{name}_seconds_sum{{{labels}}} {s["seconds"]}')
+                lines.append(f'{name}_seconds_count{{{labels}}} {s["count"]}')
+
+            lines.append(f'# HELP {name}_errors_total Failed {kind}s by operation and sequence id')
+            lines.append(f'# TYPE {name}_errors_total counter')
+            for s in kind_summaries:
+                lines.append(f'{name}_errors_total{{operation="{s["operation"]}",sequence_id="{s["sequence_id"]}"}} {s["errors"]}')
+
+            if kind=='request':
+                lines.append(f'# HELP {name}_bytes_total Bytes sent and received by operation and sequence id')
+                lines.append(f'# TYPE {name}_bytes_total counter')
+                for s in kind_summaries:
+                    for direction in ['sent','received']:
+                        lines.append(
+                            f'{name}_bytes_total{{operation="{s["operation"]}",sequence_id="{s["sequence_id"]}",direction="{direction}"}} {s["bytes_"+direction]}'
+                        )
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        """Write metrics to a text file (e.g. for the node_exporter textfile collector), replacing it atomically
+        """
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding = 'utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+class JSONLogHook:
+    """Hook writing each event as one JSON line, either to a file or to a logging.Logger (at INFO level)
+    """
+    def __init__(self, destination: Union[str,logging.Logger]):
+        self._lock = threading.Lock()
+        if isinstance(destination, logging.Logger):
+            self.logger = destination
+            self.file = None
+        else:
+            self.logger = None
+            self.file = open(destination, 'a', encoding = 'utf-8')
+
+    def __call__(self, event: dict):
+        line = json.dumps(event, default = str)
+        if self.logger is None:
+            with self._lock:
+                self.file.write(line + '\n')
+                self.file.flush()
+        else:
+            self.logger.info(line)
+
+    def close(self):
+        if not self.file is None:
+            self.file.close()
@@ -0,0 +1,124 @@
+"""Probing for the outputs of an upstream job that a downstream job's wildcard inputs refer to
+"""
+
+import threading
+from time import time
+
+from .utils import parse_wildcard, WildcardNotFound
+
+
+class ReadinessProbe:
+    """Checks for the targets of a job's wildcard inputs on a background thread, with exponential backoff,
+    starting when Sequence calls upstream_finished.
+
+    Nothing is checked while the upstream job runs since any target found then may be left over from an earlier run.
+    Job.parse_input_args uses wait() instead of looking the wildcards up.
+    """
+    def __init__(self,
+                 gc,
+                 wildcard_strs: list,
+                 cache = None,
+                 timeout: float = 300,
+                 initial_interval: float = 0.5,
+                 max_interval: float = 10,
+                 factor: float = 2.0
+                 ):
+
+        self.gc = gc
+        self.wildcard_strs = list(dict.fromkeys(wildcard_strs))
+        self.cache = cache
+        self.timeout = timeout
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.factor = factor
+
+        self._condition = threading.Condition()
+        # {wildcard string: value}
+        self.values = {}
+        self.errors = {}
+        self.upstream_done = None
+        self.stopped = False
+        self.n_checks = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+        return self
+
+    def ready(self)->bool:
+        return all([w in self.values for w in self.wildcard_strs])
+
+    def run(self):
+        interval = self.initial_interval
+        with self._condition:
+            while not self.stopped and self.upstream_done is None:
+                self._condition.wait()
+
+            while not self.stopped and not self.ready():
+                if time() - self.upstream_done>self.timeout:
+                    break
+
+                to_check = [w for w in self.wildcard_strs if not w in self.values]
+                found, errors = {}, {}
+                self._condition.release()
+                try:
+                    for w in to_check:
+                        try:
+                            found[w] = parse_wildcard(self.gc, w, self.cache)
+                        except WildcardNotFound:
+                            continue
+                        except Exception as e:
+                            # Other errors (e.g. an invalid wildcard) are raised from wait()
+                            errors[w] = e
+                finally:
+                    self._condition.acquire()
+                    self.values.update(found)
+                    self.errors.update(errors)
+                    self.n_checks += 1
+
+                if len(self.errors)>0 or self.ready():
+                    break
+
+                self._condition.wait(interval)
+                interval = min(interval*self.factor, self.max_interval)
+
+            self.stopped = True
+            self._condition.notify_all()
+
+    def upstream_finished(self):
+        """Record that the upstream job finished so checking starts
+        """
+        with self._condition:
+            self.upstream_done = time()
+            self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self.stopped = True
+            self._condition.notify_all()
+
+    def wait(self)->dict:
+        """Block until every wildcard's target exists (at most "timeout" seconds after the upstream job finished)
+
+        :raises WildcardNotFound: If a target was not found in time
+        :return: Dictionary of wildcard string: value
+        :rtype: dict
+        """
+        if self.upstream_done is None:
+            self.upstream_finished()
+        if self.thread is None:
+            self.start()
+
+        with self._condition:
+            while not self.stopped and not self.ready():
+                self._condition.wait(1)
+
+            if len(self.errors)>0:
+                raise next(iter(self.errors.values()))
+
+            missing = [w for w in self.wildcard_strs if not w in self.values]
+            if len(missing)>0:
+                raise WildcardNotFound(f'Wildcard targets not found {self.timeout}s after the upstream job finished: {missing}')
+
+            return {w: self.values[w] for w in self.wildcard_strs}
@@ -0,0 +1,219 @@
+"""Priority scheduling of job submissions from many Sequences based on the DSA's worker capacity
+"""
+
+import json
+import heapq
+import itertools
+import threading
+from time import time
+from typing_extensions import Union
+
+from .transport import get_transport
+
+
+# QUEUED, RUNNING, and the girder_worker statuses of running jobs. INACTIVE jobs are not counted since jobs
+# that were never scheduled stay INACTIVE indefinitely.
+SCHEDULED_STATUS_CODES = [1, 2, 820, 821, 822, 823, 824]
+
+
+class PriorityScheduler:
+    """Holds job submissions from many Sequences in local queues and releases them only while the DSA has
+    free worker capacity.
+
+    Every Sequence (or BatchRunner) is given a slot object from PriorityScheduler.slots as its "job_slots".
+    Waiting jobs are released in order of priority (lower values first), then to the tenant using the smallest
+    share of its weight, then in the order they started waiting.
+
+    The number of queued and running jobs is read from the /job listing (or /job/all for admins with all_users = True)
+    at most every "refresh_interval" seconds. Worker capacity is "worker_capacity" if given, otherwise the total
+    concurrency reported by /worker/status (admin only), otherwise "default_capacity".
+
+    scheduler = PriorityScheduler(gc, tenant_weights = {'clinical': 3, 'research': 1})
+    urgent = Sequence(gc, jobs, job_slots = scheduler.slots(priority = 0, tenant = 'clinical'))
+    bulk = BatchRunner(gc, template, item_ids, job_slots = scheduler.slots(priority = 10, tenant = 'research'))
+    """
+    def __init__(self,
+                 gc,
+                 worker_capacity: Union[int,None] = None,
+                 max_queued: int = 0,
+                 max_in_flight: Union[int,None] = None,
+                 tenant_weights: Union[dict,None] = None,
+                 refresh_interval: float = 5,
+                 default_capacity: int = 4,
+                 all_users: bool = False
+                 ):
+
+        assert max_queued>=0 and refresh_interval>0 and default_capacity>0
+        assert max_in_flight is None or max_in_flight>0
+
+        self.gc = gc
+        self.worker_capacity = worker_capacity
+        # Number of jobs allowed to wait in the server's queue beyond the worker capacity
+        self.max_queued = max_queued
+        # Cap on the jobs released by this scheduler regardless of server capacity
+        self.max_in_flight = max_in_flight
+        self.tenant_weights = tenant_weights if not tenant_weights is None else {}
+        self.refresh_interval = refresh_interval
+        self.default_capacity = default_capacity
+        self.all_users = all_users
+
+        self._condition = threading.Condition()
+        # {tenant: heap of (priority, order, waiter)}
+        self._queues = {}
+        self._order = itertools.count()
+        # {tenant: number of released jobs that have not finished}
+        self._in_flight = {}
+
+        self.server_active = 0
+        self.capacity = worker_capacity
+        self._refreshed = None
+        self._refreshing = False
+
+    def slots(self, priority: int = 0, tenant: str = 'default'):
+        """Semaphore-like object (acquire/release) for Sequence.job_slots or BatchRunner(job_slots = ...)
+
+        :param priority: Jobs with lower values are released first, defaults to 0
+        :type priority: int, optional
+        :param tenant: Name used for fair-sharing capacity between tenants with the same priority, defaults to 'default'
+        :type tenant: str, optional
+        :return: Slots for this priority and tenant
+        :rtype: ScheduledSlots
+        """
+        return ScheduledSlots(self, priority, tenant)
+
+    def refresh(self):
+        """Read the number of active (queued or running) jobs and the worker capacity from the server
+        """
+        transport = get_transport(self.gc)
+
+        capacity = self.worker_capacity
+        if capacity is None:
+            capacity = self.default_capacity
+            response = transport.request('GET', '/worker/status', retry = False)
+            if response.status_code==200:
+                stats = response.json().get('stats') or {}
+                worker_concurrency = sum([(w.get('pool') or {}).get('max-concurrency', 0) for w in stats.values() if isinstance(w, dict)])
+                if worker_concurrency>0:
+                    capacity = worker_concurrency
+
+        limit = capacity + self.max_queued + 1
+        active_jobs = transport.get(
+            '/job/all' if self.all_users else '/job',
+            parameters = {
+                'statuses': json.dumps(SCHEDULED_STATUS_CODES),
+                'limit': limit
+            }
+        )
+
+        with self._condition:
+            self.capacity = capacity
+            self.server_active = len(active_jobs)
+            self._refreshed = time()
+            self._condition.notify_all()
+
+    def free_slots(self)->int:
+        """Number of jobs that can be released now, from the last refresh and the jobs released and finished since
+        """
+        in_flight = sum(self._in_flight.values())
+        # Jobs released by this scheduler may not have been submitted (or listed) yet when the server was checked
+        free = (self.capacity or self.default_capacity) + self.max_queued - max(self.server_active, in_flight)
+        if not self.max_in_flight is None:
+            free = min(free, self.max_in_flight - in_flight)
+
+        return free
+
+    def next_waiter(self):
+        """Waiter to release next: lowest priority value, then the tenant using the least of its share, then first to wait
+        """
+        best = None
+        for tenant, queue in self._queues.items():
+            if len(queue)==0:
+                continue
+            priority, order, waiter = queue[0]
+            usage = self._in_flight.get(tenant, 0) / self.tenant_weights.get(tenant, 1)
+            if best is None or (priority, usage, order)<best[0]:
+                best = ((priority, usage, order), tenant)
+
+        if best is None:
+            return None
+
+        return self._queues[best[1]][0][2]
+
+    def acquire(self, priority: int = 0, tenant: str = 'default'):
+        """Block until a job of this priority and tenant can be submitted
+        """
+        waiter = object()
+        with self._condition:
+            heapq.heappush(self._queues.setdefault(tenant, []), (priority, next(self._order), waiter))
+
+            while True:
+                stale = self._refreshed is None or time() - self._refreshed>=self.refresh_interval
+                if stale and not self._refreshing:
+                    # Other threads can release jobs while the server is being checked
+                    self._refreshing = True
+                    self._condition.release()
+                    error = None
+                    try:
+                        self.refresh()
+                    except Exception as e:
+                        error = e
+                    finally:
+                        self._condition.acquire()
+                        self._refreshing = False
+
+                    if not error is None:
+                        print(f'Unable to read job counts from the server: {error}')
+                        self._refreshed = time()
+                    continue
+
+                if self.next_waiter() is waiter and self.free_slots()>0:
+                    heapq.heappop(self._queues[tenant])
+                    self._in_flight[tenant] = self._in_flight.get(tenant, 0) + 1
+                    # Counted as active on the server until the next refresh
+                    self.server_active += 1
+                    self._condition.notify_all()
+                    return
+
+                timeout = self.refresh_interval if self._refreshed is None else max(self._refreshed + self.refresh_interval - time(), 0.01)
+                self._condition.wait(timeout)
+
+    def release(self, tenant: str = 'default'):
+        """Record that a released job finished, letting the next waiting job go
+        """
+        with self._condition:
+            self._in_flight[tenant] = max(self._in_flight.get(tenant, 0) - 1, 0)
+            self.server_active = max(self.server_active - 1, 0)
+            self._condition.notify_all()
+
+    def stats(self)->dict:
+        """Current capacity, server job count, and local queue lengths and in-flight jobs per tenant
+        """
+        with self._condition:
+            return {
+                'Capacity': self.capacity,
+                'Server Active': self.server_active,
+                'Waiting': {t: len(q) for t,q in self._queues.items()},
+                'In Flight': dict(self._in_flight)
+            }
+
+
+class ScheduledSlots:
+    """Job slots of one priority and tenant on a PriorityScheduler, used like a semaphore by Sequence
+    """
+    def __init__(self, scheduler: PriorityScheduler, priority: int = 0, tenant: str = 'default'):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.tenant = tenant
+
+    def acquire(self):
+        self.scheduler.acquire(self.priority, self.tenant)
+        return True
+
+    def release(self):
+        self.scheduler.release(self.tenant)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
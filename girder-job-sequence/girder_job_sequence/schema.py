@@ -0,0 +1,309 @@
+"""Compiled plugin parameter schema used by Job to merge user inputs with plugin defaults
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from typing_extensions import Union
+
+
+INTEGER_TYPES = ['integer','integer-vector','integer-enumeration']
+FLOAT_TYPES = ['float','double','float-vector','double-vector','float-enumeration','double-enumeration','region','point']
+BOOLEAN_VALUES = [True, False, 'true', 'false', 'True', 'False']
+
+
+class ValidationError(ValueError):
+    """Raised when job inputs do not match their plugin's specification, with every problem found in "errors"
+    """
+    def __init__(self, errors: list):
+        self.errors = errors
+        super().__init__('Invalid job inputs:\n' + '\n'.join(errors))
+
+
+class Parameter:
+    """One input of a plugin, with its default value and constraints parsed ahead of time
+    """
+    __slots__ = ('type','name','label','channel','description','default','options','constraints','info',
+                 'required','minimum','maximum','step','option_values')
+
+    def __init__(self, info: dict):
+        self.type = info['type']
+        self.name = info['name']
+        self.label = info['label']
+        self.channel = info['channel']
+        self.description = info['description']
+        self.options = info.get('options')
+        self.constraints = info.get('constraints')
+        # Input dictionary from the executable dictionary
+        self.info = info
+        self.default = self.parse_default(info['type'], info['default'])
+
+        # Inputs given by index (positional arguments) without a default have to be provided
+        self.required = not info.get('index') is None and info['default'] is None
+
+        constraints = self.constraints or {}
+        self.minimum = self.parse_number(constraints.get('min'))
+        self.maximum = self.parse_number(constraints.get('max'))
+        self.step = self.parse_number(constraints.get('step'))
+
+        self.option_values = None
+        if not self.options is None:
+            self.option_values = set([self.parse_scalar(o)[0] for o in self.options if not o is None])
+
+    @property
+    def key(self)->Union[str,None]:
+        """Name used to refer to this input, its name or (for inputs defined by index) its label
+        """
+        return self.name if not self.name is None else self.label
+
+    @staticmethod
+    def parse_number(value):
+        try:
+            return float(value) if not value is None else None
+        except ValueError:
+            return None
+
+    def base_type(self)->str:
+        if self.type in INTEGER_TYPES:
+            return 'integer'
+        elif self.type in FLOAT_TYPES:
+            return 'float'
+        elif self.type=='boolean':
+            return 'boolean'
+        elif 'string' in self.type:
+            return 'string'
+
+        return 'resource'
+
+    def parse_scalar(self, value)->tuple:
+        """Convert one value to this input's type, returning (value, error message or None)
+        """
+        base_type = self.base_type()
+        if base_type=='integer':
+            if isinstance(value, bool):
+                return value, 'expected an integer'
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                return value, 'expected an integer'
+            if not number==int(number):
+                return value, 'expected an integer'
+            return int(number), None
+        elif base_type=='float':
+            if isinstance(value, bool):
+                return value, 'expected a number'
+            try:
+                return float(value), None
+            except (TypeError, ValueError):
+                return value, 'expected a number'
+        elif base_type=='boolean':
+            if not value in BOOLEAN_VALUES:
+                return value, 'expected true or false'
+            return value in [True,'true','True'], None
+
+        return str(value), None
+
+    def split_vector(self, value)->list:
+        if isinstance(value, (list, tuple)):
+            return list(value)
+
+        return str(value).replace('[','').replace(']','').replace(' ','').split(',')
+
+    def validate(self, value)->list:
+        """Check a value against this input's type, options, and constraints
+
+        :param value: Value provided for this input (wildcards are not checked since they are only resolved at submission)
+        :return: List of error messages (empty if the value is valid)
+        :rtype: list
+        """
+        if value is None:
+            return ['required input is missing'] if self.required else []
+        if isinstance(value, str) and '{{' in value:
+            return []
+
+        if 'vector' in self.type or self.type in ['region','point']:
+            values = self.split_vector(value)
+            if self.type=='region' and not len(values) in [4,6]:
+                return [f'expected 4 or 6 values for a region, got {len(values)}']
+        else:
+            values = [value]
+
+        errors = []
+        for v in values:
+            parsed, error = self.parse_scalar(v)
+            if not error is None:
+                errors.append(f'{error}, got {v!r}')
+                continue
+
+            if not self.option_values is None and not parsed in self.option_values:
+                errors.append(f'{v!r} is not one of {self.options}')
+                continue
+
+            if self.base_type() in ['integer','float']:
+                if not self.minimum is None and parsed<self.minimum:
+                    errors.append(f'{v!r} is less than the minimum of {self.constraints["min"]}')
+                if not self.maximum is None and parsed>self.maximum:
+                    errors.append(f'{v!r} is more than the maximum of {self.constraints["max"]}')
+                # Slicer uses step as the slider increment for floating point inputs so it is only enforced for integers
+                if self.base_type()=='integer' and not self.step is None and self.step>0:
+                    offset = parsed - (self.minimum if not self.minimum is None else 0)
+                    if not abs(offset/self.step - round(offset/self.step))<1e-9:
+                        errors.append(f'{v!r} is not a multiple of the step {self.constraints["step"]}')
+
+            elif self.base_type()=='resource' and str(parsed).strip()=='':
+                errors.append('expected an id or path, got an empty string')
+
+        return errors
+
+    @staticmethod
+    def parse_default(param_type: str, default: Union[str,None]):
+        """Format default values of region and vector inputs as JSON lists
+        """
+        if default is None:
+            return default
+
+        try:
+            if param_type=='region':
+                # The default region is usually "-1,-1,-1,-1" which does not meet it's own spec
+                fixed_region = default.replace('[','').replace(']','').replace(' ','')
+                return json.dumps([float(i) for i in fixed_region.split(',')])
+
+            elif 'vector' in param_type:
+                fixed_vector = default.replace('[','').replace(']','').replace(' ','').split(',')
+                if not 'string' in param_type:
+                    if any([j in param_type for j in ['float','double']]):
+                        fixed_vector = [float(i) for i in fixed_vector]
+                    elif 'integer' in param_type:
+                        fixed_vector = [int(i) for i in fixed_vector]
+
+                return json.dumps(fixed_vector)
+        except ValueError:
+            # Leaving defaults that can't be parsed (e.g. empty vectors) as they are
+            return default
+
+        return default
+
+
+class CLISchema:
+    """Parameters of a plugin in order, with a name (or label) index
+    """
+    __slots__ = ('title','parameters','index','names')
+
+    def __init__(self, executable_dict: dict):
+        self.title = executable_dict.get('title')
+        self.parameters = [
+            Parameter(i)
+            for p in executable_dict.get('parameters', [])
+            for i in p['inputs']
+        ]
+        self.index = {}
+        for p in self.parameters:
+            if not p.key is None:
+                self.index.setdefault(p.key, p)
+        self.names = frozenset([p.name for p in self.parameters if not p.name is None])
+
+    def find(self, name: str)->Union[Parameter,None]:
+        return self.index.get(name)
+
+    def validate(self, input_args: Union[list,None])->list:
+        """Check user-provided inputs against the plugin's parameters without contacting the server
+
+        :param input_args: List of {'name': name, 'value': value} provided by the user
+        :type input_args: Union[list,None]
+        :return: List of error messages (empty if all inputs are valid)
+        :rtype: list
+        """
+        user_values = {}
+        if not input_args is None:
+            for i in input_args:
+                if not i['name'] in user_values:
+                    user_values[i['name']] = i['value']
+
+        errors = []
+        for p in self.parameters:
+            if not p.name is None and p.name in user_values:
+                value = user_values[p.name]
+            elif p.required:
+                value = p.default
+            else:
+                # Defaults come from the plugin itself
+                continue
+
+            for error in p.validate(value):
+                errors.append(f'{p.key}: {error}')
+
+        return errors
+
+    def defaults(self)->list:
+        """List of {'name': name, 'default': default} for each input (same format as Job.get_defaults)
+        """
+        return [{'name': p.name, 'default': p.default} for p in self.parameters]
+
+    def merge(self, input_args: Union[list,None], extra_inputs: list = [])->list:
+        """Merge user-provided inputs with the plugin defaults in one pass
+
+        :param input_args: List of {'name': name, 'value': value} provided by the user (the first value of a repeated name is used)
+        :type input_args: Union[list,None]
+        :param extra_inputs: Inputs added after all others (e.g. girderApiUrl and girderToken), defaults to []
+        :type extra_inputs: list, optional
+        :return: List of {'name': name, 'value': value} without None values
+        :rtype: list
+        """
+        user_values = {}
+        if not input_args is None:
+            for i in input_args:
+                if not i['name'] in user_values:
+                    user_values[i['name']] = i['value']
+
+        inputs_list = []
+        for p in self.parameters:
+            if not p.name is None and p.name in user_values:
+                value = user_values[p.name]
+            else:
+                # Inputs without a name are defined by index and always use the default
+                value = p.default
+
+            if not value is None:
+                inputs_list.append({'name': p.name, 'value': value})
+
+        # Inputs that are not in the plugin's parameters are passed through as they are
+        for name, value in user_values.items():
+            if not name in self.names and not value is None:
+                inputs_list.append({'name': name, 'value': value})
+
+        for i in extra_inputs:
+            if not i['value'] is None:
+                inputs_list.append(i)
+
+        return inputs_list
+
+
+# Compiled schemas of executable dictionaries shared through the CLI catalog
+_schemas = OrderedDict()
+_schemas_lock = threading.Lock()
+_max_schemas = 256
+
+def get_schema(executable_dict: dict)->CLISchema:
+    """Get the compiled schema of an executable dictionary, compiling it the first time it is seen
+
+    :param executable_dict: Executable dictionary (see Job.get_executable)
+    :type executable_dict: dict
+    :return: Compiled schema
+    :rtype: CLISchema
+    """
+    key = id(executable_dict)
+    with _schemas_lock:
+        entry = _schemas.get(key)
+        # Holding on to the dictionary so that its id is not reused while it is cached
+        if not entry is None and entry[0] is executable_dict:
+            _schemas.move_to_end(key)
+            return entry[1]
+
+    schema = CLISchema(executable_dict)
+    with _schemas_lock:
+        _schemas[key] = (executable_dict, schema)
+        _schemas.move_to_end(key)
+        while len(_schemas)>_max_schemas:
+            _schemas.popitem(last = False)
+
+    return schema
@@ -2,27 +2,157 @@
 """
 
 from typing_extensions import Union
-import requests
-from time import sleep
+import json
+from time import time, sleep
+from math import ceil
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-from .utils import get_unique_id
+from .job import status_from_code
+from .utils import get_unique_id, get_jobs_info, resolve_jobs, parse_girder_time, check_wildcard, item_wildcard_args, resolve_wildcard_args, prefetch_item_paths
+from .cache import WildcardCache
+from .schema import ValidationError
+from .transport import get_transport
+from .wait import get_waiter, IntervalWaiter
+from .logs import LogTailer
+from .readiness import ReadinessProbe
+from . import metrics
 
 class Sequence:
     """Base class of Sequence, containing multiple jobs
     """
     def __init__(self,
                  gc,
-                 jobs: list = []):
+                 jobs: list = [],
+                 job_slots = None,
+                 wildcard_cache = None,
+                 journal = None,
+                 result_cache = None,
+                 name = None):
         
         self.gc = gc
         self.jobs = jobs
         self.id = get_unique_id()
+        # Optional label, e.g. the "name" of a manifest record (see girder_job_sequence.manifest)
+        self.name = name
+        self.step_latency = []
+        # Optional semaphore-like object (acquire/release) shared between Sequences to cap in-flight DSA jobs
+        self.job_slots = job_slots
+        self.running = False
+        # Set by Sequence.stop, no more jobs are started once this is True
+        self.stopping = False
+        # WildcardCache shared between runs (and other Sequences), a new one is used for each run if this is None
+        self.wildcard_cache = wildcard_cache
+        # Optional RunJournal (see girder_job_sequence.journal) recording submissions and status changes
+        self.journal = journal
+        # {job index: status} of jobs recorded in a journal, set by Sequence.resume
+        self.resumed_states = {}
+        # Optional ResultCache (see girder_job_sequence.cache) for reusing previous successful jobs
+        self.result_cache = result_cache
+        # Background threads preparing jobs while earlier jobs run (pipeline = True in Sequence.start)
+        self._preparer = None
+        # {job index: Future of Job.prepare}
+        self._preparations = {}
+
+    @classmethod
+    def from_journal(cls, gc, journal, sequence_id: Union[str,None] = None):
+        """Rebuild a Sequence from the job specifications recorded in a journal, to be continued with Sequence.resume
+
+        :param gc: Girder client handler
+        :type gc: None
+        :param journal: Journal the sequence was run with
+        :type journal: RunJournal
+        :param sequence_id: Id of the sequence in the journal, defaults to the most recently started one
+        :type sequence_id: Union[str,None], optional
+        :raises LookupError: If the sequence is not in the journal
+        :return: Sequence with the same jobs and id
+        :rtype: Sequence
+        """
+        from .utils import from_dict
+
+        state = journal.state(sequence_id)
+        if state is None:
+            raise LookupError(f'Sequence not found in journal: {sequence_id or "(most recent)"}')
+
+        sequence = cls(gc, [from_dict(gc, j, lazy = True) for j in state['jobs']], journal = journal)
+        sequence.id = state['sequence_id']
+
+        return sequence
+
+    def resume(self, journal, sequence_id: Union[str,None] = None, **start_kwargs)->list:
+        """Continue a sequence that was interrupted (e.g. by the process restarting) using its journal.
+        Jobs that already succeeded are not run again, jobs that were queued or running on the server are
+        waited on instead of being submitted again, and jobs that failed, were canceled, or were never submitted are run.
+        The jobs of this sequence have to be the same (and in the same order) as the ones recorded in the journal.
+
+        :param journal: Journal the sequence was run with
+        :type journal: RunJournal
+        :param sequence_id: Id of the sequence in the journal, defaults to the most recently started one
+        :type sequence_id: Union[str,None], optional
+        :raises LookupError: If the sequence is not in the journal
+        :raises ValueError: If the jobs of this sequence are not the ones recorded in the journal
+        :return: Final state of each job, see Sequence.start
+        :rtype: list
+        """
+        state = journal.state(sequence_id)
+        if state is None:
+            raise LookupError(f'Sequence not found in journal: {sequence_id or "(most recent)"}')
+
+        # Jobs constructed from docker_image and cli only have a plugin_id once resolved
+        resolve_jobs(self.jobs)
+        journal_plugins = [j.get('plugin_id') for j in state['jobs']]
+        sequence_plugins = [j.plugin_id for j in self.jobs]
+        if not journal_plugins==sequence_plugins:
+            raise ValueError(f'Jobs do not match the journal, plugins in journal: {journal_plugins}, plugins in sequence: {sequence_plugins}')
+
+        self.id = state['sequence_id']
+        self.journal = journal
+        self.resumed_states = {}
+        for job_idx, job_id in state['job_ids'].items():
+            job_status = state['states'].get(job_idx)
+            if job_status in ['ERROR','CANCELED','SKIPPED']:
+                continue
+
+            self.jobs[job_idx].job_id = job_id
+            self.resumed_states[job_idx] = job_status
+
+        start_kwargs.setdefault('mode', state['mode'])
+
+        return self.start(**start_kwargs)
+
+    def validate(self, raise_error: bool = True)->list:
+        """Check the inputs of every job in the sequence against their plugin specifications
+
+        :param raise_error: Whether to raise a ValidationError listing every invalid input, defaults to True
+        :type raise_error: bool, optional
+        :return: List of error messages (empty if all jobs are valid)
+        :rtype: list
+        """
+        resolve_jobs(self.jobs)
+
+        errors = []
+        for job_idx, job in enumerate(self.jobs):
+            title = job.executable_dict["title"] if not job.executable_dict is None else job.plugin_id
+            errors.extend([f'Job {job_idx} ({title}) {e}' for e in job.validate()])
+
+        if raise_error and len(errors)>0:
+            raise ValidationError(errors)
+
+        return errors
+
+    def journal_record(self, event: str, **data):
+        if not self.journal is None:
+            self.journal.record(self.id, event, **data)
+
+    def job_index(self, job)->int:
+        for job_idx, j in enumerate(self.jobs):
+            if j is job:
+                return job_idx
 
     def get_logs(self, type = 'all'):
         
         assert type in ['all','running','finished']
         
-        current_job_statuses = self.get_status()
+        current_job_statuses = [i['Status'] for i in self.get_status()]
 
         logs_list = []
         if type=='all':
@@ -30,7 +160,7 @@ class Sequence:
                 if status not in ['INACTIVE','QUEUED']:
                     logs_list.append(
                         {
-                            'Job Name': j.executable_dict.title,
+                            'Job Name': j.executable_dict["title"],
                             'Logs': j.get_logs()
                         }
                     )
@@ -39,7 +169,7 @@ class Sequence:
                 if status=='RUNNING':
                     logs_list.append(
                         {
-                            'Job Name': j.executable_dict.title,
+                            'Job Name': j.executable_dict["title"],
                             'Logs': j.get_logs()
                         }
                     )
@@ -49,56 +179,130 @@ class Sequence:
                 if status in ['SUCCESS','ERROR','CANCELED']:
                     logs_list.append(
                         {
-                            'Job Name': j.executable_dict.title,
+                            'Job Name': j.executable_dict["title"],
                             'Logs': j.get_logs()
                         }
                     )
 
         return logs_list
 
-    def get_status(self)->list:
+    def tail_logs(self, poll_interval: float = 2, use_notifications: bool = True, stream_timeout: float = 2):
+        """Generator of {'Job Name': '', 'Job ID': '', 'Line': ''} for new log lines from all jobs in the sequence,
+        interleaved as they are written. Ends when every started job has finished and the sequence is no longer running.
+        Call this from a different thread than Sequence.start, it waits for the sequence to start.
+
+        :param poll_interval: Seconds between checks if the notification stream is unavailable, defaults to 2
+        :type poll_interval: float, optional
+        :param use_notifications: Whether to use the notification stream, defaults to True
+        :type use_notifications: bool, optional
+        :param stream_timeout: Seconds before reconnecting to the notification stream to pick up newly started jobs, defaults to 2
+        :type stream_timeout: float, optional
+        """
+        while not self.running and all([j.job_id is None for j in self.jobs]):
+            sleep(poll_interval)
+
+        tailer = LogTailer(
+            self.gc,
+            self.jobs,
+            poll_interval = poll_interval,
+            stream_timeout = stream_timeout,
+            use_notifications = use_notifications,
+            is_active = lambda: self.running
+        )
+        for job, line in tailer.tail():
+            yield {'Job Name': job.executable_dict["title"], 'Job ID': job.job_id, 'Line': line}
+
+    def get_status(self, bulk: bool = True)->list:
         """Get the statuses of all jobs in a sequence
 
+        :param bulk: Whether to get the statuses of all started jobs from a few /job listing requests instead of one request per job, defaults to True
+        :type bulk: bool, optional
         :return: List of {'Job Name': '', 'Status': ''} dictionaries
         :rtype: list
         """
+        started_jobs = [j for j in self.jobs if not j.job_id is None]
+        if not bulk or len(started_jobs)<2:
+            return [
+                {'Job Name': j.executable_dict["title"], 'Status': j.get_status()}
+                for j in self.jobs
+            ]
+
+        # Narrowing the listing to this sequence's job types and to jobs created after the first one was submitted
+        job_infos = [getattr(j, 'job_info', {}) for j in started_jobs]
+        types = [i['type'] for i in job_infos if 'type' in i]
+        created = [i['created'] for i in job_infos if 'created' in i]
+        jobs_info = get_jobs_info(
+            self.gc,
+            [j.job_id for j in started_jobs],
+            types = types if len(types)==len(started_jobs) else None,
+            since = min(created, key = parse_girder_time) if len(created)>0 else None
+        )
+
         status_list = []
         for j in self.jobs:
+            if j.job_id is None:
+                job_status = 'INACTIVE'
+            else:
+                job_status = status_from_code(jobs_info[j.job_id]['status'])
+
             status_list.append(
-                {'Job Name': j.executable_dict["title"], 'Status': j.get_status()}
+                {'Job Name': j.executable_dict["title"], 'Status': job_status}
             )
 
         return status_list
 
-    def cancel(self, type:str = 'all')->list:
-        """Cancel either all, running, queued, or inactive jobs in a sequence
+    def compare_status_bytes(self)->list:
+        """Measure the bytes downloaded per status check for each started job with and without downloading logs
+
+        :return: List of {'Job Name': '', 'Full': bytes, 'Light': bytes} dictionaries
+        :rtype: list
+        """
+        return [
+            dict({'Job Name': j.executable_dict["title"]}, **j.compare_status_bytes())
+            for j in self.jobs
+            if not j.job_id is None
+        ]
+
+    def cancel(self, type:str = 'all', max_workers: int = 8)->list:
+        """Cancel either all, running, queued, or inactive jobs in a sequence. Cancellations are sent concurrently.
 
         :param type: str, defaults to 'all'
         :type type: str, optional
+        :param max_workers: Number of cancel requests sent at the same time, defaults to 8
+        :type max_workers: int, optional
         :return: Either a list (if multiple jobs are canceled) or a single dictionary with the cancellation response
         :rtype: list
         """
 
         assert type in ['all','running','queued','inactive']
         
-        cancel_responses = []
-        current_job_statuses = self.get_status()
+        current_job_statuses = [i['Status'] for i in self.get_status()]
         if type =='all':
-            for j,status in zip(self.jobs,current_job_statuses):
-                if not status in ['SUCCESS','ERROR','CANCELED']:
-                    cancel_responses.append(j.cancel())
-        
+            to_cancel = [j for j,status in zip(self.jobs,current_job_statuses) if not status in ['SUCCESS','ERROR','CANCELED']]
         else:
-            for j,status in zip(self.jobs,current_job_statuses):
-                if status==type.upper():
-                    cancel_responses.append(j.cancel())
+            to_cancel = [j for j,status in zip(self.jobs,current_job_statuses) if status==type.upper()]
+
+        if len(to_cancel)<2:
+            return [j.cancel() for j in to_cancel]
+
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            cancel_responses = list(executor.map(metrics.propagate_context(lambda j: j.cancel()), to_cancel))
 
         return cancel_responses
 
+    def stop(self)->list:
+        """Stop a running sequence from another thread: no more jobs are started and the submitted ones are canceled
+
+        :return: Cancellation responses, see Sequence.cancel
+        :rtype: list
+        """
+        self.stopping = True
+        return self.cancel()
+
     def add_sequence_metadata(self, job, job_idx):
 
         # This might not actually be possible to add
-        put_response = self.gc.put(
+        put_response = get_transport(self.gc).put(
             f'/job/{job.job_id}/metadata',
             data = {
                 'part_of': self.id,
@@ -109,7 +313,302 @@ class Sequence:
 
         return put_response
 
-    def start(self, check_interval:int = 5, cancel_on_error:bool = True,verbose:bool = False):
+    def wait_for_job(self, job, waiter, check_interval: float = 5, verbose: bool = False)->str:
+        """Wait for a started job to finish and record how long after submission it was detected as finished
+
+        :param job: Job that has been started
+        :type job: Job
+        :param waiter: One of the waiters in girder_job_sequence.wait
+        :type waiter: None
+        :param check_interval: Fixed polling interval used to estimate the latency saved by other wait strategies, defaults to 5
+        :type check_interval: float, optional
+        :param verbose: Whether to print current job and status at each check
+        :type verbose: bool, optional
+        :return: Last status of the job
+        :rtype: str
+        """
+        submitted = time()
+        job_idx = self.job_index(job)
+        last_status = [None]
+
+        def on_status(current_status):
+            if not current_status==last_status[0]:
+                last_status[0] = current_status
+                self.journal_record('job_status', job_index = job_idx, job_id = job.job_id, status = current_status)
+
+            if verbose:
+                print('-------------------------')
+                print(f'On {job.executable_dict["title"]}, Status: {current_status}')
+                print('-------------------------')
+
+        with metrics.timed('wait'):
+            current_status = waiter.wait(job, on_status = on_status)
+        if not current_status==last_status[0]:
+            self.journal_record('job_status', job_index = job_idx, job_id = job.job_id, status = current_status)
+
+        # Fixed-interval polling would only notice the job finishing at the next multiple of check_interval
+        detected_after = time() - submitted
+        if isinstance(waiter, IntervalWaiter):
+            fixed_interval_after = detected_after
+        else:
+            fixed_interval_after = ceil(detected_after / check_interval) * check_interval
+        self.step_latency.append({
+            'Job Name': job.executable_dict["title"],
+            'Job ID': job.job_id,
+            'Status': current_status,
+            'Detected After': detected_after,
+            'Fixed Interval Detection': fixed_interval_after,
+            'Latency Saved': max(fixed_interval_after - detected_after, 0)
+        })
+
+        if verbose:
+            print(f'{job.executable_dict["title"]} finished after {round(detected_after,2)}s, '
+                  f'{round(self.step_latency[-1]["Latency Saved"],2)}s earlier than polling every {check_interval}s')
+
+        return current_status
+
+    def run_job(self, job, waiter, check_interval: float = 5, verbose: bool = False):
+        """Start a job and wait for it to finish, holding one of the shared job slots (if any) while it is in flight
+
+        :param job: Job to start
+        :type job: Job
+        :param waiter: One of the waiters in girder_job_sequence.wait
+        :type waiter: None
+        :param check_interval: How many seconds to go between status checks, defaults to 5
+        :type check_interval: float, optional
+        :param verbose: Whether to print current job and status at each check
+        :type verbose: bool, optional
+        :return: Response to the start request and the last status of the job (ERROR if it could not be submitted)
+        :rtype: tuple
+        """
+        if not self.job_slots is None:
+            self.job_slots.acquire()
+
+        try:
+            job_idx = self.job_index(job)
+            job_request = None
+            if job_idx in self.resumed_states and not job.job_id is None:
+                # Reattaching to a job submitted before the sequence was interrupted
+                job_request = get_transport(self.gc).request('GET', f'/job/{job.job_id}')
+                if job_request.status_code==200:
+                    job.job_info = job_request.json()
+                else:
+                    print(f'Could not find job {job.job_id} from the journal, submitting it again')
+                    job.job_id = None
+                    job_request = None
+
+            if job_request is None:
+                preparation = self._preparations.get(job_idx)
+                if not preparation is None:
+                    # Anything that failed while preparing is done again (raising the error) by Job.start
+                    wait([preparation])
+                job_request = job.start()
+                if not job_request.status_code==200:
+                    print('Error submitting job request')
+                    print(f'Status Code: {job_request.status_code}')
+                    print(job_request.content)
+
+                    self.journal_record('job_status', job_index = job_idx, job_id = None, status = 'ERROR')
+                    return job_request, 'ERROR'
+
+                self.journal_record('job_submitted', job_index = job_idx, job_id = job.job_id)
+
+            #self.add_sequence_metadata(job,job_idx)
+            current_status = self.wait_for_job(job, waiter, check_interval, verbose)
+            if not job.wildcard_cache is None:
+                # Outputs of this job may have been added to items that were already indexed
+                job.wildcard_cache.mark_stale()
+        finally:
+            if not self.job_slots is None:
+                self.job_slots.release()
+
+        return job_request, current_status
+
+    def prefetch_wildcards(self, cache: WildcardCache, max_workers: int = 8):
+        """Look up the items and folders referenced by wildcard inputs of every job in the sequence at once.
+        Files and annotations are looked up when their job starts since they may be created by earlier jobs.
+        Lookups that fail here (e.g. for items that do not exist yet) are tried again when the job starts.
+
+        :param cache: WildcardCache used by the jobs in this run
+        :type cache: WildcardCache
+        :param max_workers: Number of concurrent lookups, defaults to 8
+        :type max_workers: int, optional
+        """
+        to_resolve = {}
+        for job in self.jobs:
+            if job.input_args is None:
+                continue
+            for i in job.input_args:
+                if type(i['value'])==str and check_wildcard(i['value']):
+                    try:
+                        wildcard_args = json.loads(i['value'][1:-1].replace("'",'"'))
+                    except ValueError:
+                        continue
+
+                    if not wildcard_args.get('type') in ['item','folder']:
+                        wildcard_args = item_wildcard_args(wildcard_args)
+                    if not wildcard_args is None:
+                        to_resolve[cache.normalize(wildcard_args)] = wildcard_args
+
+        if len(to_resolve)>1:
+            # Sibling items are found by listing their folder once
+            try:
+                prefetch_item_paths(self.gc, list(to_resolve.values()), cache)
+            except Exception:
+                pass
+
+        def resolve(wildcard_args):
+            try:
+                cache.get_or_resolve(self.gc, wildcard_args, lambda: resolve_wildcard_args(self.gc, wildcard_args))
+            except Exception:
+                pass
+
+        if len(to_resolve)>0:
+            with ThreadPoolExecutor(max_workers = min(max_workers, len(to_resolve))) as executor:
+                list(executor.map(metrics.propagate_context(resolve), to_resolve.values()))
+
+    def prepare_job(self, job_idx: int):
+        """Start preparing a job (see Job.prepare) on a background thread, if the sequence is running with pipeline = True
+
+        :param job_idx: Index of the job
+        :type job_idx: int
+        :return: Future of the preparation, or None if it is not prepared in the background
+        :rtype: Union[Future,None]
+        """
+        if self._preparer is None or job_idx>=len(self.jobs) or self.resumed_states.get(job_idx)=='SUCCESS':
+            return None
+
+        if not job_idx in self._preparations:
+            self._preparations[job_idx] = self._preparer.submit(metrics.propagate_context(self.jobs[job_idx].prepare))
+
+        return self._preparations[job_idx]
+
+    def get_dependencies(self)->list:
+        """Find the indices of the jobs that each job depends on. Jobs refer to their dependencies
+        by name (Job.name) or by index in the sequence.
+
+        :return: List containing a list of dependency indices for each job
+        :rtype: list
+        """
+        job_names = {}
+        for job_idx, job in enumerate(self.jobs):
+            if not job.name is None:
+                assert not job.name in job_names, f'Job name: {job.name} is used more than once'
+                job_names[job.name] = job_idx
+
+        dependencies = []
+        for job_idx, job in enumerate(self.jobs):
+            job_deps = []
+            for d in (job.depends_on or []):
+                if isinstance(d, int):
+                    assert 0<=d<len(self.jobs), f'Dependency index: {d} is out of range'
+                    job_deps.append(d)
+                else:
+                    assert d in job_names, f'Dependency: {d} is not the name of a job in this sequence'
+                    job_deps.append(job_names[d])
+
+            assert not job_idx in job_deps, f'Job: {job_idx} depends on itself'
+            dependencies.append(job_deps)
+
+        # Checking for cycles (Kahn's algorithm)
+        n_deps = [len(set(d)) for d in dependencies]
+        ready = [i for i,n in enumerate(n_deps) if n==0]
+        n_visited = 0
+        while len(ready)>0:
+            job_idx = ready.pop()
+            n_visited += 1
+            for other_idx, other_deps in enumerate(dependencies):
+                if job_idx in other_deps:
+                    n_deps[other_idx] -= 1
+                    if n_deps[other_idx]==0:
+                        ready.append(other_idx)
+
+        assert n_visited==len(self.jobs), 'Job dependencies contain a cycle'
+
+        return dependencies
+
+    def run_dag(self, max_concurrent: int = 4, check_interval: int = 5, cancel_on_error: bool = True, verbose: bool = False, wait_strategy: str = 'poll')->list:
+        """Run jobs as a dependency graph, starting every job whose dependencies have succeeded (up to max_concurrent at a time).
+
+        :param max_concurrent: Maximum number of jobs submitted and running at the same time, defaults to 4
+        :type max_concurrent: int, optional
+        :param check_interval: How many seconds to go between status checks, defaults to 5
+        :type check_interval: int, optional
+        :param cancel_on_error: Whether to skip the jobs downstream of a failed job, defaults to True
+        :type cancel_on_error: bool, optional
+        :param verbose: Whether to print current job and status at each check
+        :type verbose: bool, optional
+        :param wait_strategy: How to wait for each job to finish, see Sequence.start, defaults to 'poll'
+        :type wait_strategy: str, optional
+        :return: Final state of each job, one of SUCCESS, ERROR, CANCELED, or SKIPPED (if an upstream job failed)
+        :rtype: list
+        """
+        assert max_concurrent>0 and check_interval>0
+        dependencies = self.get_dependencies()
+        # Jobs that succeeded before the sequence was resumed are not run again
+        job_states = ['SUCCESS' if self.resumed_states.get(i)=='SUCCESS' else 'PENDING' for i in range(len(self.jobs))]
+        # Downstream jobs still run after an upstream error if errors are not canceling
+        ready_states = ['SUCCESS'] if cancel_on_error else ['SUCCESS','ERROR','CANCELED']
+        self.step_latency = []
+
+        def run_node(job_idx):
+            # Waiters keep per-stream state so each thread gets its own
+            waiter = get_waiter(self.gc, wait_strategy, check_interval)
+            _, current_status = self.run_job(self.jobs[job_idx], waiter, check_interval, verbose)
+
+            return current_status
+
+        def skip_downstream(job_idx):
+            for other_idx, other_deps in enumerate(dependencies):
+                if job_idx in other_deps and job_states[other_idx]=='PENDING':
+                    job_states[other_idx] = 'SKIPPED'
+                    self.journal_record('job_status', job_index = other_idx, job_id = None, status = 'SKIPPED')
+                    if verbose:
+                        print(f'Skipping job: {other_idx}, {self.jobs[other_idx].executable_dict["title"]}')
+                    skip_downstream(other_idx)
+
+        # Jobs waiting on others are prepared while those run
+        for job_idx, job_deps in enumerate(dependencies):
+            if len(job_deps)>0:
+                self.prepare_job(job_idx)
+
+        running = {}
+        with ThreadPoolExecutor(max_workers = max_concurrent) as executor:
+            while True:
+                for job_idx, job_deps in enumerate(dependencies):
+                    if len(running)>=max_concurrent:
+                        break
+                    if self.stopping:
+                        break
+                    if job_states[job_idx]=='PENDING' and all([job_states[d] in ready_states for d in job_deps]):
+                        job_states[job_idx] = 'RUNNING'
+                        running[executor.submit(metrics.propagate_context(run_node), job_idx)] = job_idx
+
+                if len(running)==0:
+                    break
+
+                finished, _ = wait(list(running.keys()), return_when = FIRST_COMPLETED)
+                for future in finished:
+                    job_idx = running.pop(future)
+                    try:
+                        current_status = future.result()
+                    except Exception as e:
+                        print(f'Job: {job_idx} failed with: {e}')
+                        current_status = 'ERROR'
+
+                    job_states[job_idx] = current_status
+                    if current_status in ['ERROR','CANCELED']:
+                        if verbose:
+                            print('XXXXXXXXXXXXXXXXXXXXXXXXXXXX')
+                            print(f'{current_status} encountered on job: {self.jobs[job_idx].job_id}, {self.jobs[job_idx].executable_dict["title"]}')
+                            print('XXXXXXXXXXXXXXXXXXXXXXXXXXXX')
+
+                        if cancel_on_error:
+                            skip_downstream(job_idx)
+
+        return job_states
+
+    def start(self, check_interval:int = 5, cancel_on_error:bool = True,verbose:bool = False, wait_strategy: str = 'poll', mode: str = 'linear', max_concurrent: int = 4, prefetch_wildcards: bool = True, validate: bool = True, wildcard_timeout: float = 300, probe_wildcards: bool = False, pipeline: bool = True):
         """Start the job sequence, checking the status of running jobs every "check_interval" seconds
 
         :param check_interval: How many seconds to go between status checks, defaults to 5
@@ -118,52 +617,178 @@ class Sequence:
         :type cancel_on_error: bool, optional
         :param verbose: Whether to print current job and status at each check
         :type verbose: bool, optional
+        :param wait_strategy: How to wait for each job to finish, "poll" (every check_interval seconds), "backoff" (exponential backoff up to check_interval),
+            "notification" (Girder notification stream, falling back to "backoff"), "shared" (one poller for every job of this Girder client, see wait.SharedPoller),
+            or a waiter object, defaults to 'poll'
+        :type wait_strategy: str, optional
+        :param mode: "linear" to run jobs one after another in order or "dag" to run jobs as soon as the jobs in their "depends_on" have succeeded, defaults to 'linear'
+        :type mode: str, optional
+        :param max_concurrent: Maximum number of jobs running at the same time in "dag" mode, defaults to 4
+        :type max_concurrent: int, optional
+        :param prefetch_wildcards: Whether to look up the items and folders used in wildcard inputs of all jobs concurrently before the first job starts, defaults to True
+        :type prefetch_wildcards: bool, optional
+        :param validate: Whether to check the inputs of every job before the first job is submitted, raising a ValidationError if any are invalid, defaults to True
+        :type validate: bool, optional
+        :param wildcard_timeout: Seconds to keep checking for the targets of file and annotation wildcards that do not exist yet when a job starts, since they may be
+            outputs of earlier jobs. Only used for jobs after the first ("linear" mode) or with "depends_on" ("dag" mode), other wildcards fail right away, defaults to 300
+        :type wildcard_timeout: float, optional
+        :param probe_wildcards: Whether to check for the next job's file and annotation wildcard targets on a background thread as soon as the current job
+            succeeds ("linear" mode) instead of when the next job starts, defaults to False
+        :type probe_wildcards: bool, optional
+        :param pipeline: Whether to prepare jobs (see Job.prepare) and prefetch wildcards in the background while earlier jobs run, instead of before the first job starts.
+            Plugin specifications are still fetched up front when validating or recording to a journal, defaults to True
+        :type pipeline: bool, optional
+        :return: Final state of each job, SUCCESS, ERROR, CANCELED, INACTIVE (not started), or SKIPPED ("dag" mode)
+        :rtype: list
         """
 
         assert check_interval>0
+        assert mode in ['linear','dag']
+
+        # Plugin specifications of lazily constructed jobs are fetched concurrently
+        if validate or not pipeline or not self.journal is None:
+            resolve_jobs(self.jobs)
+        if validate:
+            self.validate()
+
+        # Wildcards are looked up once per run and shared by every job
+        wildcard_cache = self.wildcard_cache if not self.wildcard_cache is None else WildcardCache()
+        for job_idx, job in enumerate(self.jobs):
+            job.wildcard_cache = wildcard_cache
+            # Only jobs after another one can be waiting on its outputs
+            has_upstream = len(job.depends_on or [])>0 if mode=='dag' else job_idx>0
+            job.wildcard_timeout = wildcard_timeout if has_upstream else 0
+            if not self.result_cache is None:
+                job.result_cache = self.result_cache
+
+        self.journal_record(
+            'sequence_started',
+            mode = mode,
+            jobs = [
+                {
+                    'plugin_id': j.plugin_id,
+                    'name': j.name,
+                    'input_args': j.input_args,
+                    'depends_on': j.depends_on
+                }
+                for j in self.jobs
+            ]
+        )
+
+        # Read by Sequence.tail_logs to know when no more jobs will be started
+        self.running = True
+        if pipeline:
+            self._preparer = ThreadPoolExecutor(max_workers = 2)
+            self._preparations = {}
+        try:
+            # Requests made while running are tagged with this sequence's id (see girder_job_sequence.metrics)
+            with metrics.tags(sequence_id = self.id):
+                def prefetch():
+                    with metrics.timed('prefetch_wildcards'):
+                        self.prefetch_wildcards(wildcard_cache)
+
+                if prefetch_wildcards and pipeline:
+                    # Jobs waiting on a wildcard being prefetched share the lookup through the cache
+                    self._preparer.submit(metrics.propagate_context(prefetch))
+                elif prefetch_wildcards:
+                    prefetch()
+
+                if mode=='dag':
+                    job_states = self.run_dag(max_concurrent, check_interval, cancel_on_error, verbose, wait_strategy)
+                else:
+                    job_states = self.run_linear(check_interval, cancel_on_error, verbose, wait_strategy, probe_wildcards)
+        finally:
+            self.running = False
+            self.resumed_states = {}
+            if not self._preparer is None:
+                self._preparer.shutdown(wait = False, cancel_futures = True)
+                self._preparer = None
+                self._preparations = {}
+
+        self.journal_record('sequence_finished', states = job_states)
+
+        return job_states
+
+    def start_readiness_probe(self, job_idx: int)->Union[ReadinessProbe,None]:
+        """Start a probe for the file and annotation wildcard targets of the job after job_idx, which checks for them once that job succeeds
+
+        :param job_idx: Index of the upstream job
+        :type job_idx: int
+        :return: Probe (also set as the next job's readiness_probe) or None if the next job has no file or annotation wildcard inputs
+        :rtype: Union[ReadinessProbe,None]
+        """
+        if job_idx+1>=len(self.jobs) or self.resumed_states.get(job_idx+1)=='SUCCESS':
+            return None
+
+        next_job = self.jobs[job_idx+1]
+        wildcard_strs = next_job.dependent_wildcards()
+        if len(wildcard_strs)==0 or next_job.wildcard_timeout<=0:
+            return None
+
+        next_job.readiness_probe = ReadinessProbe(
+            self.gc,
+            wildcard_strs,
+            cache = next_job.wildcard_cache,
+            timeout = next_job.wildcard_timeout
+        ).start()
+
+        return next_job.readiness_probe
+
+    def run_linear(self, check_interval: int = 5, cancel_on_error: bool = True, verbose: bool = False, wait_strategy: str = 'poll', probe_wildcards: bool = False)->list:
+        """Run jobs one after another in order, see Sequence.start
+        """
+
         send_new_job = True
+        waiter = get_waiter(self.gc, wait_strategy, check_interval)
+        job_states = ['INACTIVE']*len(self.jobs)
+        self.step_latency = []
 
         for job_idx, job in enumerate(self.jobs):
 
-            if not send_new_job:
+            if not send_new_job or self.stopping:
                 break
 
-            job_request = job.start()
+            if self.resumed_states.get(job_idx)=='SUCCESS':
+                job_states[job_idx] = 'SUCCESS'
+                continue
+
+            self.prepare_job(job_idx+1)
+            probe = self.start_readiness_probe(job_idx) if probe_wildcards else None
+            current_status = 'ERROR'
+            try:
+                job_request, current_status = self.run_job(job, waiter, check_interval, verbose)
+            finally:
+                job.readiness_probe = None
+                if not probe is None:
+                    if current_status=='SUCCESS':
+                        probe.upstream_finished()
+                    else:
+                        # The next job (if it still runs) looks its wildcards up when it starts
+                        probe.stop()
+                        self.jobs[job_idx+1].readiness_probe = None
+            job_states[job_idx] = current_status
             if job_request.status_code==200:
                 #job_info = job_request.json()
-                current_status = job.get_status()
-                #self.add_sequence_metadata(job,job_idx)
-                while not current_status in ['SUCCESS','ERROR','CANCELED']:
-                    sleep(check_interval)
-                    current_status = job.get_status()
 
+                if current_status in ['ERROR','CANCELED']:
+                    
                     if verbose:
-                        print('-------------------------')
-                        print(f'On {job.executable_dict["title"]}, Status: {current_status}')
-                        print('-------------------------')
+                        print('XXXXXXXXXXXXXXXXXXXXXXXXXXXX')
+                        print(f'{current_status} encountered on job: {job.job_id}, {job.executable_dict["title"]}')
+                        print('XXXXXXXXXXXXXXXXXXXXXXXXXXXX')
 
-                    if current_status in ['ERROR','CANCELED']:
-                        
+                    if cancel_on_error:
                         if verbose:
-                            print('XXXXXXXXXXXXXXXXXXXXXXXXXXXX')
-                            print(f'{current_status} encountered on job: {job.job_id}, {job.executable_dict["title"]}')
-                            print('XXXXXXXXXXXXXXXXXXXXXXXXXXXX')
+                            print('Canceling remaining jobs in sequence')
 
-                        if cancel_on_error:
-                            if verbose:
-                                print('Canceling remaining jobs in sequence')
-
-                            self.cancel()
-                            send_new_job = False
-                            break
+                        self.cancel()
+                        send_new_job = False
             else:
 
-                print('Error submitting job request')
-                print(f'Status Code: {job_request.status_code}')
-                print(job_request.content)
-
                 if cancel_on_error:
                     self.cancel()
                     send_new_job = False
                     break
 
+        return job_states
+
@@ -0,0 +1,413 @@
+"""Long-running supervisor running sequences from a durable local queue (SQLite)
+
+Sequences submitted to the queue (from any number of processes) are run by one supervisor process, which shares
+job slots, the wildcard cache, and one status poller (see wait.SharedPoller) between all of them. Sequences that
+were running when the supervisor stopped are resumed from their journal (stored in the same database) when it restarts.
+
+    girder-job-sequence serve --queue sequences.db --api-url https://dsa.example.com/api/v1
+    girder-job-sequence submit --queue sequences.db manifest.jsonl
+    girder-job-sequence status --queue sequences.db
+    girder-job-sequence cancel --queue sequences.db <sequence id>
+
+The API key or token used by "serve" is read from --api-key/--token or the GIRDER_API_KEY/GIRDER_TOKEN environment variables.
+"""
+
+import os
+import sys
+import json
+import signal
+import sqlite3
+import argparse
+import threading
+from time import time
+from typing_extensions import Union
+
+from .sequence import Sequence
+from .cache import WildcardCache
+from .journal import SQLiteJournal
+from .manifest import iter_manifest
+from .utils import get_unique_id, from_dict
+
+
+QUEUE_STATES = ['queued','running','succeeded','failed','canceled']
+FINAL_QUEUE_STATES = ['succeeded','failed','canceled']
+
+
+class SequenceQueue:
+    """Sequence definitions waiting to run (or running, or finished) stored in an SQLite database.
+    Every method is safe to call from several threads and processes at once.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=FULL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS sequences '
+            '(id TEXT PRIMARY KEY, name TEXT, jobs TEXT, start_kwargs TEXT, priority INTEGER, state TEXT, '
+            'submitted REAL, started REAL, finished REAL, job_states TEXT, error TEXT, cancel_requested INTEGER DEFAULT 0)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS sequences_state ON sequences (state, priority, submitted)')
+        self.connection.commit()
+
+    @staticmethod
+    def to_dict(row)->dict:
+        keys = ['id','name','jobs','start_kwargs','priority','state','submitted','started','finished','job_states','error','cancel_requested']
+        record = dict(zip(keys, row))
+        for key in ['jobs','start_kwargs','job_states']:
+            record[key] = json.loads(record[key]) if not record[key] is None else None
+        record['cancel_requested'] = bool(record['cancel_requested'])
+
+        return record
+
+    def submit(self, jobs: list, name: Union[str,None] = None, start_kwargs: Union[dict,None] = None, priority: int = 0)->str:
+        """Add a sequence to the queue
+
+        :param jobs: Job dictionaries (see utils.from_dict)
+        :type jobs: list
+        :param name: Optional label for the sequence, defaults to None
+        :type name: Union[str,None], optional
+        :param start_kwargs: Arguments for Sequence.start, added to the supervisor's defaults, defaults to None
+        :type start_kwargs: Union[dict,None], optional
+        :param priority: Sequences with lower values are started first, defaults to 0
+        :type priority: int, optional
+        :return: Id of the sequence (also its Sequence.id and journal id)
+        :rtype: str
+        """
+        sequence_id = get_unique_id()
+        with self._lock, self.connection:
+            self.connection.execute(
+                'INSERT INTO sequences (id, name, jobs, start_kwargs, priority, state, submitted) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (sequence_id, name, json.dumps(jobs), json.dumps(start_kwargs or {}), priority, 'queued', time())
+            )
+
+        return sequence_id
+
+    def claim(self)->Union[dict,None]:
+        """Mark the next queued sequence (lowest priority value, then oldest) as running and return it, or None if none are queued
+        """
+        with self._lock:
+            # Taking the write lock before reading so two supervisors cannot claim the same sequence
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.connection.execute(
+                    "SELECT * FROM sequences WHERE state = 'queued' ORDER BY priority, submitted LIMIT 1"
+                ).fetchone()
+                if not row is None:
+                    self.connection.execute("UPDATE sequences SET state = 'running', started = ? WHERE id = ?", (time(), row[0]))
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+        if row is None:
+            return None
+
+        return dict(self.to_dict(row), state = 'running')
+
+    def finish(self, sequence_id: str, state: str, job_states: Union[list,None] = None, error: Union[str,None] = None):
+        assert state in FINAL_QUEUE_STATES
+        with self._lock, self.connection:
+            self.connection.execute(
+                'UPDATE sequences SET state = ?, finished = ?, job_states = ?, error = ? WHERE id = ?',
+                (state, time(), json.dumps(job_states) if not job_states is None else None, error, sequence_id)
+            )
+
+    def request_cancel(self, sequence_id: str)->bool:
+        """Cancel a sequence. Queued sequences are canceled right away and running ones by the supervisor on its next check.
+
+        :return: False if the sequence is not in the queue or already finished
+        :rtype: bool
+        """
+        with self._lock, self.connection:
+            cursor = self.connection.execute(
+                "UPDATE sequences SET state = 'canceled', finished = ? WHERE id = ? AND state = 'queued'",
+                (time(), sequence_id)
+            )
+            if cursor.rowcount>0:
+                return True
+
+            cursor = self.connection.execute(
+                "UPDATE sequences SET cancel_requested = 1 WHERE id = ? AND state = 'running'",
+                (sequence_id,)
+            )
+            return cursor.rowcount>0
+
+    def cancel_requested(self)->list:
+        """Ids of running sequences waiting to be canceled
+        """
+        with self._lock:
+            rows = self.connection.execute("SELECT id FROM sequences WHERE state = 'running' AND cancel_requested = 1").fetchall()
+
+        return [r[0] for r in rows]
+
+    def get(self, sequence_id: str)->Union[dict,None]:
+        with self._lock:
+            row = self.connection.execute('SELECT * FROM sequences WHERE id = ?', (sequence_id,)).fetchone()
+
+        return self.to_dict(row) if not row is None else None
+
+    def list(self, state: Union[str,None] = None, limit: int = 100)->list:
+        """Most recently submitted sequences, optionally only the ones in one state
+        """
+        with self._lock:
+            if state is None:
+                rows = self.connection.execute('SELECT * FROM sequences ORDER BY submitted DESC LIMIT ?', (limit,)).fetchall()
+            else:
+                rows = self.connection.execute('SELECT * FROM sequences WHERE state = ? ORDER BY submitted DESC LIMIT ?', (state, limit)).fetchall()
+
+        return [self.to_dict(r) for r in rows]
+
+    def counts(self)->dict:
+        with self._lock:
+            rows = self.connection.execute('SELECT state, COUNT(*) FROM sequences GROUP BY state').fetchall()
+
+        return dict({s: 0 for s in QUEUE_STATES}, **dict(rows))
+
+    def close(self):
+        self.connection.close()
+
+
+class Supervisor:
+    """Runs sequences from a SequenceQueue, up to "max_sequences" at a time and "max_jobs_in_flight" DSA jobs at a time.
+
+    All sequences share one WildcardCache and wait for their jobs through one SharedPoller ("shared" wait strategy),
+    so the number of status requests does not grow with the number of active sequences. Each sequence is recorded in
+    an SQLiteJournal in the queue's database, and sequences left running by a previous supervisor are resumed from it.
+    Only one supervisor should use a queue at a time.
+    """
+    def __init__(self,
+                 gc,
+                 queue: Union[SequenceQueue,str],
+                 max_sequences: int = 8,
+                 max_jobs_in_flight: int = 8,
+                 poll_interval: float = 1,
+                 check_interval: float = 5,
+                 start_kwargs: Union[dict,None] = None,
+                 job_slots = None
+                 ):
+
+        assert max_sequences>0 and max_jobs_in_flight>0 and poll_interval>0
+
+        self.gc = gc
+        self.queue = queue if isinstance(queue, SequenceQueue) else SequenceQueue(queue)
+        self.journal = SQLiteJournal(self.queue.path)
+        self.max_sequences = max_sequences
+        self.poll_interval = poll_interval
+        # Defaults for every sequence, updated with the "start_kwargs" each sequence was submitted with
+        self.start_kwargs = dict({'wait_strategy': 'shared', 'check_interval': check_interval}, **(start_kwargs or {}))
+
+        # Or slots from a PriorityScheduler shared with other processes' sequences
+        self.job_slots = job_slots if not job_slots is None else threading.BoundedSemaphore(max_jobs_in_flight)
+        self.wildcard_cache = WildcardCache()
+
+        self._lock = threading.Lock()
+        # {sequence id: Sequence} of sequences being run
+        self.active = {}
+        # {sequence id: Thread}
+        self.threads = {}
+        self._stop_event = threading.Event()
+
+    def run_sequence(self, record: dict, resume: bool = False):
+        """Run (or resume) one claimed sequence and record how it finished in the queue
+        """
+        sequence_id = record['id']
+        sequence = None
+        try:
+            start_kwargs = dict(self.start_kwargs, **(record['start_kwargs'] or {}))
+            resumable = resume and not self.journal.state(sequence_id) is None
+            if resumable:
+                sequence = Sequence.from_journal(self.gc, self.journal, sequence_id)
+            else:
+                sequence = Sequence(self.gc, [from_dict(self.gc, j, lazy = True) for j in record['jobs']], journal = self.journal)
+                sequence.id = sequence_id
+
+            sequence.name = record['name']
+            sequence.job_slots = self.job_slots
+            sequence.wildcard_cache = self.wildcard_cache
+            with self._lock:
+                self.active[sequence_id] = sequence
+
+            if record['cancel_requested']:
+                sequence.stopping = True
+                job_states = []
+            elif resumable:
+                job_states = sequence.resume(self.journal, sequence_id, **start_kwargs)
+            else:
+                job_states = sequence.start(**start_kwargs)
+
+            if sequence.stopping:
+                state = 'canceled'
+            else:
+                state = 'succeeded' if len(job_states)>0 and all([s=='SUCCESS' for s in job_states]) else 'failed'
+            self.queue.finish(sequence_id, state, job_states = job_states)
+
+        except Exception as e:
+            state = 'canceled' if not sequence is None and sequence.stopping else 'failed'
+            self.queue.finish(sequence_id, state, error = f'{type(e).__name__}: {e}')
+
+        finally:
+            with self._lock:
+                self.active.pop(sequence_id, None)
+                self.threads.pop(sequence_id, None)
+
+    def start_sequence(self, record: dict, resume: bool = False):
+        # Daemon threads so that stopping the supervisor does not wait for running sequences, which are resumed on restart
+        thread = threading.Thread(target = self.run_sequence, args = (record, resume), daemon = True)
+        with self._lock:
+            self.threads[record['id']] = thread
+        thread.start()
+
+    def check_cancellations(self):
+        for sequence_id in self.queue.cancel_requested():
+            with self._lock:
+                sequence = self.active.get(sequence_id)
+            if not sequence is None and not sequence.stopping:
+                try:
+                    sequence.stop()
+                except Exception as e:
+                    print(f'Unable to cancel sequence {sequence_id}: {e}')
+
+    def run(self):
+        """Run queued sequences until Supervisor.stop is called (e.g. from a signal handler)
+        """
+        self._stop_event.clear()
+        # Sequences left running by a previous supervisor, resumed (oldest first) before new ones are claimed
+        to_resume = [r for r in reversed(self.queue.list(state = 'running', limit = -1)) if not r['id'] in self.threads]
+
+        while not self._stop_event.is_set():
+            while len(self.threads)<self.max_sequences:
+                if len(to_resume)>0:
+                    # Read again in case it was canceled while waiting
+                    record = self.queue.get(to_resume.pop(0)['id'])
+                    if not record is None and record['state']=='running':
+                        self.start_sequence(record, resume = True)
+                    continue
+
+                record = self.queue.claim()
+                if record is None:
+                    break
+                self.start_sequence(record)
+
+            self.check_cancellations()
+            self._stop_event.wait(self.poll_interval)
+
+    def stop(self):
+        """Stop starting new sequences. Running sequences are left as "running" in the queue and resumed by the next supervisor.
+        """
+        self._stop_event.set()
+
+    def status(self)->dict:
+        """Number of sequences in each state and the ids of the ones being run by this supervisor
+        """
+        with self._lock:
+            active = list(self.active.keys())
+
+        return {
+            'Counts': self.queue.counts(),
+            'Active': active
+        }
+
+
+def connect(api_url: str, api_key: Union[str,None] = None, token: Union[str,None] = None):
+    """Girder client for the DSA instance at "api_url", authenticated with an API key or token if given
+    """
+    import girder_client
+
+    gc = girder_client.GirderClient(apiUrl = api_url)
+    if not api_key is None:
+        gc.authenticate(apiKey = api_key)
+    elif not token is None:
+        gc.setToken(token)
+
+    return gc
+
+def sequence_status(queue: SequenceQueue, journal: SQLiteJournal, record: dict)->dict:
+    """Queue record of a sequence without its job definitions, with the latest job states from the journal while it runs
+    """
+    status = {k: v for k,v in record.items() if not k in ['jobs','start_kwargs']}
+    if record['state']=='running':
+        state = journal.state(record['id'])
+        if not state is None:
+            status['job_states'] = [state['states'].get(i, 'INACTIVE') for i in range(len(state['jobs']))]
+            status['job_ids'] = [state['job_ids'].get(i) for i in range(len(state['jobs']))]
+
+    return status
+
+def main(argv: Union[list,None] = None)->int:
+    """Console entry point, see the module docstring
+    """
+    parser = argparse.ArgumentParser(prog = 'girder-job-sequence', description = 'Run job sequences from a local queue')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    serve_parser = subparsers.add_parser('serve', help = 'Run queued sequences until interrupted')
+    serve_parser.add_argument('--queue', required = True, help = 'Path to the SQLite queue')
+    serve_parser.add_argument('--api-url', required = True, help = 'Girder API URL, e.g. https://dsa.example.com/api/v1')
+    serve_parser.add_argument('--api-key', default = os.environ.get('GIRDER_API_KEY'))
+    serve_parser.add_argument('--token', default = os.environ.get('GIRDER_TOKEN'))
+    serve_parser.add_argument('--max-sequences', type = int, default = 8)
+    serve_parser.add_argument('--max-jobs', type = int, default = 8, help = 'Maximum number of DSA jobs in flight')
+    serve_parser.add_argument('--check-interval', type = float, default = 5, help = 'Seconds between job status checks')
+
+    submit_parser = subparsers.add_parser('submit', help = 'Add the sequences in a manifest (JSON, JSONL, or YAML) to the queue')
+    submit_parser.add_argument('--queue', required = True)
+    submit_parser.add_argument('--priority', type = int, default = 0)
+    submit_parser.add_argument('--format', default = None, choices = ['json','jsonl','yaml'])
+    submit_parser.add_argument('manifest')
+
+    status_parser = subparsers.add_parser('status', help = 'Print the status of one sequence or the most recent ones (JSON)')
+    status_parser.add_argument('--queue', required = True)
+    status_parser.add_argument('--state', default = None, choices = QUEUE_STATES)
+    status_parser.add_argument('--limit', type = int, default = 100)
+    status_parser.add_argument('sequence_id', nargs = '?')
+
+    cancel_parser = subparsers.add_parser('cancel', help = 'Cancel a queued or running sequence')
+    cancel_parser.add_argument('--queue', required = True)
+    cancel_parser.add_argument('sequence_id')
+
+    args = parser.parse_args(argv)
+    queue = SequenceQueue(args.queue)
+    try:
+        if args.command=='serve':
+            gc = connect(args.api_url, args.api_key, args.token)
+            supervisor = Supervisor(gc, queue, max_sequences = args.max_sequences, max_jobs_in_flight = args.max_jobs, check_interval = args.check_interval)
+            for signal_number in [signal.SIGINT, signal.SIGTERM]:
+                signal.signal(signal_number, lambda *_: supervisor.stop())
+
+            print(f'Running sequences from {args.queue}')
+            supervisor.run()
+
+        elif args.command=='submit':
+            for record in iter_manifest(args.manifest, args.format):
+                print(queue.submit(record['jobs'], name = record['name'], start_kwargs = record.get('start_kwargs'), priority = args.priority))
+
+        elif args.command=='status':
+            journal = SQLiteJournal(queue.path)
+            if not args.sequence_id is None:
+                record = queue.get(args.sequence_id)
+                if record is None:
+                    print(f'Sequence not found: {args.sequence_id}', file = sys.stderr)
+                    return 1
+                print(json.dumps(sequence_status(queue, journal, record), indent = 2))
+            else:
+                print(json.dumps({
+                    'counts': queue.counts(),
+                    'sequences': [sequence_status(queue, journal, r) for r in queue.list(args.state, args.limit)]
+                }, indent = 2))
+            journal.close()
+
+        elif args.command=='cancel':
+            if not queue.request_cancel(args.sequence_id):
+                print(f'Sequence not found or already finished: {args.sequence_id}', file = sys.stderr)
+                return 1
+            print(f'Cancel requested: {args.sequence_id}')
+
+    finally:
+        queue.close()
+
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main())
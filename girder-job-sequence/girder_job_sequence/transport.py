@@ -0,0 +1,320 @@
+"""Pooled HTTP transport shared by Job, Sequence, and utility lookups
+"""
+
+import re
+import threading
+import weakref
+from math import floor
+from time import perf_counter, monotonic
+from typing_extensions import Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import metrics
+
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+# Statuses where the server did not process the request, so it is safe to re-send a POST (job submission)
+RETRY_POST_STATUS_CODES = [429, 503]
+# Girder ids in a path, replaced so requests to the same endpoint share a latency baseline
+ID_PATTERN = re.compile(r'(?<=/)[0-9a-f]{24}(?=/|$)')
+
+
+def route_template(method: str, path: str)->str:
+    """Method and path with ids replaced, e.g. "GET /job/{id}"
+    """
+    return f'{method.upper()} /' + ID_PATTERN.sub('{id}', '/' + path.lstrip('/')).lstrip('/')
+
+
+class RetryPolicy(Retry):
+    """Retry with exponential backoff on 429/5xx responses. Non-idempotent requests are only
+    retried when the server reports that it did not process them.
+    """
+    def is_retry(self, method, status_code, has_retry_after = False):
+        if method.upper()=='POST' and not status_code in RETRY_POST_STATUS_CODES:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class AIMDLimiter:
+    """Adaptive limit on the number of requests in flight (additive increase, multiplicative decrease).
+
+    The limit grows by about one request per "window" of successful requests and is multiplied by
+    "decrease_factor" when a request fails with 429/5xx, times out, or takes longer than "latency_target"
+    (by default, "spike_ratio" times the recent average latency of the same route and at least "latency_floor" seconds).
+    Average latencies are kept per route (see route_template) since some endpoints (e.g. listing files) are always
+    slower than others (e.g. job status). Decreases are at most once per "cooldown" seconds (or the route's average
+    latency, if longer) so one burst of errors only counts once.
+    """
+    def __init__(self,
+                 initial_limit: Union[float,None] = None,
+                 min_limit: int = 1,
+                 max_limit: int = 10,
+                 decrease_factor: float = 0.5,
+                 latency_target: Union[float,None] = None,
+                 spike_ratio: float = 3.0,
+                 latency_floor: float = 0.25,
+                 cooldown: float = 1.0
+                 ):
+
+        assert 1<=min_limit<=max_limit and 0<decrease_factor<1
+
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(initial_limit if not initial_limit is None else max_limit)
+        self.decrease_factor = decrease_factor
+        self.latency_target = latency_target
+        self.spike_ratio = spike_ratio
+        self.latency_floor = latency_floor
+        self.cooldown = cooldown
+
+        self._condition = threading.Condition()
+        self.in_flight = 0
+        # {route: average latency in seconds}
+        self.average_latency = {}
+        self.last_decrease = None
+        self.n_decreases = 0
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight>=max(floor(self.limit), self.min_limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, seconds: float, overloaded: bool = False, route: Union[str,None] = None):
+        """Finish a request, adjusting the limit from its latency and whether the server was overloaded
+
+        :param seconds: Latency of the request
+        :type seconds: float
+        :param overloaded: Whether the request failed in a way that indicates the server is overloaded, defaults to False
+        :type overloaded: bool, optional
+        :param route: Route of the request (see route_template), compared to the average latency of that route only, defaults to None
+        :type route: Union[str,None], optional
+        """
+        with self._condition:
+            self.in_flight -= 1
+            average_latency = self.average_latency.get(route)
+
+            if not self.latency_target is None:
+                slow = seconds>self.latency_target
+            else:
+                slow = not average_latency is None and seconds>max(average_latency*self.spike_ratio, self.latency_floor)
+
+            if overloaded or slow:
+                now = monotonic()
+                if self.last_decrease is None or now - self.last_decrease>=max(self.cooldown, average_latency or 0):
+                    self.limit = max(self.limit*self.decrease_factor, self.min_limit)
+                    self.last_decrease = now
+                    self.n_decreases += 1
+            else:
+                self.limit = min(self.limit + 1/self.limit, self.max_limit)
+                self.average_latency[route] = seconds if average_latency is None else 0.9*average_latency + 0.1*seconds
+
+            self._condition.notify_all()
+
+    def stats(self)->dict:
+        with self._condition:
+            return {
+                'Limit': self.limit,
+                'In Flight': self.in_flight,
+                'Average Latency': dict(self.average_latency),
+                'Decreases': self.n_decreases
+            }
+
+
+class Transport:
+    """Keep-alive connection pool for one DSA instance. The token is read from the Girder client
+    on every request and sent in the "Girder-Token" header.
+
+    Unless adaptive is False, the number of requests in flight (across every thread using this transport)
+    is limited by an AIMDLimiter between 1 and "max_concurrency" (defaults to pool_size) that backs off
+    when the server returns 429/5xx, times out, or slows down. Streamed requests (e.g. the notification stream) are not limited.
+    """
+    def __init__(self,
+                 gc,
+                 pool_size: int = 10,
+                 max_retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 timeout: Union[float,None] = 60,
+                 adaptive: bool = True,
+                 max_concurrency: Union[int,None] = None,
+                 limiter: Union[AIMDLimiter,None] = None
+                 ):
+
+        self.gc = gc
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        if limiter is None and adaptive:
+            limiter = AIMDLimiter(max_limit = max_concurrency if not max_concurrency is None else pool_size)
+        self.limiter = limiter
+
+        retry = RetryPolicy(
+            total = max_retries,
+            connect = max_retries,
+            read = 0,
+            status = max_retries,
+            backoff_factor = backoff_factor,
+            status_forcelist = RETRY_STATUS_CODES,
+            allowed_methods = ['HEAD','GET','PUT','DELETE','OPTIONS','POST'],
+            raise_on_status = False,
+            respect_retry_after_header = True
+        )
+        adapter = HTTPAdapter(
+            pool_connections = pool_size,
+            pool_maxsize = pool_size,
+            max_retries = retry
+        )
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Used for probes (e.g. checking if an endpoint is enabled) where retrying would only add delay
+        single_adapter = HTTPAdapter(
+            pool_connections = pool_size,
+            pool_maxsize = pool_size,
+            max_retries = 0
+        )
+        self.single_attempt_session = requests.Session()
+        self.single_attempt_session.mount('http://', single_adapter)
+        self.single_attempt_session.mount('https://', single_adapter)
+
+    def url(self, path: str)->str:
+        return self.gc.urlBase + path.lstrip('/')
+
+    def headers(self)->dict:
+        if self.gc.token:
+            return {'Girder-Token': self.gc.token}
+        return {}
+
+    def request(self, method: str, path: str, parameters: Union[dict,None] = None, data = None, json = None, stream: bool = False, timeout: Union[float,None] = None, retry: bool = True)->requests.Response:
+        """Send a request relative to the API url and return the raw response
+
+        :param method: HTTP method
+        :type method: str
+        :param path: Path relative to the API url (e.g. "/job/{id}")
+        :type path: str
+        :param parameters: Query parameters, defaults to None
+        :type parameters: Union[dict,None], optional
+        :param data: Form data, defaults to None
+        :param json: JSON body, defaults to None
+        :param stream: Whether to stream the response body, defaults to False
+        :type stream: bool, optional
+        :param timeout: Timeout in seconds, defaults to the transport's timeout
+        :type timeout: Union[float,None], optional
+        :param retry: Whether to retry on connection errors and 429/5xx responses, defaults to True
+        :type retry: bool, optional
+        :return: Response
+        :rtype: requests.Response
+        """
+        session = self.session if retry else self.single_attempt_session
+        request_kwargs = {
+            'params': parameters,
+            'data': data,
+            'json': json,
+            'headers': self.headers(),
+            'stream': stream,
+            'timeout': timeout if not timeout is None else self.timeout
+        }
+        # Streams stay open for a long time and would hold a slot the whole time
+        limiter = self.limiter if not stream else None
+        if limiter is None and not metrics.enabled():
+            return session.request(method, self.url(path), **request_kwargs)
+
+        if not limiter is None:
+            limiter.acquire()
+            route = route_template(method, path)
+        start = perf_counter()
+        try:
+            response = session.request(method, self.url(path), **request_kwargs)
+        except Exception as e:
+            seconds = perf_counter() - start
+            if not limiter is None:
+                limiter.release(seconds, overloaded = isinstance(e, (requests.Timeout, requests.ConnectionError)), route = route)
+            if metrics.enabled():
+                metrics.record_request(method, path, seconds, error = type(e).__name__)
+            raise
+
+        seconds = perf_counter() - start
+        if not limiter is None:
+            limiter.release(seconds, overloaded = response.status_code in RETRY_STATUS_CODES, route = route)
+
+        if metrics.enabled():
+            body = response.request.body or b''
+            metrics.record_request(
+                method,
+                path,
+                seconds,
+                status = response.status_code,
+                bytes_sent = len(body),
+                # Reading the content of a streamed response here would consume it
+                bytes_received = int(response.headers.get('Content-Length') or 0) if stream else len(response.content)
+            )
+
+        return response
+
+    def send(self, method: str, path: str, parameters: Union[dict,None] = None, data = None, json = None):
+        """Send a request and return the decoded JSON response, raising for error statuses
+        """
+        response = self.request(method, path, parameters = parameters, data = data, json = json)
+        response.raise_for_status()
+
+        return response.json()
+
+    def get(self, path: str, parameters: Union[dict,None] = None):
+        return self.send('GET', path, parameters = parameters)
+
+    def post(self, path: str, parameters: Union[dict,None] = None, data = None, json = None):
+        return self.send('POST', path, parameters = parameters, data = data, json = json)
+
+    def put(self, path: str, parameters: Union[dict,None] = None, data = None, json = None):
+        return self.send('PUT', path, parameters = parameters, data = data, json = json)
+
+    def delete(self, path: str, parameters: Union[dict,None] = None):
+        return self.send('DELETE', path, parameters = parameters)
+
+    def close(self):
+        self.session.close()
+        self.single_attempt_session.close()
+
+
+_transports = weakref.WeakKeyDictionary()
+_transports_lock = threading.Lock()
+
+def get_transport(gc)->Transport:
+    """Get the shared Transport for this Girder client, creating one with default settings if needed
+
+    :param gc: Girder client handler
+    :type gc: None
+    :return: Transport shared by everything using this Girder client
+    :rtype: Transport
+    """
+    with _transports_lock:
+        transport = _transports.get(gc)
+        if transport is None:
+            transport = Transport(gc)
+            _transports[gc] = transport
+
+    return transport
+
+def configure_transport(gc, **kwargs)->Transport:
+    """Replace the shared Transport for this Girder client, e.g. to change the connection pool size or retries
+
+    :param gc: Girder client handler
+    :type gc: None
+    :return: New Transport
+    :rtype: Transport
+    """
+    transport = Transport(gc, **kwargs)
+    with _transports_lock:
+        previous = _transports.get(gc)
+        _transports[gc] = transport
+
+    if not previous is None:
+        previous.close()
+
+    return transport
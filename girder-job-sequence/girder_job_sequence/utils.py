@@ -4,14 +4,26 @@
 import os
 from typing_extensions import Union
 import json
+from time import time, sleep
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 
 from uuid import uuid4
 
+from .cache import CLI_CATALOG, ItemIndex
+from .transport import get_transport
+from . import metrics
+
+class WildcardNotFound(LookupError):
+    """The item, folder, file, or annotation referenced by a wildcard does not exist (yet)
+    """
+    pass
+
 def get_unique_id():
     """Create a unique id for something"""
     return uuid4().hex[:24]
 
-def id_from_info(gc, docker_image_name: str, cli_name: str):
+def id_from_info(gc, docker_image_name: str, cli_name: str, use_cache: bool = True):
     """Find a plugin's info from the name of the Docker image (image/name:tag) and CLI name
 
     :param gc: Girder client handler
@@ -20,9 +32,14 @@ def id_from_info(gc, docker_image_name: str, cli_name: str):
     :type docker_image_name: str
     :param cli_name: Name of the CLI
     :type cli_name: str
+    :param use_cache: Whether to look the plugin up in the shared CLI catalog instead of listing all plugins, defaults to True
+    :type use_cache: bool, optional
     """
 
-    plugin_list = gc.get('/slicer_cli_web/cli')
+    if use_cache:
+        return CLI_CATALOG.get_plugin_info(gc, docker_image_name, cli_name)
+
+    plugin_list = get_transport(gc).get('/slicer_cli_web/cli')
 
     plugin_info = None
     for p in plugin_list:
@@ -32,6 +49,89 @@ def id_from_info(gc, docker_image_name: str, cli_name: str):
 
     return plugin_info
 
+def parse_girder_time(time_str: str)->datetime:
+    """Parse a created/updated timestamp from a Girder document
+    """
+    parsed = datetime.fromisoformat(time_str.replace('Z','+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+
+    return parsed
+
+def get_jobs_info(gc, job_ids: list, types: Union[list,None] = None, since: Union[str,None] = None, page_size: int = 100, max_pages: int = 10, max_workers: int = 8, errors: Union[dict,None] = None)->dict:
+    """Get many job documents (without logs) from a few paged /job listing requests instead of one request per job.
+    Jobs that are not found in the listing (e.g. belonging to another user) are requested individually and concurrently.
+
+    :param gc: Girder client handler
+    :type gc: None
+    :param job_ids: Ids of jobs to find
+    :type job_ids: list
+    :param types: Job types to filter the listing by (e.g. the "type" of each job in a sequence), defaults to None
+    :type types: Union[list,None], optional
+    :param since: Created time of the oldest job being looked for, listing stops at jobs older than this, defaults to None
+    :type since: Union[str,None], optional
+    :param page_size: Number of jobs per listing request, defaults to 100
+    :type page_size: int, optional
+    :param max_pages: Maximum number of listing requests before falling back to individual requests, defaults to 10
+    :type max_pages: int, optional
+    :param max_workers: Number of concurrent individual requests, defaults to 8
+    :type max_workers: int, optional
+    :param errors: Dictionary filled with job id: exception for jobs whose individual request failed (e.g. deleted jobs),
+        which are left out of the result. If None, the first of these errors is raised once every request is done, defaults to None
+    :type errors: Union[dict,None], optional
+    :return: Dictionary of job id: job document
+    :rtype: dict
+    """
+    remaining = set([i for i in job_ids if not i is None])
+    jobs_info = {}
+    since = parse_girder_time(since) if not since is None else None
+
+    parameters = {
+        'limit': page_size,
+        'sort': 'created',
+        'sortdir': -1
+    }
+    if not types is None:
+        parameters['types'] = json.dumps(list(set(types)))
+
+    for page in range(max_pages):
+        if len(remaining)==0:
+            break
+
+        parameters['offset'] = page*page_size
+        jobs_page = get_transport(gc).get('/job', parameters = parameters)
+        for j in jobs_page:
+            if j['_id'] in remaining:
+                jobs_info[j['_id']] = j
+                remaining.remove(j['_id'])
+
+        if len(jobs_page)<page_size:
+            break
+        if not since is None and 'created' in jobs_page[-1] and parse_girder_time(jobs_page[-1]['created'])<since:
+            break
+
+    def get_job(job_id):
+        try:
+            return get_transport(gc).get(f'/job/{job_id}'), None
+        except Exception as e:
+            return None, e
+
+    failed = {}
+    if len(remaining)>0:
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            for job_id, (job_info, error) in zip(remaining, executor.map(metrics.propagate_context(get_job), remaining)):
+                if error is None:
+                    jobs_info[job_id] = job_info
+                else:
+                    failed[job_id] = error
+
+    if errors is None and len(failed)>0:
+        raise next(iter(failed.values()))
+    elif not errors is None:
+        errors.update(failed)
+
+    return jobs_info
+
 def get_text_key_vals(xml_dict:dict):
     """Used for grabbing ".text" of values in dictionary containing XML sub-elements
 
@@ -53,44 +153,110 @@ def get_text_key_vals(xml_dict:dict):
 def find_item(gc,type: str, query:str):
 
     if type=='path':
-        item_info = gc.get(f'/resource/lookup',parameters={'path': query})['_id']
+        # "test" returns null instead of an error status for paths that do not exist
+        item_info = get_transport(gc).get(f'/resource/lookup',parameters={'path': query, 'test': 'true'})
+        if item_info is None:
+            raise WildcardNotFound(f'Path not found: {query}')
+        item_info = item_info['_id']
     elif type=='_id':
-        item_info = gc.get(f'/item/{query}')['_id']
+        item_info = get_transport(gc).get(f'/item/{query}')['_id']
 
     return item_info
 
-def find_file(gc, item_type:str, item_query:str, file_type:str, file_query:str):
+def find_file(gc, item_type:str, item_query:str, file_type:str, file_query:str, index: Union[ItemIndex,None] = None, page_size: int = 50):
+    """Find the id of a file by name in an item. Without an index, files in items referenced by path are looked up
+    directly with /resource/lookup. Otherwise the item's files are listed "page_size" at a time, stopping at the
+    first page containing the file, with every name read kept in the index for later lookups.
+
+    :param index: Index of the item's files (see WildcardCache.item_index), defaults to None
+    :type index: Union[ItemIndex,None], optional
+    :param page_size: Number of files requested at a time, defaults to 50
+    :type page_size: int, optional
+    """
+
+    if file_type == '_id':
+        return file_query
+
+    if item_type == 'path' and index is None:
+        file_path = f'{item_query.rstrip("/")}/{file_query}'
+        file_info = get_transport(gc).get(f'/resource/lookup',parameters={'path': file_path, 'test': 'true'})
+        if file_info is None or file_info.get('_modelType','file')!='file':
+            raise WildcardNotFound(f'File: {file_query} not found in item: {item_query}')
+        return file_info['_id']
 
     if item_type == 'path':
         item_info = find_item(gc,item_type, item_query)
     elif item_type=='_id':
         item_info = item_query
-    
-    if file_type == 'fileName':
-        item_files = gc.get(f'/item/{item_info}/files',parameters = {'limit': 0})
 
-        file_names = [i['name'] for i in item_files]
-        file_info = item_files[file_names.index(file_query)]['_id']
-    
-    elif file_type == '_id':
-        file_info = file_query
+    if index is None:
+        index = ItemIndex()
+
+    with index.lock:
+        while index.get(file_query) is None:
+            # Sorted by creation so files added later are listed after the ones already read
+            files_page = get_transport(gc).get(
+                f'/item/{item_info}/files',
+                parameters = {'limit': page_size, 'offset': index.offset, 'sort': '_id', 'sortdir': 1}
+            )
+            index.n_requests += 1
+            index.offset += len(files_page)
+            for f in files_page:
+                index.add(f['name'], f['_id'])
+
+            if len(files_page)<page_size:
+                break
+
+        # Everything added since the last listing has been read
+        index.stale = False
+        file_info = index.get(file_query)
+
+    if file_info is None:
+        raise WildcardNotFound(f'File: {file_query} not found in item: {item_info}')
 
     return file_info
 
-def find_annotation(gc, item_type, item_query, annotation_type, annotation_query):
+def find_annotation(gc, item_type, item_query, annotation_type, annotation_query, index: Union[ItemIndex,None] = None, page_size: int = 50):
+    """Find the id of an annotation by name in an item, filtering by name on the server and stopping at the
+    first exact match. Matches are kept in "index" (if given) for later lookups.
+    """
+
+    if annotation_type=='annotationId':
+        return annotation_query
 
     if item_type=='path': 
         item_info = find_item(gc, item_type,item_query)
     elif item_type == '_id':
         item_info = item_query
 
-    if annotation_type == 'annotationName':
-        item_annotations = gc.get(f'/annotation',parameters={'itemId': item_info["_id"]})
+    if not index is None and not index.get(annotation_query) is None:
+        return index.get(annotation_query)
+
+    annotation_info = None
+    offset = 0
+    while annotation_info is None:
+        annotations_page = get_transport(gc).get(
+            f'/annotation',
+            parameters = {'itemId': item_info, 'name': annotation_query, 'limit': page_size, 'offset': offset}
+        )
+        offset += len(annotations_page)
+        # The name filter may not be an exact match on every server version
+        matches = [a['_id'] for a in annotations_page if a['annotation']['name']==annotation_query]
+        if len(matches)>0:
+            annotation_info = matches[0]
+        elif len(annotations_page)<page_size:
+            break
+
+    if annotation_info is None:
+        raise WildcardNotFound(f'Annotation: {annotation_query} not found in item: {item_info}')
 
-        annotation_names = [i['annotation']['name'] for i in item_annotations]
-        annotation_info = item_annotations[annotation_names.index(annotation_query)]['_id']
-    elif annotation_type=='annotationId':
-        annotation_info = annotation_query
+    if not index is None:
+        with index.lock:
+            index.add(annotation_query, annotation_info)
+            # Other names are looked up on the server again after jobs finish
+            if index.stale:
+                index.ids = {annotation_query: annotation_info}
+                index.stale = False
 
     return annotation_info
 
@@ -102,30 +268,220 @@ def check_wildcard(test_str: str):
     """
     return '{{' in test_str
 
-def parse_wildcard(gc, wildcard_str:str):
+def parse_wildcard(gc, wildcard_str:str, cache = None):
     """Parse wildcard input, using type, {item,file,or annotation}_type and {item,file,or annotation}_query key-val pairs to search for items, files, or annotations
 
     :param gc: Girder client handler
     :type gc: None
     :param wildcard_str: String containing "{{}}" wildcard indicator
     :type wildcard_str: str
+    :param cache: WildcardCache to memoize lookups in, defaults to None
+    :type cache: Union[WildcardCache,None], optional
     """
     # Verifying this is a wildcard candidate
     assert '{{' in wildcard_str
     wildcard_args = json.loads(wildcard_str[1:-1].replace("'",'"'))
 
+    if cache is None:
+        return resolve_wildcard_args(gc, wildcard_args)
+
+    return cache.get_or_resolve(gc, wildcard_args, lambda: resolve_wildcard_args(gc, wildcard_args, cache))
+
+def item_wildcard_args(wildcard_args: dict)->Union[dict,None]:
+    """Get the arguments of the item lookup needed to find a file or annotation by item path (None if there isn't one)
+    """
+    if wildcard_args['type'] in ['file','annotation'] and wildcard_args.get('item_type')=='path':
+        return {'type': 'item', 'item_type': 'path', 'item_query': wildcard_args['item_query']}
+    return None
+
+def resolve_item_paths(gc, paths: list, page_size: int = 1000, min_siblings: int = 2, max_workers: int = 8)->dict:
+    """Look up many item paths at once. Paths are grouped by parent folder and each folder with at least
+    "min_siblings" of them is listed in pages (stopping once every name is found) instead of looking each path up.
+
+    :param gc: Girder client handler
+    :type gc: None
+    :param paths: Item paths
+    :type paths: list
+    :param page_size: Number of items requested at a time, defaults to 1000
+    :type page_size: int, optional
+    :param min_siblings: Minimum number of paths in a folder for it to be listed, defaults to 2
+    :type min_siblings: int, optional
+    :param max_workers: Number of folders looked up concurrently, defaults to 8
+    :type max_workers: int, optional
+    :return: Dictionary of path: item id for the paths that were found
+    :rtype: dict
+    """
+    # {parent path: {item name: [paths]}}
+    folders = {}
+    for path in dict.fromkeys(paths):
+        parent, _, name = path.strip().rstrip('/').rpartition('/')
+        folders.setdefault(parent, {}).setdefault(name, []).append(path)
+
+    def resolve_folder(parent, names):
+        found = {}
+        if len(names)<min_siblings:
+            for name_paths in names.values():
+                try:
+                    item_id = find_item(gc, 'path', name_paths[0])
+                except WildcardNotFound:
+                    continue
+                found.update({p: item_id for p in name_paths})
+            return found
+
+        folder_info = get_transport(gc).get(f'/resource/lookup',parameters={'path': parent, 'test': 'true'})
+        if folder_info is None or folder_info.get('_modelType')!='folder':
+            return found
+
+        remaining = dict(names)
+        offset = 0
+        while len(remaining)>0:
+            items_page = get_transport(gc).get('/item',parameters={'folderId': folder_info['_id'], 'limit': page_size, 'offset': offset})
+            offset += len(items_page)
+            for item in items_page:
+                if item['name'] in remaining:
+                    found.update({p: item['_id'] for p in remaining.pop(item['name'])})
+
+            if len(items_page)<page_size:
+                break
+
+        return found
+
+    item_ids = {}
+    if len(folders)<=1:
+        for parent, names in folders.items():
+            item_ids.update(resolve_folder(parent, names))
+        return item_ids
+
+    with ThreadPoolExecutor(max_workers = min(max_workers, len(folders))) as executor:
+        for found in executor.map(metrics.propagate_context(lambda f: resolve_folder(*f)), folders.items()):
+            item_ids.update(found)
+
+    return item_ids
+
+def prefetch_item_paths(gc, wildcard_args_list: list, cache, page_size: int = 1000)->int:
+    """Resolve the item paths referenced by many wildcards together (see resolve_item_paths) and store them in a
+    WildcardCache, so item wildcards and the item lookups of file and annotation wildcards are answered from it
+
+    :param gc: Girder client handler
+    :type gc: None
+    :param wildcard_args_list: Parsed wildcard arguments
+    :type wildcard_args_list: list
+    :param cache: WildcardCache to store the item ids in
+    :type cache: WildcardCache
+    :param page_size: Number of items requested at a time, defaults to 1000
+    :type page_size: int, optional
+    :return: Number of item paths found
+    :rtype: int
+    """
+    # {path: [item wildcard arguments]}
+    pending = {}
+    for wildcard_args in wildcard_args_list:
+        if wildcard_args.get('type')=='item' and wildcard_args.get('item_type')=='path':
+            item_args = wildcard_args
+        else:
+            item_args = item_wildcard_args(wildcard_args)
+
+        if item_args is None or cache.contains(gc, item_args):
+            continue
+        pending.setdefault(item_args['item_query'], []).append(item_args)
+
+    if len(pending)==0:
+        return 0
+
+    found = resolve_item_paths(gc, list(pending), page_size = page_size)
+    for path, item_id in found.items():
+        for item_args in pending[path]:
+            cache.put(gc, item_args, item_id)
+
+    return len(found)
+
+def resolve_wildcard_args(gc, wildcard_args: dict, cache = None):
+    """Look up the value of a parsed wildcard
+
+    :param gc: Girder client handler
+    :type gc: None
+    :param wildcard_args: Parsed wildcard arguments
+    :type wildcard_args: dict
+    :param cache: WildcardCache used for item lookups and item indexes of file and annotation wildcards, defaults to None
+    :type cache: Union[WildcardCache,None], optional
+    """
+    item_args = item_wildcard_args(wildcard_args)
+    if not cache is None and not item_args is None:
+        # Looking up the item through the cache so other wildcards in the same item reuse it
+        item_id = cache.get_or_resolve(gc, item_args, lambda: resolve_wildcard_args(gc, item_args))
+        wildcard_args = dict(wildcard_args, item_type = '_id', item_query = item_id)
+
     if wildcard_args['type']=='item':
         wildcard_val = find_item(gc, wildcard_args['item_type'], wildcard_args['item_query'])
     elif wildcard_args['type']=='folder':
         # This is the same function since they both use the /resource/lookup endpoint for path types
         wildcard_val = find_item(gc,wildcard_args['folder_type'],wildcard_args['folder_query'])
     elif wildcard_args['type']=='file':
-        wildcard_val = find_file(gc, wildcard_args['item_type'],wildcard_args['item_query'],wildcard_args['file_type'],wildcard_args['file_query'])
+        index = cache.item_index(gc, wildcard_args['item_query'], 'file') if not cache is None and wildcard_args['item_type']=='_id' else None
+        wildcard_val = find_file(gc, wildcard_args['item_type'],wildcard_args['item_query'],wildcard_args['file_type'],wildcard_args['file_query'], index = index)
     elif wildcard_args['type']=='annotation':
-        wildcard_val = find_annotation(gc,wildcard_args['item_type'],wildcard_args['item_query'],wildcard_args['annotation_type'],wildcard_args['anotation_query'])
+        index = cache.item_index(gc, wildcard_args['item_query'], 'annotation') if not cache is None and wildcard_args['item_type']=='_id' else None
+        wildcard_val = find_annotation(gc,wildcard_args['item_type'],wildcard_args['item_query'],wildcard_args['annotation_type'],wildcard_args.get('annotation_query', wildcard_args.get('anotation_query')), index = index)
 
     return wildcard_val
 
+def wait_for_wildcard(gc, wildcard_str: str, cache = None, timeout: float = 300, initial_interval: float = 0.5, max_interval: float = 10, factor: float = 2.0):
+    """Look up a wildcard, checking again with exponential backoff while its target does not exist, up to "timeout" seconds
+
+    :param gc: Girder client handler
+    :type gc: None
+    :param wildcard_str: String containing "{{}}" wildcard indicator
+    :type wildcard_str: str
+    :param cache: WildcardCache to memoize lookups in, defaults to None
+    :type cache: Union[WildcardCache,None], optional
+    :param timeout: Maximum number of seconds to wait, defaults to 300
+    :type timeout: float, optional
+    :raises WildcardNotFound: If the target does not exist after "timeout" seconds
+    :return: Wildcard value
+    """
+    start_time = time()
+    interval = initial_interval
+    while True:
+        try:
+            return parse_wildcard(gc, wildcard_str, cache)
+        except WildcardNotFound:
+            remaining = timeout - (time() - start_time)
+            if remaining<=0:
+                raise
+
+        sleep(min(interval, remaining))
+        interval = min(interval*factor, max_interval)
+
+def resolve_wildcards(gc, wildcard_strs: list, cache = None, max_workers: int = 8, wait_timeout: float = 0)->dict:
+    """Resolve many wildcards concurrently, looking each distinct wildcard up once
+
+    :param gc: Girder client handler
+    :type gc: None
+    :param wildcard_strs: Wildcard strings (containing "{{}}")
+    :type wildcard_strs: list
+    :param cache: WildcardCache to memoize lookups in, defaults to None
+    :type cache: Union[WildcardCache,None], optional
+    :param max_workers: Number of concurrent lookups, defaults to 8
+    :type max_workers: int, optional
+    :param wait_timeout: Seconds to keep checking for targets that do not exist yet (see wait_for_wildcard), defaults to 0
+    :type wait_timeout: float, optional
+    :return: Dictionary of wildcard string: value
+    :rtype: dict
+    """
+    def lookup(w):
+        if wait_timeout>0:
+            return wait_for_wildcard(gc, w, cache, timeout = wait_timeout)
+        return parse_wildcard(gc, w, cache)
+
+    unique_strs = list(dict.fromkeys(wildcard_strs))
+    if len(unique_strs)<=1:
+        return {w: lookup(w) for w in unique_strs}
+
+    with ThreadPoolExecutor(max_workers = min(max_workers, len(unique_strs))) as executor:
+        values = list(executor.map(metrics.propagate_context(lookup), unique_strs))
+
+    return dict(zip(unique_strs, values))
+
 def from_json(gc, json_path: str):
     """Read job or job sequence from JSON file
 
@@ -145,17 +501,19 @@ def from_json(gc, json_path: str):
     if type(job_json)==dict:
         job_json = [job_json]
     
-    job_list = from_list(job_json)
+    job_list = from_list(gc, job_json)
     
     return job_list
 
-def from_dict(gc, dict_data:dict):
+def from_dict(gc, dict_data:dict, lazy: bool = False):
     """Method for creating job/sequence from a dictionary
 
     :param gc: Girder client handler
     :type gc: None
     :param dict_data: _description_
     :type dict_data: dict
+    :param lazy: Whether to wait until the plugin specification is first needed to fetch it, defaults to False
+    :type lazy: bool, optional
     """
     from .job import Job
 
@@ -164,24 +522,63 @@ def from_dict(gc, dict_data:dict):
         plugin_id = dict_data['plugin_id'] if 'plugin_id' in dict_data else None,
         docker_image=dict_data['docker_image'] if 'docker_image' in dict_data else None,
         cli= dict_data['cli'] if 'cli' in dict_data else None,
-        input_args = dict_data['input_args'] if 'input_args' in dict_data else None
+        input_args = dict_data['input_args'] if 'input_args' in dict_data else None,
+        name = dict_data['name'] if 'name' in dict_data else None,
+        depends_on = dict_data['depends_on'] if 'depends_on' in dict_data else None,
+        lazy = lazy
     )
 
     return job_from_dict
 
-def from_list(gc, list_data:list):
+def resolve_jobs(jobs: list, max_workers: int = 8)->list:
+    """Fetch the plugin specifications of many lazily constructed Jobs concurrently. Each distinct plugin
+    is fetched once, the other Jobs using it then read it from the CLI catalog.
+
+    :param jobs: Jobs (see Job.resolve)
+    :type jobs: list
+    :param max_workers: Number of plugin specifications fetched at the same time, defaults to 8
+    :type max_workers: int, optional
+    :return: Executable dictionary of each job (None for plugins that were not found)
+    :rtype: list
+    """
+    unresolved = [j for j in jobs if not j.resolved]
+
+    first_jobs = {}
+    for j in unresolved:
+        plugin_key = (j.gc.urlBase, j.plugin_id) if not j.plugin_id is None else (j.gc.urlBase, j.docker_image, j.cli)
+        first_jobs.setdefault(plugin_key, j)
+
+    # Jobs referring to plugins by docker_image and cli share one plugin listing
+    for api_url in set([k[0] for k in first_jobs if len(k)==3]):
+        CLI_CATALOG.get_listing(next(j.gc for k,j in first_jobs.items() if k[0]==api_url))
+
+    if len(first_jobs)>1:
+        with ThreadPoolExecutor(max_workers = min(max_workers, len(first_jobs))) as executor:
+            list(executor.map(metrics.propagate_context(lambda j: j.resolve()), first_jobs.values()))
+
+    return [j.resolve() for j in jobs]
+
+def from_list(gc, list_data:list, lazy: bool = False, max_workers: int = 8):
     """Generating job/sequence from list of dictionaries
 
     :param list_data: _description_
     :type list_data: list
+    :param lazy: Whether to wait until each plugin specification is first needed (or Sequence.start) to fetch it
+        instead of fetching all of them concurrently now, defaults to False
+    :type lazy: bool, optional
+    :param max_workers: Number of plugin specifications fetched at the same time, defaults to 8
+    :type max_workers: int, optional
     """
 
     job_list = []
     for l in list_data:
         job_list.append(
-            from_dict(gc,l)
+            from_dict(gc,l,lazy = True)
         )
 
+    if not lazy:
+        resolve_jobs(job_list, max_workers)
+
     if len(job_list)>1:
         from .sequence import Sequence
         return Sequence(gc,job_list)
@@ -0,0 +1,355 @@
+"""Strategies for waiting on a running Job to finish
+"""
+
+import json
+import weakref
+import threading
+from time import time, sleep
+from typing_extensions import Union
+
+import requests
+
+from .transport import get_transport
+
+
+FINISHED_STATUSES = ['SUCCESS','ERROR','CANCELED']
+
+
+class IntervalWaiter:
+    """Check the status of a job every "check_interval" seconds
+    """
+    def __init__(self, check_interval: float = 5):
+        assert check_interval>0
+        self.check_interval = check_interval
+
+    def wait(self, job, on_status = None, timeout: Union[float,None] = None)->str:
+        """Block until the job reaches SUCCESS, ERROR, or CANCELED (or timeout is reached)
+
+        :param job: Job that has been started
+        :type job: Job
+        :param on_status: Function called with each status that is checked, defaults to None
+        :type on_status: Callable, optional
+        :param timeout: Maximum number of seconds to wait, defaults to None
+        :type timeout: Union[float,None], optional
+        :return: Last status of the job
+        :rtype: str
+        """
+        start_time = time()
+        current_status = job.get_status()
+        while not current_status in FINISHED_STATUSES:
+            if not timeout is None and time()-start_time>timeout:
+                break
+
+            sleep(self.check_interval)
+            current_status = job.get_status()
+
+            if not on_status is None:
+                on_status(current_status)
+
+        return current_status
+
+
+class BackoffWaiter:
+    """Check the status of a job with exponentially increasing intervals, going back to
+    "initial_interval" whenever the status changes.
+    """
+    def __init__(self, initial_interval: float = 0.5, max_interval: float = 30, factor: float = 2.0):
+        assert initial_interval>0 and max_interval>=initial_interval and factor>=1
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.factor = factor
+
+    def wait(self, job, on_status = None, timeout: Union[float,None] = None)->str:
+        """Block until the job reaches SUCCESS, ERROR, or CANCELED (or timeout is reached)
+
+        :param job: Job that has been started
+        :type job: Job
+        :param on_status: Function called with each status that is checked, defaults to None
+        :type on_status: Callable, optional
+        :param timeout: Maximum number of seconds to wait, defaults to None
+        :type timeout: Union[float,None], optional
+        :return: Last status of the job
+        :rtype: str
+        """
+        start_time = time()
+        interval = self.initial_interval
+        current_status = job.get_status()
+        while not current_status in FINISHED_STATUSES:
+            if not timeout is None and time()-start_time>timeout:
+                break
+
+            sleep(interval)
+            new_status = job.get_status()
+            if new_status==current_status:
+                interval = min(interval*self.factor, self.max_interval)
+            else:
+                interval = self.initial_interval
+            current_status = new_status
+
+            if not on_status is None:
+                on_status(current_status)
+
+        return current_status
+
+
+class NotificationWaiter:
+    """React to job status changes pushed through Girder's notification stream (/notification/stream).
+    Falls back to BackoffWaiter if the stream is disabled or unavailable on the server.
+    """
+    def __init__(self, gc, stream_timeout: float = 60, fallback: Union[BackoffWaiter,None] = None):
+        self.gc = gc
+        self.stream_timeout = stream_timeout
+        self.fallback = fallback if not fallback is None else BackoffWaiter()
+        # None until the stream has been tried once
+        self.available = None
+        self.since = None
+
+    def wait(self, job, on_status = None, timeout: Union[float,None] = None)->str:
+        """Block until the job reaches SUCCESS, ERROR, or CANCELED (or timeout is reached)
+
+        :param job: Job that has been started
+        :type job: Job
+        :param on_status: Function called with each status reported by the server, defaults to None
+        :type on_status: Callable, optional
+        :param timeout: Maximum number of seconds to wait, defaults to None
+        :type timeout: Union[float,None], optional
+        :return: Last status of the job
+        :rtype: str
+        """
+        from .job import status_from_code
+
+        start_time = time()
+        current_status = job.get_status()
+        while not current_status in FINISHED_STATUSES:
+            if self.available is False:
+                remaining = None if timeout is None else max(timeout-(time()-start_time),0)
+                return self.fallback.wait(job, on_status = on_status, timeout = remaining)
+
+            if not timeout is None and time()-start_time>timeout:
+                break
+
+            stream_timeout = self.stream_timeout
+            if not timeout is None:
+                stream_timeout = max(min(stream_timeout, timeout-(time()-start_time)),1)
+
+            events = self.stream_events(stream_timeout)
+            try:
+                for event in events:
+                    if event.get('type')=='job_status' and event.get('data',{}).get('_id')==job.job_id:
+                        current_status = status_from_code(event['data']['status'])
+                        if not on_status is None:
+                            on_status(current_status)
+
+                        if current_status in FINISHED_STATUSES:
+                            break
+                else:
+                    # Stream closed without a terminal event (timeout), checking in case one was missed
+                    current_status = job.get_status()
+            except requests.RequestException as e:
+                print(f'Notification stream interrupted: {e}')
+                current_status = job.get_status()
+            finally:
+                events.close()
+
+        return current_status
+
+    def stream_events(self, stream_timeout: float):
+        """Generator of notification events from the SSE stream, closes when the server ends the stream
+        """
+        # Girder takes whole seconds and closes the stream right away with a timeout of 0
+        parameters = {'timeout': max(int(stream_timeout), 1)}
+        if not self.since is None:
+            parameters['since'] = self.since
+
+        response = get_transport(self.gc).request(
+            'GET',
+            '/notification/stream',
+            parameters = parameters,
+            stream = True,
+            timeout = stream_timeout+30,
+            retry = False
+        )
+
+        try:
+            if not response.status_code==200:
+                print(f'Notification stream unavailable ({response.status_code}: {response.text}), falling back to polling')
+                self.available = False
+                return
+
+            self.available = True
+            # chunk_size=None yields each chunk as the server flushes it instead of waiting for a full buffer
+            for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+
+                event = json.loads(line[len('data:'):])
+                if '_girderTime' in event:
+                    self.since = event['_girderTime']
+
+                yield event
+        finally:
+            response.close()
+
+
+class SharedPoller:
+    """Check the status of every job being waited on (by any number of Sequences and threads) from one background
+    thread, using a few /job listing requests per check (see utils.get_jobs_info) instead of one polling loop per job.
+    The thread stops while no jobs are waited on.
+
+    A job whose status cannot be read in "max_failures" checks in a row (e.g. it was deleted) is reported as ERROR
+    to its waiters, with the last exception in SharedPoller.failed. Failed requests are also recorded by the
+    instrumentation hooks (see girder_job_sequence.metrics).
+    """
+    def __init__(self, gc, check_interval: float = 5, max_failures: int = 3, verbose: bool = False):
+        assert check_interval>0 and max_failures>0
+        self.gc = gc
+        self.check_interval = check_interval
+        self.max_failures = max_failures
+        self.verbose = verbose
+
+        self._condition = threading.Condition()
+        # {job id: {'job': Job, 'status': str, 'version': number of checks, 'waiters': int, 'failures': int}}
+        self._waiting = {}
+        # {job id: last exception} of jobs given up on
+        self.failed = {}
+        self.thread = None
+        self.n_checks = 0
+
+    def wait(self, job, on_status = None, timeout: Union[float,None] = None)->str:
+        """Block until the job reaches SUCCESS, ERROR, or CANCELED (or timeout is reached)
+
+        :param job: Job that has been started
+        :type job: Job
+        :param on_status: Function called with each status that is checked, defaults to None
+        :type on_status: Callable, optional
+        :param timeout: Maximum number of seconds to wait, defaults to None
+        :type timeout: Union[float,None], optional
+        :return: Last status of the job
+        :rtype: str
+        """
+        start_time = time()
+        with self._condition:
+            entry = self._waiting.setdefault(job.job_id, {'job': job, 'status': None, 'version': 0, 'waiters': 0, 'failures': 0})
+            entry['waiters'] += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.run, daemon = True)
+                self.thread.start()
+
+        seen = 0
+        current_status = None
+        try:
+            while not current_status in FINISHED_STATUSES:
+                with self._condition:
+                    while entry['version']==seen:
+                        remaining = None if timeout is None else timeout-(time()-start_time)
+                        if not remaining is None and remaining<=0:
+                            return current_status if not current_status is None else job.get_status()
+                        self._condition.wait(remaining)
+
+                    seen = entry['version']
+                    current_status = entry['status']
+
+                if not on_status is None:
+                    on_status(current_status)
+        finally:
+            with self._condition:
+                entry['waiters'] -= 1
+                if entry['waiters']<=0 and self._waiting.get(job.job_id) is entry:
+                    del self._waiting[job.job_id]
+
+        return current_status
+
+    def run(self):
+        from .job import status_from_code
+        from .utils import get_jobs_info
+
+        with self._condition:
+            while len(self._waiting)>0:
+                jobs = [e['job'] for e in self._waiting.values()]
+                self._condition.release()
+                errors = {}
+                try:
+                    job_infos = [getattr(j, 'job_info', {}) for j in jobs]
+                    types = [i.get('type') for i in job_infos]
+                    created = [i.get('created') for i in job_infos]
+                    statuses = get_jobs_info(
+                        self.gc,
+                        [j.job_id for j in jobs],
+                        types = types if not None in types else None,
+                        since = min(created) if not None in created else None,
+                        errors = errors
+                    )
+                except Exception as e:
+                    # The listing itself failed, counted as a failure for every job
+                    statuses = {}
+                    errors = {j.job_id: e for j in jobs}
+                finally:
+                    self._condition.acquire()
+
+                for job_id, job_info in statuses.items():
+                    entry = self._waiting.get(job_id)
+                    if not entry is None:
+                        entry['status'] = status_from_code(job_info['status'])
+                        entry['failures'] = 0
+                        entry['version'] += 1
+
+                for job_id, error in errors.items():
+                    entry = self._waiting.get(job_id)
+                    if entry is None:
+                        continue
+
+                    entry['failures'] += 1
+                    if self.verbose:
+                        print(f'Unable to check the status of job {job_id} ({entry["failures"]}/{self.max_failures}): {error}')
+                    if entry['failures']>=self.max_failures:
+                        # Releasing the waiters instead of waiting on a job that cannot be read
+                        self.failed[job_id] = error
+                        entry['status'] = 'ERROR'
+                        entry['version'] += 1
+
+                self.n_checks += 1
+                self._condition.notify_all()
+                self._condition.wait(self.check_interval)
+
+            self.thread = None
+
+
+# One SharedPoller per Girder client, see get_shared_poller
+_pollers = weakref.WeakKeyDictionary()
+_pollers_lock = threading.Lock()
+
+def get_shared_poller(gc, check_interval: float = 5)->SharedPoller:
+    """Get the SharedPoller for this Girder client, creating one if needed. "check_interval" only applies when it is created.
+    """
+    with _pollers_lock:
+        poller = _pollers.get(gc)
+        if poller is None:
+            poller = SharedPoller(gc, check_interval)
+            _pollers[gc] = poller
+
+    return poller
+
+def get_waiter(gc, wait_strategy = 'poll', check_interval: float = 5):
+    """Create a waiter for one of the wait strategies
+
+    :param gc: Girder client handler
+    :type gc: None
+    :param wait_strategy: One of "poll" (fixed check_interval), "backoff", "notification", or "shared" (one SharedPoller
+        for every job of this Girder client), or a waiter object (anything with a "wait" method), defaults to 'poll'
+    :type wait_strategy: str, optional
+    :param check_interval: Seconds between status checks for "poll" and "shared", and maximum interval for "backoff", defaults to 5
+    :type check_interval: float, optional
+    """
+    if not isinstance(wait_strategy, str):
+        return wait_strategy
+
+    assert wait_strategy in ['poll','backoff','notification','shared']
+
+    if wait_strategy=='shared':
+        return get_shared_poller(gc, check_interval)
+    elif wait_strategy=='poll':
+        return IntervalWaiter(check_interval)
+    elif wait_strategy=='backoff':
+        return BackoffWaiter(initial_interval = min(0.5, check_interval), max_interval = check_interval)
+    elif wait_strategy=='notification':
+        return NotificationWaiter(gc, fallback = BackoffWaiter(initial_interval = min(0.5, check_interval), max_interval = check_interval))
@@ -0,0 +1,168 @@
+"""Benchmarking girder-job-sequence against a local mock DSA server
+
+Run from the girder-job-sequence directory:
+
+    python -m tests.benchmark_job_sequence --latency 0.02
+"""
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import argparse
+import tracemalloc
+import threading
+from time import time, sleep
+from concurrent.futures import ThreadPoolExecutor
+
+from girder_job_sequence.job import Job
+from girder_job_sequence.batch import BatchRunner
+from girder_job_sequence.cache import WildcardCache
+from girder_job_sequence.utils import resolve_wildcards
+
+from tests.mock_dsa import MockDSA
+
+
+def submission_throughput(mock: MockDSA, plugin_id: str, n_jobs: int, max_workers: int)->dict:
+    """Jobs per second submitted, one at a time and from a thread pool
+    """
+    gc = mock.client()
+    jobs = [
+        Job(gc, plugin_id = plugin_id, input_args = [{'name': 'input_image', 'value': f'image_{i}'}])
+        for i in range(n_jobs)
+    ]
+
+    start_time = time()
+    for j in jobs[:n_jobs//2]:
+        j.start()
+    serial_time = time() - start_time
+
+    start_time = time()
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        list(executor.map(lambda j: j.start(), jobs[n_jobs//2:]))
+    concurrent_time = time() - start_time
+
+    return {
+        'Serial Jobs per Second': (n_jobs//2)/serial_time,
+        f'Concurrent ({max_workers} threads) Jobs per Second': (n_jobs - n_jobs//2)/concurrent_time
+    }
+
+def poll_overhead(mock: MockDSA, plugin_id: str, n_polls: int)->dict:
+    """Time and bytes per status check with and without downloading the job log
+    """
+    gc = mock.client()
+    job = Job(gc, plugin_id = plugin_id, input_args = [{'name': 'input_image', 'value': 'image'}])
+    # Checking the status of a long running job after it has written part of its log
+    job_duration = mock.job_duration
+    mock.job_duration = 60
+    job.start()
+    mock.job_duration = job_duration
+    sleep(mock.queue_time + 10)
+
+    results = {}
+    for light in [True, False]:
+        n_bytes = 0
+        start_time = time()
+        for _ in range(n_polls):
+            n_bytes += job.fetch_status_info(light = light)[1]
+        label = 'Light' if light else 'Full'
+        results[f'{label} Poll Seconds'] = (time() - start_time)/n_polls
+        results[f'{label} Poll Bytes'] = n_bytes/n_polls
+
+    return results
+
+def wildcard_cost(mock: MockDSA, n_items: int, n_jobs: int)->dict:
+    """Requests and seconds to resolve the wildcards of many jobs referring to the same items, with and without a cache
+    """
+    gc = mock.client()
+    wildcards = []
+    for i in range(n_items):
+        item_id = mock.add_item(f'/collection/benchmark/images/image_{i}.svs')
+        mock.add_file(item_id, f'image_{i}.svs')
+        wildcards.append(
+            "{{'type':'file','item_type':'path','item_query':'/collection/benchmark/images/image_%d.svs','file_type':'fileName','file_query':'image_%d.svs'}}" % (i, i)
+        )
+
+    results = {}
+    for label, cache in [('Uncached', None), ('Cached', WildcardCache(types = ['item','folder','file','annotation']))]:
+        n_requests = len(mock.request_log)
+        start_time = time()
+        for _ in range(n_jobs):
+            resolve_wildcards(gc, wildcards, cache = cache)
+        results[f'{label} Seconds per Job'] = (time() - start_time)/n_jobs
+        results[f'{label} Requests per Job'] = (len(mock.request_log) - n_requests)/n_jobs
+
+    return results
+
+def memory_per_sequence(mock: MockDSA, plugin_id: str, n_sequences: int)->dict:
+    """Memory allocated by girder-job-sequence (not the mock server) per in-flight sequence
+    """
+    gc = mock.client()
+    template = [
+        {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': '${item}'}]},
+        {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': '${item}'}]}
+    ]
+    batch = BatchRunner(
+        gc,
+        template,
+        [f'image_{i}' for i in range(n_sequences)],
+        max_sequences = n_sequences,
+        max_jobs_in_flight = n_sequences,
+        start_kwargs = {'check_interval': 0.2}
+    )
+
+    tracemalloc.start(25)
+    snapshots = []
+    def sample():
+        # Sampling while every sequence is waiting on its first job
+        sleep(mock.queue_time + mock.job_duration/2)
+        snapshots.append(tracemalloc.take_snapshot())
+
+    sampler = threading.Thread(target = sample)
+    baseline = tracemalloc.take_snapshot()
+    sampler.start()
+    batch.run()
+    sampler.join()
+    tracemalloc.stop()
+
+    ignored = [
+        tracemalloc.Filter(False, os.path.abspath(__file__).replace('benchmark_job_sequence.py','mock_dsa.py'), all_frames = True),
+        tracemalloc.Filter(False, '*socketserver.py', all_frames = True),
+        tracemalloc.Filter(False, '*http/server.py', all_frames = True),
+        tracemalloc.Filter(False, tracemalloc.__file__)
+    ]
+    in_flight = sum([s.size_diff for s in snapshots[0].filter_traces(ignored).compare_to(baseline.filter_traces(ignored), 'filename')])
+
+    return {
+        'Sequences in Flight': n_sequences,
+        'KiB per In-flight Sequence': in_flight/1024/n_sequences
+    }
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Benchmark girder-job-sequence against a mock DSA server')
+    parser.add_argument('--latency', type = float, default = 0.01, help = 'Seconds added to each request')
+    parser.add_argument('--jobs', type = int, default = 200, help = 'Jobs submitted in the throughput benchmark')
+    parser.add_argument('--workers', type = int, default = 8, help = 'Threads used for concurrent submission')
+    parser.add_argument('--polls', type = int, default = 50, help = 'Status checks in the polling benchmark')
+    parser.add_argument('--log-lines', type = int, default = 2000, help = 'Log lines written by each mock job')
+    parser.add_argument('--sequences', type = int, default = 50, help = 'Sequences in flight in the memory benchmark')
+    args = parser.parse_args()
+
+    with MockDSA(latency = args.latency, job_duration = 1.0, log_lines = args.log_lines) as mock:
+        plugin_id = mock.add_plugin('dsarchive/benchmark:latest', 'Benchmark')
+
+        benchmarks = [
+            ('Submission', lambda: submission_throughput(mock, plugin_id, args.jobs, args.workers)),
+            ('Status Polling', lambda: poll_overhead(mock, plugin_id, args.polls)),
+            ('Wildcard Resolution', lambda: wildcard_cost(mock, 10, 20)),
+            ('Memory', lambda: memory_per_sequence(mock, plugin_id, args.sequences))
+        ]
+        for name, benchmark in benchmarks:
+            print(f'--------------{name}--------------')
+            for key, val in benchmark().items():
+                print(f'{key}: {round(val, 4) if isinstance(val, float) else val}')
+
+
+if __name__=='__main__':
+    main()
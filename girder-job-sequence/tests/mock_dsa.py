@@ -0,0 +1,466 @@
+"""In-process stand-in for the DSA endpoints used by girder-job-sequence
+"""
+
+import json
+import random
+import threading
+from time import time, sleep
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from uuid import uuid4
+
+
+def _new_id():
+    return uuid4().hex[:24]
+
+
+DEFAULT_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<executable>
+  <title>{title}</title>
+  <description>Mock plugin</description>
+  <contributor>Mock</contributor>
+  <parameters>
+    <label>IO</label>
+    <description>Inputs and outputs</description>
+    <image>
+      <name>input_image</name>
+      <label>Input Image</label>
+      <channel>input</channel>
+      <index>0</index>
+      <description>Input image</description>
+    </image>
+    <integer>
+      <name>threshold</name>
+      <label>Threshold</label>
+      <description>Threshold</description>
+      <default>50</default>
+      <constraints><min>0</min><max>255</max><step>1</step></constraints>
+    </integer>
+    <string-enumeration>
+      <name>mode</name>
+      <label>Mode</label>
+      <description>Mode</description>
+      <default>fast</default>
+      <element>fast</element>
+      <element>slow</element>
+    </string-enumeration>
+    <float-vector>
+      <name>scale</name>
+      <label>Scale</label>
+      <description>Scale</description>
+      <default>1.0,1.0</default>
+    </float-vector>
+    <region>
+      <name>analysis_roi</name>
+      <label>ROI</label>
+      <description>ROI</description>
+      <default>-1,-1,-1,-1</default>
+    </region>
+    <boolean>
+      <name>flag</name>
+      <label>Flag</label>
+      <description>Flag</description>
+      <default>false</default>
+    </boolean>
+  </parameters>
+</executable>
+"""
+
+
+class MockDSA:
+    """Local HTTP server standing in for the DSA endpoints used by girder-job-sequence, for tests and benchmarks
+    that can run without a DSA instance.
+
+    Serves slicer_cli_web plugin listing/XML/run, job get/list/cancel, notification polling and streaming,
+    resource lookup, item, item files, annotation, and worker status endpoints. Jobs move from QUEUED to RUNNING after
+    "queue_time" seconds (and once fewer than "worker_concurrency" jobs are running, if set) and finish "job_duration"
+    seconds later, failing with probability "failure_rate". Every request waits "latency" seconds before being handled.
+    Requests arriving while "max_concurrent_requests" (if set) are already being handled get a 503 response.
+
+    with MockDSA(latency = 0.02, job_duration = 1) as mock:
+        plugin_id = mock.add_plugin('dsarchive/histomicstk:latest', 'NucleiDetection')
+        gc = mock.client()
+    """
+    def __init__(self,
+                 latency: float = 0.0,
+                 job_duration: float = 0.2,
+                 queue_time: float = 0.05,
+                 failure_rate: float = 0.0,
+                 log_lines: int = 5,
+                 notifications: bool = True,
+                 worker_concurrency = None,
+                 max_concurrent_requests = None,
+                 seed = None
+                 ):
+        self.latency = latency
+        self.job_duration = job_duration
+        self.queue_time = queue_time
+        self.failure_rate = failure_rate
+        self.log_lines = log_lines
+        self.notifications_enabled = notifications
+        self.worker_concurrency = worker_concurrency
+        self.n_running = 0
+        self.max_concurrent_requests = max_concurrent_requests
+        self.requests_in_flight = 0
+        self.n_rejected = 0
+        self.random = random.Random(seed)
+
+        self.lock = threading.RLock()
+        self.plugins = {}
+        self.jobs = {}
+        self.folders = {}
+        self.items = {}
+        self.files = {}
+        self.annotations = {}
+        self.paths = {}
+        self.notifications = []
+        self.request_log = []
+
+        self.token = 'mock-token'
+        self.server = None
+        self.thread = None
+
+    # Adding plugins and data
+    def add_plugin(self, image, name, xml = None, updated = None):
+        plugin_id = _new_id()
+        self.plugins[plugin_id] = {
+            '_id': plugin_id,
+            'image': image,
+            'name': name,
+            'type': 'python',
+            'updated': updated or datetime.now(timezone.utc).isoformat(),
+            'xml': xml or DEFAULT_XML.format(title=name)
+        }
+        return plugin_id
+
+    def add_folder(self, path):
+        folder_id = _new_id()
+        self.folders[folder_id] = {'_id': folder_id, '_modelType': 'folder', 'name': path.rstrip('/').split('/')[-1]}
+        self.paths[path.rstrip('/')] = ('folder', folder_id)
+        return folder_id
+
+    def add_item(self, path):
+        folder_path = '/'.join(path.split('/')[:-1])
+        if not folder_path in self.paths:
+            self.add_folder(folder_path)
+        item_id = _new_id()
+        self.items[item_id] = {'_id': item_id, '_modelType': 'item', 'name': path.split('/')[-1],
+                               'folderId': self.paths[folder_path][1]}
+        self.paths[path] = ('item', item_id)
+        return item_id
+
+    def add_file(self, item_id, name):
+        file_id = _new_id()
+        self.files[file_id] = {'_id': file_id, '_modelType': 'file', 'name': name, 'itemId': item_id, 'size': 10}
+        return file_id
+
+    def add_annotation(self, item_id, name):
+        annotation_id = _new_id()
+        self.annotations[annotation_id] = {'_id': annotation_id, 'itemId': item_id, 'annotation': {'name': name}}
+        return annotation_id
+
+    # Simulating jobs
+    def _notify(self, type, data, updated = None):
+        if self.notifications_enabled:
+            self.notifications.append({
+                '_id': _new_id(),
+                'type': type,
+                'data': data,
+                'time': time(),
+                'updated': updated or datetime.now(timezone.utc).isoformat()
+            })
+
+    def _advance(self, job):
+        now = time()
+        new_status = job['status']
+        if job['status'] in [3,4,5]:
+            return
+        if job['_started'] is None and now - job['_submitted']>=self.queue_time:
+            if self.worker_concurrency is None or self.n_running<self.worker_concurrency:
+                job['_started'] = now
+                self.n_running += 1
+        if job['_started'] is None:
+            return
+        elapsed = now - job['_started']
+        if elapsed>=job['_duration']:
+            new_status = 4 if job['_fail'] else 3
+            self.n_running -= 1
+        else:
+            new_status = 2
+        n_lines = int(min(elapsed/max(job['_duration'],1e-6),1.0)*self.log_lines)
+        while len(job['log'])<n_lines:
+            line = f'log line {len(job["log"])} for {job["_id"]}\n'
+            job['log'].append(line)
+            # Girder updates the job document and sends the notification with the same time
+            job['updated'] = datetime.now(timezone.utc).isoformat()
+            self._notify('job_log', {'_id': job['_id'], 'overwrite': False, 'text': line}, job['updated'])
+        if not new_status==job['status']:
+            job['status'] = new_status
+            job['updated'] = datetime.now(timezone.utc).isoformat()
+            self._notify('job_status', self._public_job(job, include_log=False))
+
+    def _public_job(self, job, include_log = True):
+        doc = {k:v for k,v in job.items() if not k.startswith('_') or k=='_id'}
+        if not include_log:
+            doc.pop('log', None)
+        return doc
+
+    # Running the server
+    def start(self):
+        handler = _make_handler(self)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if not self.server is None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @property
+    def api_url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}/api/v1'
+
+    def client(self):
+        from girder_client import GirderClient
+        gc = GirderClient(apiUrl=self.api_url)
+        gc.setToken(self.token)
+        return gc
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # Routing requests, returns (status code, JSON payload or XML string)
+    def handle(self, method, path, query, body):
+        with self.lock:
+            if not self.max_concurrent_requests is None and self.requests_in_flight>=self.max_concurrent_requests:
+                self.n_rejected += 1
+                return 503, {'message': 'Server overloaded'}
+            self.requests_in_flight += 1
+        try:
+            return self.route(method, path, query, body)
+        finally:
+            with self.lock:
+                self.requests_in_flight -= 1
+
+    def route(self, method, path, query, body):
+        if self.latency:
+            sleep(self.latency)
+
+        parts = [p for p in path.split('/') if p][2:]
+        q = {k:v[-1] for k,v in query.items()}
+        with self.lock:
+            self.request_log.append((method, '/'.join(parts)))
+
+            if parts[:2]==['slicer_cli_web','cli']:
+                if len(parts)==2 and method=='GET':
+                    return 200, [{k:v for k,v in p.items() if not k=='xml'} for p in self.plugins.values()]
+                plugin = self.plugins.get(parts[2])
+                if plugin is None:
+                    return 400, {'message': 'Invalid plugin id'}
+                if parts[3:]==['xml']:
+                    return 200, plugin['xml']
+                if parts[3:]==['run'] and method=='POST':
+                    job_id = _new_id()
+                    job = {
+                        '_id': job_id,
+                        'title': plugin['name'],
+                        'type': f'{plugin["image"]}#{plugin["name"]}',
+                        'status': 1,
+                        'log': [],
+                        'kwargs': {'inputs': q},
+                        'created': datetime.now(timezone.utc).isoformat(),
+                        'updated': datetime.now(timezone.utc).isoformat(),
+                        'userId': 'mock-user',
+                        '_submitted': time(),
+                        '_started': None,
+                        '_duration': self.job_duration,
+                        '_fail': self.random.random()<self.failure_rate
+                    }
+                    self.jobs[job_id] = job
+                    self._notify('job_created', self._public_job(job, include_log=False))
+                    return 200, self._public_job(job)
+
+            if parts[:1]==['job']:
+                for job in self.jobs.values():
+                    self._advance(job)
+                if len(parts)==1 and method=='GET':
+                    jobs = list(self.jobs.values())
+                    if 'statuses' in q:
+                        statuses = json.loads(q['statuses'])
+                        jobs = [j for j in jobs if j['status'] in statuses]
+                    if 'types' in q:
+                        types = json.loads(q['types'])
+                        jobs = [j for j in jobs if j['type'] in types]
+                    sort = q.get('sort','created')
+                    jobs = sorted(jobs, key=lambda j: j[sort], reverse=int(q.get('sortdir',-1))<0)
+                    offset = int(q.get('offset',0))
+                    limit = int(q.get('limit',50))
+                    jobs = jobs[offset:offset+limit] if limit>0 else jobs[offset:]
+                    return 200, [self._public_job(j, include_log=False) for j in jobs]
+                job = self.jobs.get(parts[1])
+                if job is None:
+                    return 400, {'message': 'Invalid job id'}
+                if len(parts)==2 and method=='GET':
+                    return 200, self._public_job(job)
+                if parts[2:]==['cancel'] and method=='PUT':
+                    if not job['status'] in [3,4,5]:
+                        if not job['_started'] is None:
+                            self.n_running -= 1
+                        job['status'] = 5
+                        self._notify('job_status', self._public_job(job, include_log=False))
+                    return 200, self._public_job(job, include_log=False)
+
+            if parts==['notification'] and method=='GET':
+                for job in self.jobs.values():
+                    self._advance(job)
+                since = q.get('since')
+                events = self.notifications
+                if not since is None:
+                    events = [e for e in events if e['updated']>since]
+                return 200, events
+
+            if parts==['worker','status'] and method=='GET':
+                if self.worker_concurrency is None:
+                    return 400, {'message': 'No workers'}
+                return 200, {'stats': {'mock-worker': {'pool': {'max-concurrency': self.worker_concurrency}}}}
+
+            if parts==['resource','lookup']:
+                target = self.paths.get(q.get('path','').rstrip('/'))
+                if target is None:
+                    # Files can be looked up as children of an item path
+                    item_path = '/'.join(q.get('path','').split('/')[:-1])
+                    item_target = self.paths.get(item_path)
+                    if not item_target is None and item_target[0]=='item':
+                        for f in self.files.values():
+                            if f['itemId']==item_target[1] and f['name']==q['path'].split('/')[-1]:
+                                return 200, f
+                    if q.get('test')=='true':
+                        return 200, None
+                    return 400, {'message': f'Path not found: {q.get("path")}'}
+                model, doc_id = target
+                return 200, self.folders[doc_id] if model=='folder' else self.items[doc_id]
+
+            if parts[:1]==['item']:
+                if len(parts)==1:
+                    items = [i for i in self.items.values() if i['folderId']==q.get('folderId')]
+                    if 'name' in q:
+                        items = [i for i in items if i['name']==q['name']]
+                    offset = int(q.get('offset',0))
+                    limit = int(q.get('limit',50))
+                    return 200, items[offset:offset+limit] if limit>0 else items[offset:]
+                item = self.items.get(parts[1])
+                if item is None:
+                    return 400, {'message': 'Invalid item id'}
+                if len(parts)==2:
+                    return 200, item
+                if parts[2:]==['files']:
+                    files = [f for f in self.files.values() if f['itemId']==parts[1]]
+                    offset = int(q.get('offset',0))
+                    limit = int(q.get('limit',50))
+                    return 200, files[offset:offset+limit] if limit>0 else files[offset:]
+
+            if parts==['annotation']:
+                annotations = [a for a in self.annotations.values() if a['itemId']==q.get('itemId')]
+                if 'name' in q:
+                    annotations = [a for a in annotations if a['annotation']['name']==q['name']]
+                offset = int(q.get('offset',0))
+                limit = int(q.get('limit',50))
+                return 200, annotations[offset:offset+limit] if limit>0 else annotations[offset:]
+
+        return 404, {'message': f'No route for {method} {path}'}
+
+
+def _make_handler(mock):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body are written separately, without this keep-alive clients wait on delayed ACKs
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _dispatch(self, method):
+            parsed = urlparse(self.path)
+            query = parse_qs(parsed.query)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            if method in ['POST','PUT'] and self.headers.get('Content-Type','').startswith('application/x-www-form-urlencoded'):
+                query.update(parse_qs(body.decode()))
+
+            token = self.headers.get('Girder-Token') or query.get('token',[None])[-1]
+            if not token==mock.token:
+                return self._send(401, {'message': 'Not logged in'})
+
+            if parsed.path.endswith('/notification/stream'):
+                return self._stream(query)
+
+            status, payload = mock.handle(method, parsed.path, query, body)
+            self._send(status, payload)
+
+        def _send(self, status, payload):
+            if isinstance(payload, str):
+                data = payload.encode()
+                content_type = 'application/xml'
+            else:
+                data = json.dumps(payload).encode()
+                content_type = 'application/json'
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _stream(self, query):
+            if not mock.notifications_enabled:
+                return self._send(503, {'message': 'The notification stream is not enabled.'})
+            timeout = float(query.get('timeout',[300])[-1])
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            with mock.lock:
+                seen = len(mock.notifications)
+                if 'since' in query:
+                    since = float(query['since'][-1])
+                    seen = next((i for i,e in enumerate(mock.notifications) if e['time']>=since), seen)
+            start = time()
+            try:
+                while time()-start<timeout:
+                    with mock.lock:
+                        for job in mock.jobs.values():
+                            mock._advance(job)
+                        events = mock.notifications[seen:]
+                        seen = len(mock.notifications)
+                    for e in events:
+                        self._chunk(f'data: {json.dumps(dict(e, _girderTime=int(time())))}\n\n'.encode())
+                        start = time()
+                    sleep(0.01)
+                self._chunk(b'')
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+
+        def _chunk(self, data):
+            self.wfile.write(f'{len(data):X}\r\n'.encode() + data + b'\r\n')
+            self.wfile.flush()
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_POST(self):
+            self._dispatch('POST')
+
+        def do_PUT(self):
+            self._dispatch('PUT')
+
+        def do_DELETE(self):
+            self._dispatch('DELETE')
+
+    return Handler
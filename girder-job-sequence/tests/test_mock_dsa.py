@@ -0,0 +1,1200 @@
+"""Testing girder-job-sequence against a local mock DSA server (no DSA instance or credentials needed)
+"""
+
+import os
+import io
+import sys
+import json
+import tempfile
+import contextlib
+import threading
+from time import time, sleep
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from girder_job_sequence.sequence import Sequence
+from girder_job_sequence.utils import from_dict, from_list, get_jobs_info, parse_wildcard, resolve_wildcards, resolve_item_paths, wait_for_wildcard, WildcardNotFound
+from girder_job_sequence.cache import CLICatalog, ResultCache, WildcardCache
+from girder_job_sequence import metrics
+from girder_job_sequence.batch import BatchRunner
+from girder_job_sequence.manifest import iter_manifest, iter_json_array
+from girder_job_sequence.scheduler import PriorityScheduler
+from girder_job_sequence.schema import ValidationError, get_schema
+from girder_job_sequence.transport import AIMDLimiter, configure_transport, get_transport, route_template
+from girder_job_sequence.journal import JSONLJournal, SQLiteJournal
+from girder_job_sequence.supervisor import SequenceQueue, Supervisor, main as supervisor_main
+from girder_job_sequence.wait import BackoffWaiter, NotificationWaiter, SharedPoller, get_shared_poller
+from concurrent.futures import ThreadPoolExecutor
+
+from tests.mock_dsa import MockDSA
+
+
+def test_sequence_runs():
+
+    with MockDSA(job_duration = 0.1) as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+
+        job_sequence = from_list(gc, [
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': 'image_1'}]},
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': 'image_1'}, {'name': 'threshold', 'value': 100}]}
+        ])
+        job_sequence.start(check_interval = 0.05)
+
+        assert [s['Status'] for s in job_sequence.get_status()] == ['SUCCESS', 'SUCCESS']
+        assert len(mock.jobs) == 2
+
+def test_failure_cancels_sequence():
+
+    with MockDSA(job_duration = 0.1, failure_rate = 1.0) as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+
+        job_sequence = from_list(gc, [
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': 'image_1'}]},
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': 'image_2'}]}
+        ])
+        job_sequence.start(check_interval = 0.05, cancel_on_error = True)
+
+        # The second job is never submitted
+        assert len(mock.jobs) == 1
+
+def test_wildcard_cache():
+
+    with MockDSA() as mock:
+        gc = mock.client()
+        item_id = mock.add_item('/collection/test/image.svs')
+        file_id = mock.add_file(item_id, 'image.svs')
+        wildcard = "{{'type':'file','item_type':'path','item_query':'/collection/test/image.svs','file_type':'fileName','file_query':'image.svs'}}"
+
+        cache = WildcardCache(types = ['item','folder','file','annotation'])
+        assert resolve_wildcards(gc, [wildcard], cache = cache) == {wildcard: file_id}
+
+        n_requests = len(mock.request_log)
+        resolve_wildcards(gc, [wildcard], cache = cache)
+        assert len(mock.request_log) == n_requests
+
+def test_metrics():
+
+    with MockDSA(job_duration = 0.1) as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+
+        job_sequence = from_list(gc, [
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': 'image_1'}]},
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': 'image_2'}]}
+        ])
+        recorder = metrics.add_hook(metrics.MetricsRecorder())
+        try:
+            job_sequence.start(check_interval = 0.05)
+        finally:
+            metrics.remove_hook(recorder)
+
+        summaries = {(s['kind'], s['operation']): s for s in recorder.to_dict() if s['sequence_id']==job_sequence.id}
+        assert summaries[('request','start')]['count'] == 2
+        assert summaries[('request','status')]['bytes_received'] > 0
+        assert summaries[('span','wait')]['count'] == 2
+        assert f'girder_job_sequence_request_seconds_count{{operation="start",sequence_id="{job_sequence.id}"}} 2' in recorder.to_prometheus()
+
+        # Nothing is recorded after the hook is removed
+        n_events = sum([s['count'] for s in recorder.to_dict()])
+        job_sequence.get_status()
+        assert sum([s['count'] for s in recorder.to_dict()]) == n_events
+
+def test_lazy_construction():
+
+    with MockDSA() as mock:
+        plugin_ids = [mock.add_plugin('dsarchive/mock:latest', f'MockPlugin{i}') for i in range(3)]
+        gc = mock.client()
+        job_list = [
+            {'plugin_id': plugin_ids[i%3], 'input_args': [{'name': 'input_image', 'value': f'image_{i}'}]}
+            for i in range(12)
+        ]
+
+        job_sequence = from_list(gc, job_list, lazy = True)
+        assert len(mock.request_log) == 0
+
+        # Each plugin's XML is fetched once
+        job_sequence.validate()
+        assert len([r for r in mock.request_log if r[1].endswith('/xml')]) == 3
+
+        job_sequence = from_list(gc, job_list + [{'docker_image': 'dsarchive/mock:latest', 'cli': 'MockPlugin0', 'input_args': []}])
+        assert all([j.resolved for j in job_sequence.jobs])
+        assert job_sequence.jobs[-1].plugin_id == plugin_ids[0]
+
+def test_manifest():
+
+    records = [
+        [{'plugin_id': 'a', 'input_args': [{'name': 'input_image', 'value': f'image_{i}'}]}]
+        for i in range(20)
+    ]
+    # Elements are read one at a time even if they span several chunks
+    assert list(iter_json_array(io.StringIO(json.dumps(records, indent = 2)), chunk_size = 7)) == records
+    assert list(iter_json_array(io.StringIO('[1, 22.5, "x", null]'), chunk_size = 2)) == [1, 22.5, 'x', None]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open(os.path.join(tmp_dir, 'manifest.jsonl'), 'w') as f:
+            f.write('\n'.join([json.dumps({'name': f'seq_{i}', 'jobs': r}) for i,r in enumerate(records)]) + '\n\n')
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+            json.dump(records, f)
+        with open(os.path.join(tmp_dir, 'sequence.json'), 'w') as f:
+            json.dump([r[0] for r in records], f)
+        with open(os.path.join(tmp_dir, 'manifest.yaml'), 'w') as f:
+            f.write('\n---\n'.join([json.dumps({'jobs': r}) for r in records]))
+
+        assert [r['name'] for r in iter_manifest(os.path.join(tmp_dir, 'manifest.jsonl'))] == [f'seq_{i}' for i in range(20)]
+        assert [r['jobs'] for r in iter_manifest(os.path.join(tmp_dir, 'manifest.json'))] == records
+        assert [r['jobs'] for r in iter_manifest(os.path.join(tmp_dir, 'manifest.yaml'))] == records
+        # An array of jobs is one sequence
+        assert len(list(iter_manifest(os.path.join(tmp_dir, 'sequence.json')))) == 1
+
+        with MockDSA(job_duration = 0.05) as mock:
+            plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+            gc = mock.client()
+            with open(os.path.join(tmp_dir, 'batch.jsonl'), 'w') as f:
+                for i in range(6):
+                    f.write(json.dumps({'name': f'seq_{i}', 'jobs': [{'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f'image_{i}'}]}]}) + '\n')
+
+            batch = BatchRunner.from_manifest(gc, os.path.join(tmp_dir, 'batch.jsonl'), max_sequences = 3, start_kwargs = {'check_interval': 0.05})
+            summary = batch.run()
+
+            assert summary['Succeeded'] == 6
+            assert sorted([r['Item'] for r in batch.results]) == [f'seq_{i}' for i in range(6)]
+
+def test_priority_scheduler():
+
+    with MockDSA(job_duration = 0.2, worker_concurrency = 1) as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+        scheduler = PriorityScheduler(gc, refresh_interval = 0.05)
+
+        # Holding the only worker slot while other jobs wait
+        held = scheduler.slots(tenant = 'research')
+        held.acquire()
+        assert scheduler.capacity == 1
+
+        released = []
+        def wait_for_slot(priority, tenant, name):
+            slots = scheduler.slots(priority, tenant)
+            slots.acquire()
+            released.append(name)
+            slots.release()
+
+        threads = []
+        for priority, tenant, name in [(10, 'research', 'bulk_1'), (10, 'research', 'bulk_2'), (0, 'clinical', 'urgent')]:
+            threads.append(threading.Thread(target = wait_for_slot, args = (priority, tenant, name)))
+            threads[-1].start()
+            sleep(0.05)
+
+        held.release()
+        for t in threads:
+            t.join()
+        assert released == ['urgent', 'bulk_1', 'bulk_2']
+
+        # Sequences sharing the scheduler never have more than one job on the server
+        job_sequences = [
+            from_list(gc, [{'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f'image_{i}_{j}'}]} for j in range(2)])
+            for i in range(3)
+        ]
+        threads = []
+        for job_sequence in job_sequences:
+            job_sequence.job_slots = scheduler.slots(tenant = 'research')
+            threads.append(threading.Thread(target = job_sequence.start, kwargs = {'check_interval': 0.05}))
+            threads[-1].start()
+        for t in threads:
+            t.join()
+
+        submitted = sorted([j['_submitted'] for j in mock.jobs.values()])
+        finished = sorted([j['_started'] + j['_duration'] for j in mock.jobs.values()])
+        assert all([s>=f for s,f in zip(submitted[1:], finished[:-1])])
+
+def test_adaptive_concurrency():
+
+    limiter = AIMDLimiter(max_limit = 8, cooldown = 0)
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release(0.01)
+    limiter.acquire()
+    limiter.release(0.01, overloaded = True)
+    assert limiter.limit == 4
+    # Latency spikes also back off (at most once per average latency)
+    sleep(0.02)
+    limiter.acquire()
+    limiter.release(1.0)
+    assert limiter.limit == 2
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release(0.01)
+    assert limiter.limit == 8
+
+    with MockDSA(latency = 0.02, max_concurrent_requests = 4) as mock:
+        gc = mock.client()
+        transport = configure_transport(gc, pool_size = 16, backoff_factor = 0.01, max_retries = 10)
+        with ThreadPoolExecutor(max_workers = 16) as executor:
+            responses = list(executor.map(lambda i: transport.request('GET', '/job').status_code, range(200)))
+
+        assert all([r==200 for r in responses])
+        assert mock.n_rejected > 0
+        assert transport.limiter.n_decreases > 0
+
+def test_wildcard_readiness():
+
+    with MockDSA(job_duration = 0.3) as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+        wildcard = "{{'type':'file','item_type':'path','item_query':'/collection/test/output.svs','file_type':'fileName','file_query':'output.csv'}}"
+
+        try:
+            wait_for_wildcard(gc, wildcard, timeout = 0.2)
+            assert False
+        except WildcardNotFound:
+            pass
+
+        job_sequence = from_list(gc, [
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': 'image_1'}]},
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': wildcard}]}
+        ])
+
+        # The first job's output is uploaded a while after it finishes
+        def upload_output():
+            sleep(mock.queue_time + mock.job_duration + 0.5)
+            with mock.lock:
+                item_id = mock.add_item('/collection/test/output.svs')
+                upload_output.file_id = mock.add_file(item_id, 'output.csv')
+                upload_output.uploaded = time()
+
+        uploader = threading.Thread(target = upload_output)
+        uploader.start()
+        states = job_sequence.start(check_interval = 0.05, wildcard_timeout = 5)
+        uploader.join()
+
+        assert states == ['SUCCESS', 'SUCCESS']
+        second_job = mock.jobs[job_sequence.jobs[1].job_id]
+        assert second_job['kwargs']['inputs']['input_image'] == upload_output.file_id
+        # Submitted right after the output appeared instead of failing or waiting a fixed time
+        assert second_job['_submitted'] - upload_output.uploaded < 1.0
+
+def test_item_index():
+
+    with MockDSA() as mock:
+        gc = mock.client()
+        item_id = mock.add_item('/collection/test/image.svs')
+        file_ids = {f'tile_{i}.png': mock.add_file(item_id, f'tile_{i}.png') for i in range(120)}
+        annotation_id = mock.add_annotation(item_id, 'Nuclei')
+        for i in range(30):
+            mock.add_annotation(item_id, f'Other {i}')
+
+        def file_wildcard(name, item_type = '_id'):
+            item_query = item_id if item_type=='_id' else '/collection/test/image.svs'
+            return f"{{{{'type':'file','item_type':'{item_type}','item_query':'{item_query}','file_type':'fileName','file_query':'{name}'}}}}"
+
+        def n_listings(path):
+            return len([r for r in mock.request_log if r[1]==path])
+
+        # Without a cache files in items referenced by path are looked up directly
+        assert resolve_wildcards(gc, [file_wildcard('tile_3.png', 'path')]) == {file_wildcard('tile_3.png', 'path'): file_ids['tile_3.png']}
+        assert n_listings(f'item/{item_id}/files') == 0
+
+        # Listing stops at the first page containing the file and later lookups reuse it
+        cache = WildcardCache()
+        assert parse_wildcard(gc, file_wildcard('tile_3.png'), cache) == file_ids['tile_3.png']
+        assert parse_wildcard(gc, file_wildcard('tile_10.png'), cache) == file_ids['tile_10.png']
+        assert n_listings(f'item/{item_id}/files') == 1
+        assert parse_wildcard(gc, file_wildcard('tile_110.png'), cache) == file_ids['tile_110.png']
+        assert n_listings(f'item/{item_id}/files') == 3
+
+        # Files uploaded by a job are found without listing the earlier ones again
+        new_file_id = mock.add_file(item_id, 'tile_3.png')
+        assert parse_wildcard(gc, file_wildcard('tile_3.png'), cache) == file_ids['tile_3.png']
+        cache.mark_stale()
+        assert parse_wildcard(gc, file_wildcard('tile_3.png'), cache) == new_file_id
+        assert n_listings(f'item/{item_id}/files') == 4
+        assert cache.item_index(gc, item_id, 'file').offset == 121
+
+        try:
+            parse_wildcard(gc, file_wildcard('missing.png'), cache)
+            assert False
+        except WildcardNotFound:
+            pass
+
+        annotation_wildcard = f"{{{{'type':'annotation','item_type':'_id','item_query':'{item_id}','annotation_type':'annotationName','annotation_query':'Nuclei'}}}}"
+        assert parse_wildcard(gc, annotation_wildcard, cache) == annotation_id
+        assert parse_wildcard(gc, annotation_wildcard, cache) == annotation_id
+        assert n_listings('annotation') == 1
+
+def test_batched_paths():
+
+    with MockDSA() as mock:
+        gc = mock.client()
+        item_ids = {f'/collection/test/slides/slide_{i}.svs': mock.add_item(f'/collection/test/slides/slide_{i}.svs') for i in range(300)}
+        other_id = mock.add_item('/collection/test/other/model.pt')
+        paths = [f'/collection/test/slides/slide_{i}.svs' for i in range(0, 300, 3)] + ['/collection/test/other/model.pt', '/collection/test/slides/missing.svs']
+
+        found = resolve_item_paths(gc, paths, page_size = 100)
+        assert found == dict({p: item_ids[p] for p in paths[:-2]}, **{'/collection/test/other/model.pt': other_id})
+        # One folder lookup and every page of the slides folder (one slide is missing), one path lookup for the model
+        assert len([r for r in mock.request_log if r[1]=='resource/lookup']) == 2
+        assert len([r for r in mock.request_log if r[1]=='item']) == 4
+
+        template = [{
+            'plugin_id': 'none',
+            'input_args': [{'name': 'input_image', 'value': "{{'type':'item','item_type':'path','item_query':'${item}'}}"}]
+        }]
+        batch = BatchRunner(gc, template, list(item_ids)[:50])
+        n_requests = len(mock.request_log)
+        assert batch.prefetch_paths(batch.items) == 50
+        assert len(mock.request_log) - n_requests == 2
+
+        # Sequences in the batch find their items in the shared cache
+        wildcard = "{{'type':'item','item_type':'path','item_query':'/collection/test/slides/slide_7.svs'}}"
+        assert parse_wildcard(gc, wildcard, batch.wildcard_cache) == item_ids['/collection/test/slides/slide_7.svs']
+        assert len(mock.request_log) - n_requests == 2
+
+def test_pipeline():
+
+    with MockDSA(job_duration = 0.5) as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+        item_ids = [mock.add_item(f'/collection/test/image_{i}.svs') for i in range(2)]
+
+        def run(pipeline):
+            job_sequence = from_list(gc, [
+                {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': 'image'}]}
+            ] + [
+                {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f"{{{{'type':'item','item_type':'path','item_query':'/collection/test/image_{i}.svs'}}}}"}]}
+                for i in range(2)
+            ], lazy = True)
+
+            lookup_times = []
+            hook = metrics.add_hook(lambda e: lookup_times.append(e['time']) if e['operation']=='wildcard' else None)
+            try:
+                states = job_sequence.start(check_interval = 0.05, prefetch_wildcards = False, probe_wildcards = False, validate = False, pipeline = pipeline)
+            finally:
+                metrics.remove_hook(hook)
+
+            assert states == ['SUCCESS', 'SUCCESS', 'SUCCESS']
+            assert [mock.jobs[j.job_id]['kwargs']['inputs']['input_image'] for j in job_sequence.jobs[1:]] == item_ids
+            first_job = mock.jobs[job_sequence.jobs[0].job_id]
+            return min(lookup_times) < first_job['_started'] + first_job['_duration']
+
+        # The second job's item is looked up while the first job runs instead of after it finishes
+        assert run(pipeline = True)
+        assert not run(pipeline = False)
+
+def test_supervisor():
+
+    with MockDSA(job_duration = 0.2) as mock, tempfile.TemporaryDirectory() as tmp_dir:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+        queue_path = os.path.join(tmp_dir, 'queue.db')
+
+        manifest_path = os.path.join(tmp_dir, 'manifest.jsonl')
+        with open(manifest_path, 'w') as f:
+            for i in range(4):
+                f.write(json.dumps({'name': f'slide_{i}', 'jobs': [
+                    {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f'slide_{i}'}]},
+                    {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f'slide_{i}_mask'}]}
+                ]}) + '\n')
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            assert supervisor_main(['submit', '--queue', queue_path, manifest_path]) == 0
+        sequence_ids = output.getvalue().split()
+        assert len(sequence_ids) == 4
+
+        queue = SequenceQueue(queue_path)
+        # Queued sequences are canceled without running
+        assert queue.request_cancel(sequence_ids[-1])
+        assert queue.get(sequence_ids[-1])['state'] == 'canceled'
+
+        supervisor = Supervisor(gc, queue, max_sequences = 2, poll_interval = 0.05, check_interval = 0.05)
+        runner = threading.Thread(target = supervisor.run, daemon = True)
+        runner.start()
+        try:
+            start_time = time()
+            while queue.counts()['succeeded']<3 and time()-start_time<20:
+                sleep(0.05)
+        finally:
+            supervisor.stop()
+            runner.join()
+
+        assert [queue.get(i)['state'] for i in sequence_ids] == ['succeeded']*3 + ['canceled']
+        assert queue.get(sequence_ids[0])['job_states'] == ['SUCCESS','SUCCESS']
+        # Every sequence waited on its jobs through the same poller
+        assert get_shared_poller(gc).n_checks > 0
+        assert len([j for j in mock.jobs.values() if j['kwargs']['inputs']['input_image'].startswith('slide_3')]) == 0
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            assert supervisor_main(['status', '--queue', queue_path]) == 0
+        assert json.loads(output.getvalue())['counts']['succeeded'] == 3
+
+        # A sequence left running by a stopped supervisor is resumed without submitting its finished jobs again
+        sequence_id = queue.submit([
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': 'resumed'}]},
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': 'resumed_mask'}]}
+        ])
+        record = queue.claim()
+        assert record['id'] == sequence_id
+        interrupted = Sequence(gc, [from_dict(gc, j) for j in record['jobs']], journal = supervisor.journal)
+        interrupted.id = sequence_id
+        interrupted.jobs = interrupted.jobs[:1]
+        interrupted.journal_record('sequence_started', mode = 'linear', jobs = record['jobs'])
+        interrupted.run_linear(check_interval = 0.05)
+        n_jobs = len(mock.jobs)
+
+        supervisor = Supervisor(gc, queue, poll_interval = 0.05, check_interval = 0.05)
+        runner = threading.Thread(target = supervisor.run, daemon = True)
+        runner.start()
+        try:
+            start_time = time()
+            while queue.get(sequence_id)['state']=='running' and time()-start_time<20:
+                sleep(0.05)
+        finally:
+            supervisor.stop()
+            runner.join()
+
+        assert queue.get(sequence_id)['state'] == 'succeeded'
+        assert len(mock.jobs) == n_jobs + 1
+        queue.close()
+
+def test_status_check_cost():
+
+    with MockDSA(job_duration = 0.1) as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+
+        jobs = from_list(gc, [
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f'image_{i}'}]}
+            for i in range(3)
+        ]).jobs
+        for job in jobs:
+            job.start()
+
+        # One request for the job document per status check
+        job = jobs[0]
+        job.measure_bytes = True
+        n_requests = len(mock.request_log)
+        assert job.get_status() in ['QUEUED','RUNNING']
+        assert mock.request_log[n_requests:] == [('GET', f'job/{job.job_id}')]
+        assert job.status_bytes[-1] == job.fetch_status_info(light = False)[1]
+        assert job.status_bytes[-1] < job.fetch_status_info(light = True)[1]
+
+def test_shared_poller_errors():
+
+    with MockDSA(job_duration = 0.1) as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+
+        jobs = from_list(gc, [
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f'image_{i}'}]}
+            for i in range(2)
+        ]).jobs
+        jobs[0].start()
+        # A job that was deleted from the server
+        jobs[1].start()
+        with mock.lock:
+            del mock.jobs[jobs[1].job_id]
+
+        errors = {}
+        jobs_info = get_jobs_info(gc, [j.job_id for j in jobs], errors = errors)
+        assert list(jobs_info) == [jobs[0].job_id] and list(errors) == [jobs[1].job_id]
+
+        poller = SharedPoller(gc, check_interval = 0.05, max_failures = 3)
+        with ThreadPoolExecutor(max_workers = 2) as executor:
+            statuses = list(executor.map(lambda j: poller.wait(j, timeout = 10), jobs))
+
+        # Waiters of the deleted job are released instead of waiting forever
+        assert statuses == ['SUCCESS', 'ERROR']
+        assert list(poller.failed) == [jobs[1].job_id]
+
+def test_supervisor_resume():
+
+    with MockDSA(job_duration = 0.2) as mock, tempfile.TemporaryDirectory() as tmp_dir:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+        queue = SequenceQueue(os.path.join(tmp_dir, 'queue.db'))
+        journal = SQLiteJournal(queue.path)
+
+        # A supervisor crashed after the first job of each of these sequences finished
+        sequence_ids = []
+        for i in range(5):
+            jobs = [
+                {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f'slide_{i}'}]},
+                {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f'slide_{i}_mask'}]}
+            ]
+            sequence_id = queue.submit(jobs)
+            assert queue.claim()['id'] == sequence_id
+            interrupted = Sequence(gc, [from_dict(gc, jobs[0])], journal = journal)
+            interrupted.id = sequence_id
+            interrupted.journal_record('sequence_started', mode = 'linear', jobs = jobs)
+            assert interrupted.run_linear(check_interval = 0.05) == ['SUCCESS']
+            sequence_ids.append(sequence_id)
+        n_jobs = len(mock.jobs)
+
+        supervisor = Supervisor(gc, queue, max_sequences = 2, poll_interval = 0.02, check_interval = 0.05)
+        runner = threading.Thread(target = supervisor.run, daemon = True)
+        runner.start()
+        max_threads = 0
+        try:
+            start_time = time()
+            while queue.counts()['succeeded']<5 and time()-start_time<20:
+                max_threads = max(max_threads, len(supervisor.threads))
+                sleep(0.01)
+        finally:
+            supervisor.stop()
+            runner.join()
+
+        assert [queue.get(i)['state'] for i in sequence_ids] == ['succeeded']*5
+        # Only the second job of each sequence was submitted, at most max_sequences sequences at a time
+        assert len(mock.jobs) == n_jobs + 5
+        assert sorted([j['kwargs']['inputs']['input_image'] for j in list(mock.jobs.values())[n_jobs:]]) == sorted([f'slide_{i}_mask' for i in range(5)])
+        assert 0 < max_threads <= 2
+        journal.close()
+        queue.close()
+
+
+def test_wildcard_timeout_scope():
+
+    with MockDSA(job_duration = 0.2) as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+        item_id = mock.add_item('/collection/test/image.svs')
+        typo = "{{'type':'file','item_type':'path','item_query':'/collection/test/imgae.svs','file_type':'fileName','file_query':'image.svs'}}"
+        output = "{{'type':'file','item_type':'path','item_query':'/collection/test/image.svs','file_type':'fileName','file_query':'output.csv'}}"
+
+        # A missing target in the first job cannot be an upstream output so it fails without waiting
+        job_sequence = from_list(gc, [
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': typo}]},
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': output}]}
+        ])
+        started = time()
+        try:
+            job_sequence.start(check_interval = 0.05, wildcard_timeout = 30, validate = False)
+            assert False
+        except WildcardNotFound:
+            pass
+        assert time() - started < 5
+        assert [j.wildcard_timeout for j in job_sequence.jobs] == [0, 30]
+        assert len(mock.jobs) == 0
+
+        # Outputs of the first job are waited for, checking only once it succeeded when probing
+        job_sequence = from_list(gc, [
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': 'image_1'}]},
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': output}]}
+        ])
+
+        def upload_output():
+            sleep(mock.queue_time + mock.job_duration + 0.3)
+            with mock.lock:
+                upload_output.file_id = mock.add_file(item_id, 'output.csv')
+
+        uploader = threading.Thread(target = upload_output)
+        uploader.start()
+        states = job_sequence.start(check_interval = 0.05, wildcard_timeout = 5, probe_wildcards = True)
+        uploader.join()
+
+        assert states == ['SUCCESS', 'SUCCESS']
+        assert mock.jobs[job_sequence.jobs[1].job_id]['kwargs']['inputs']['input_image'] == upload_output.file_id
+
+def test_mixed_endpoint_latency():
+
+    assert route_template('get', 'item/0123456789abcdef01234567/files') == 'GET /item/{id}/files'
+
+    # A slow endpoint is compared to its own average latency instead of that of faster ones
+    limiter = AIMDLimiter(max_limit = 8, cooldown = 0, latency_floor = 0.05)
+    fast_route, slow_route = route_template('GET', '/job/0123456789abcdef01234567'), route_template('GET', '/item/0123456789abcdef01234567/files')
+    for _ in range(50):
+        limiter.acquire()
+        limiter.release(0.001, route = fast_route)
+        limiter.acquire()
+        limiter.release(0.1, route = slow_route)
+    assert limiter.n_decreases == 0
+    assert limiter.limit == 8
+
+    # A spike on either route still backs off
+    limiter.acquire()
+    limiter.release(0.5, route = fast_route)
+    assert limiter.limit == 4
+    # At most once per average latency
+    sleep(0.15)
+    limiter.acquire()
+    limiter.release(5.0, route = slow_route)
+    assert limiter.limit == 2
+
+def test_journal_resume():
+
+    with MockDSA(job_duration = 0.1) as mock, tempfile.TemporaryDirectory() as tmp_dir:
+        mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        other_plugin_id = mock.add_plugin('dsarchive/mock:latest', 'OtherPlugin')
+        gc = mock.client()
+        journal = JSONLJournal(os.path.join(tmp_dir, 'journal.jsonl'))
+        jobs = [
+            {'docker_image': 'dsarchive/mock:latest', 'cli': 'MockPlugin', 'input_args': [{'name': 'input_image', 'value': f'slide_{i}'}]}
+            for i in range(2)
+        ]
+
+        job_sequence = Sequence(gc, [from_dict(gc, j, lazy = True) for j in jobs], journal = journal)
+        assert job_sequence.start(check_interval = 0.05) == ['SUCCESS', 'SUCCESS']
+        n_jobs = len(mock.jobs)
+
+        # Jobs that are not resolved yet are compared by their plugin and nothing that succeeded is submitted again
+        resumed = Sequence(gc, [from_dict(gc, j, lazy = True) for j in jobs])
+        assert resumed.resume(journal, check_interval = 0.05) == ['SUCCESS', 'SUCCESS']
+        assert resumed.id == job_sequence.id
+        assert [j.job_id for j in resumed.jobs] == [j.job_id for j in job_sequence.jobs]
+        assert Sequence.from_journal(gc, journal).resume(journal, check_interval = 0.05) == ['SUCCESS', 'SUCCESS']
+        assert len(mock.jobs) == n_jobs
+
+        try:
+            Sequence(gc, [from_dict(gc, jobs[0]), from_dict(gc, {'plugin_id': other_plugin_id})]).resume(journal)
+            assert False
+        except ValueError as e:
+            assert 'do not match' in str(e)
+        for resume_missing in [lambda: Sequence.from_journal(gc, journal, 'missing'), lambda: resumed.resume(journal, 'missing')]:
+            try:
+                resume_missing()
+                assert False
+            except LookupError:
+                pass
+        assert len(mock.jobs) == n_jobs
+        journal.close()
+
+def test_async_status():
+
+    try:
+        import httpx
+    except ImportError:
+        import pytest
+        pytest.skip('httpx is not installed')
+
+    import asyncio
+    from girder_job_sequence.aio import AsyncJob, AsyncSequence, get_async_transport
+
+    def n_status_requests(mock, job_ids):
+        return len([r for r in mock.request_log if r[0]=='GET' and r[1] in [f'job/{i}' for i in job_ids]])
+
+    for notifications in [True, False]:
+        with MockDSA(job_duration = 0.3, log_lines = 200, notifications = notifications) as mock:
+            plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+            gc = mock.client()
+
+            async def run():
+                jobs = [AsyncJob(from_dict(gc, {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f'slide_{i}'}]})) for i in range(2)]
+                async_sequence = AsyncSequence(gc, jobs)
+                try:
+                    states = await async_sequence.run(check_interval = 0.05)
+                    job_ids = [j.job_id for j in jobs]
+                    n_requests = n_status_requests(mock, job_ids)
+                    statuses = await async_sequence.get_status()
+                    # Polling for a finished job without downloading its log
+                    light_status = await AsyncJob(jobs[0].job).get_status(light = True)
+                    return states, statuses, light_status, n_status_requests(mock, job_ids) - n_requests
+                finally:
+                    await get_async_transport(gc).aclose()
+
+            states, statuses, light_status, n_requests = asyncio.run(run())
+            assert states == ['SUCCESS', 'SUCCESS']
+            assert [s['Status'] for s in statuses] == ['SUCCESS', 'SUCCESS']
+            assert light_status == 'SUCCESS'
+            if notifications:
+                # Statuses seen on the notification stream are not requested again
+                assert n_requests == 0
+            else:
+                # Without the stream every status is requested, the light check through the job listing
+                assert n_requests == 2
+
+def test_cli_catalog():
+
+    with MockDSA() as mock, tempfile.TemporaryDirectory() as tmp_dir:
+        plugin_ids = [mock.add_plugin('dsarchive/mock:latest', f'MockPlugin{i}') for i in range(3)]
+        gc = mock.client()
+        catalog = CLICatalog(max_size = 2, cache_dir = tmp_dir)
+
+        def n_listings():
+            return len([r for r in mock.request_log if r[1]=='slicer_cli_web/cli'])
+
+        # One listing is shared by every plugin lookup
+        for i in range(3):
+            assert catalog.get_plugin_info(gc, 'dsarchive/mock:latest', f'MockPlugin{i}')['_id'] == plugin_ids[i]
+        assert n_listings() == 1
+        assert catalog.get_plugin_info(gc, 'dsarchive/mock:latest', 'Missing') is None
+
+        loads = []
+        def loader(plugin_id):
+            return lambda: loads.append(plugin_id) or {'title': plugin_id}
+
+        for plugin_id in plugin_ids[:2] + plugin_ids[:2]:
+            catalog.get_executable(gc, plugin_id, loader(plugin_id))
+        assert loads == plugin_ids[:2]
+
+        # The least recently used executable is evicted past max_size
+        catalog.get_executable(gc, plugin_ids[2], loader(plugin_ids[2]))
+        catalog.get_executable(gc, plugin_ids[0], loader(plugin_ids[0]))
+        assert loads == plugin_ids + plugin_ids[:1]
+
+        # Plugins updated on the server are fetched again after the listing is refreshed
+        mock.plugins[plugin_ids[2]]['updated'] = 'later'
+        catalog.refresh(gc)
+        catalog.get_executable(gc, plugin_ids[2], loader(plugin_ids[2]))
+        assert loads == plugin_ids + plugin_ids[:1] + plugin_ids[2:]
+
+        # Persisted catalogs are read by other processes without any requests
+        n_requests = len(mock.request_log)
+        other = CLICatalog(cache_dir = tmp_dir)
+        assert other.get_plugin_info(gc, 'dsarchive/mock:latest', 'MockPlugin1')['_id'] == plugin_ids[1]
+        assert other.get_executable(gc, plugin_ids[0], loader('unused')) == {'title': plugin_ids[0]}
+        assert len(mock.request_log) == n_requests
+
+def test_transport():
+
+    with MockDSA(job_duration = 0.1) as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+        transport = configure_transport(gc, backoff_factor = 0, max_retries = 2, adaptive = False)
+        assert get_transport(gc) is transport
+
+        # The token is sent in a header instead of the url
+        response = transport.request('GET', '/job')
+        assert response.request.headers['Girder-Token'] == mock.token
+        assert not 'token' in response.request.url
+
+        # Jobs and sequences reuse the pooled keep-alive connections
+        job_sequence = from_list(gc, [
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f'image_{i}'}]}
+            for i in range(2)
+        ])
+        assert job_sequence.start(check_interval = 0.05, pipeline = False) == ['SUCCESS', 'SUCCESS']
+        pool = transport.session.get_adapter(mock.api_url).poolmanager.connection_from_url(mock.api_url)
+        assert pool.num_connections <= 2 < len(mock.request_log)
+
+        handle = mock.handle
+        def fail_first(status_code, n_failures):
+            failures = []
+            def failing_handle(method, path, query, body):
+                if len(failures)<n_failures:
+                    failures.append(method)
+                    return status_code, {'message': 'Server error'}
+                return handle(method, path, query, body)
+            mock.handle = failing_handle
+            return failures
+
+        # Server errors are retried for idempotent requests
+        failures = fail_first(500, 2)
+        assert transport.request('GET', '/job').status_code == 200
+        assert len(failures) == 2
+
+        # Job submissions are only retried when the server did not process them
+        failures = fail_first(500, 1)
+        assert transport.request('POST', f'/slicer_cli_web/cli/{plugin_id}/run').status_code == 500
+        assert len(failures) == 1
+        failures = fail_first(503, 1)
+        assert transport.request('POST', f'/slicer_cli_web/cli/{plugin_id}/run').status_code == 200
+        assert len(failures) == 1
+        mock.handle = handle
+
+def test_wait_strategies():
+
+    def n_status_checks(mock, job_sequence):
+        return len([r for r in mock.request_log if r[0]=='GET' and r[1] in [f'job/{j.job_id}' for j in job_sequence.jobs]])
+
+    for notifications in [True, False]:
+        with MockDSA(job_duration = 0.3, notifications = notifications) as mock:
+            plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+            gc = mock.client()
+            job_sequence = from_list(gc, [
+                {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f'image_{i}'}]}
+                for i in range(2)
+            ])
+
+            waiter = NotificationWaiter(gc, fallback = BackoffWaiter(initial_interval = 0.05, max_interval = 0.2))
+            start_time = time()
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                states = job_sequence.start(check_interval = 5, wait_strategy = waiter)
+
+            assert states == ['SUCCESS', 'SUCCESS']
+            # Finished jobs are noticed right away instead of after check_interval
+            assert time() - start_time < 3
+            assert waiter.available == notifications
+            if notifications:
+                # Status changes are pushed, the status is only checked when each job starts waiting
+                assert n_status_checks(mock, job_sequence) == 2
+            else:
+                assert 'falling back to polling' in output.getvalue()
+
+    # Backoff checks less often than a fixed interval while a job keeps the same status
+    with MockDSA(job_duration = 1.0) as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+        checks = {}
+        for wait_strategy in ['poll', 'backoff']:
+            job_sequence = Sequence(gc, [from_dict(gc, {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': 'image_1'}]})])
+            assert job_sequence.start(check_interval = 0.05 if wait_strategy=='poll' else 0.4, wait_strategy = wait_strategy) == ['SUCCESS']
+            checks[wait_strategy] = n_status_checks(mock, job_sequence)
+        assert checks['backoff'] < checks['poll']/2
+
+def test_dag_mode():
+
+    with MockDSA(job_duration = 0.3) as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        failing_plugin_id = mock.add_plugin('dsarchive/mock:latest', 'FailingPlugin')
+        gc = mock.client()
+
+        # Jobs of FailingPlugin always fail
+        handle = mock.handle
+        def failing_handle(method, path, query, body):
+            status, payload = handle(method, path, query, body)
+            if method=='POST' and failing_plugin_id in path:
+                mock.jobs[payload['_id']]['_fail'] = True
+            return status, payload
+        mock.handle = failing_handle
+
+        def make_sequence(b_plugin_id):
+            return from_list(gc, [
+                {'plugin_id': plugin_id, 'name': 'a', 'input_args': [{'name': 'input_image', 'value': 'image_a'}]},
+                {'plugin_id': b_plugin_id, 'name': 'b', 'input_args': [{'name': 'input_image', 'value': 'image_b'}]},
+                {'plugin_id': plugin_id, 'name': 'c', 'depends_on': ['a','b'], 'input_args': [{'name': 'input_image', 'value': 'image_c'}]},
+                {'plugin_id': plugin_id, 'depends_on': [2], 'input_args': [{'name': 'input_image', 'value': 'image_d'}]}
+            ])
+
+        job_sequence = make_sequence(plugin_id)
+        assert job_sequence.start(check_interval = 0.05, mode = 'dag', max_concurrent = 2) == ['SUCCESS']*4
+        a, b, c, d = [mock.jobs[j.job_id] for j in job_sequence.jobs]
+        # Independent jobs run at the same time and the others start once all of their dependencies finished
+        assert abs(a['_submitted'] - b['_submitted']) < mock.job_duration
+        assert c['_submitted'] >= max(a['_started'], b['_started']) + mock.job_duration
+        assert d['_submitted'] >= c['_started'] + mock.job_duration
+
+        # Jobs downstream of a failed job are skipped, others still run
+        n_jobs = len(mock.jobs)
+        job_sequence = make_sequence(failing_plugin_id)
+        assert job_sequence.start(check_interval = 0.05, mode = 'dag', max_concurrent = 2) == ['SUCCESS', 'ERROR', 'SKIPPED', 'SKIPPED']
+        assert len(mock.jobs) == n_jobs + 2
+
+        # Unless errors are not canceling
+        job_sequence = make_sequence(failing_plugin_id)
+        assert job_sequence.start(check_interval = 0.05, mode = 'dag', cancel_on_error = False) == ['SUCCESS', 'ERROR', 'SUCCESS', 'SUCCESS']
+        mock.handle = handle
+
+        try:
+            from_list(gc, [
+                {'plugin_id': plugin_id, 'name': 'a', 'depends_on': ['b']},
+                {'plugin_id': plugin_id, 'name': 'b', 'depends_on': ['a']}
+            ]).get_dependencies()
+            assert False
+        except AssertionError as e:
+            assert 'cycle' in str(e).lower()
+
+def test_batch_runner():
+
+    with MockDSA(job_duration = 0.1) as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+        item_ids = {f'slide_{i}.svs': mock.add_item(f'/collection/Slides/slide_{i}.svs') for i in range(8)}
+        template = [
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': "{{'type':'item','item_type':'path','item_query':'/collection/Slides/${item}'}}"}]},
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': '${item}'}, {'name': 'threshold', 'value': 10}]}
+        ]
+
+        class CountingSlots:
+            def __init__(self, n):
+                self.semaphore = threading.BoundedSemaphore(n)
+                self.lock = threading.Lock()
+                self.held = 0
+                self.max_held = 0
+
+            def acquire(self):
+                self.semaphore.acquire()
+                with self.lock:
+                    self.held += 1
+                    self.max_held = max(self.max_held, self.held)
+
+            def release(self):
+                with self.lock:
+                    self.held -= 1
+                self.semaphore.release()
+
+        slots = CountingSlots(2)
+        batch = BatchRunner(gc, template, list(item_ids) + ['missing.svs'], max_sequences = 4, job_slots = slots, start_kwargs = {'check_interval': 0.05})
+        summary = batch.run()
+
+        assert (summary['Sequences'], summary['Succeeded'], summary['Failed'], summary['Jobs Run']) == (9, 8, 1, 16)
+        # At most "max_jobs_in_flight" DSA jobs at a time across every sequence
+        assert slots.max_held == 2
+        results = {r['Item']: r for r in batch.results}
+        assert 'WildcardNotFound' in results['missing.svs']['Error']
+        # Each sequence's template is filled with its item, and the slides folder was listed once for every sequence
+        inputs = [j['kwargs']['inputs']['input_image'] for j in mock.jobs.values()]
+        assert sorted(inputs) == sorted(list(item_ids.values()) + list(item_ids))
+        assert len([r for r in mock.request_log if r[1]=='item']) == 1
+
+def test_bulk_status_and_cancel():
+
+    with MockDSA(job_duration = 30, latency = 0.05) as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+        job_sequence = from_list(gc, [
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f'image_{i}'}]}
+            for i in range(7)
+        ])
+        for job in job_sequence.jobs[:6]:
+            assert job.start().status_code == 200
+
+        # Statuses of every started job come from one listing request
+        n_requests = len(mock.request_log)
+        statuses = [s['Status'] for s in job_sequence.get_status()]
+        assert mock.request_log[n_requests:] == [('GET', 'job')]
+        assert statuses[-1] == 'INACTIVE'
+        assert all([s in ['QUEUED','RUNNING'] for s in statuses[:-1]])
+        assert [s['Status'] for s in job_sequence.get_status(bulk = False)] == statuses
+
+        # Cancellations are sent at the same time
+        start_time = time()
+        responses = job_sequence.cancel()
+        assert time() - start_time < 6*mock.latency
+        assert [r['status'] for r in responses[:6]] == [5]*6
+        assert responses[-1] == {'message': 'Job has not started yet'}
+        assert len([r for r in mock.request_log if r[0]=='PUT' and r[1].endswith('/cancel')]) == 6
+        assert [s['Status'] for s in job_sequence.get_status()] == ['CANCELED']*6 + ['INACTIVE']
+
+def test_log_tailing():
+
+    for notifications in [True, False]:
+        with MockDSA(job_duration = 0.5, log_lines = 20, notifications = notifications) as mock:
+            plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+            gc = mock.client()
+            job_sequence = from_list(gc, [
+                {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f'image_{i}'}]}
+                for i in range(2)
+            ])
+
+            # Every line of every job is read once, in order, while the sequence runs
+            lines = []
+            def tail():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    lines.extend(job_sequence.tail_logs(poll_interval = 0.05, stream_timeout = 0.5))
+            tailer = threading.Thread(target = tail)
+            tailer.start()
+            with contextlib.redirect_stdout(io.StringIO()):
+                assert job_sequence.start(check_interval = 0.05, wait_strategy = 'notification') == ['SUCCESS', 'SUCCESS']
+            tailer.join(timeout = 10)
+            assert not tailer.is_alive()
+
+            for job in job_sequence.jobs:
+                assert [l['Line'] for l in lines if l['Job ID']==job.job_id] == [f'log line {i} for {job.job_id}' for i in range(20)]
+            if notifications:
+                # New text comes from the stream (even when reconnecting more often than once a second), so each job
+                # document is only downloaded when tailing starts, when the job finishes, and by Sequence.start
+                assert len([r for r in mock.request_log if r[0]=='GET' and r[1] in [f'job/{j.job_id}' for j in job_sequence.jobs]]) <= 2*4
+
+            # Tailing a finished job only returns its remaining lines
+            job = job_sequence.jobs[0]
+            assert list(job.tail_logs(poll_interval = 0.05)) == []
+            assert list(job.log_buffer)[-1] == f'log line 19 for {job.job_id}'
+
+def test_concurrent_wildcards():
+
+    with MockDSA(latency = 0.2) as mock:
+        gc = mock.client()
+        paths = [f'/collection/test/folder_{i}/image.svs' for i in range(4)]
+        item_ids = [mock.add_item(p) for p in paths]
+
+        def item_wildcard(path):
+            return f"{{{{'type':'item','item_type':'path','item_query':'{path}'}}}}"
+
+        def n_lookups():
+            return len([r for r in mock.request_log if r[1]=='resource/lookup'])
+
+        # Distinct wildcards are looked up at the same time, repeated ones once
+        cache = WildcardCache()
+        start_time = time()
+        values = resolve_wildcards(gc, [item_wildcard(p) for p in paths + paths], cache = cache)
+        assert time() - start_time < 2*mock.latency
+        assert values == {item_wildcard(p): i for p,i in zip(paths, item_ids)}
+        assert n_lookups() == 4
+
+        # Key order, whitespace, and trailing slashes do not matter
+        variant = f"{{{{'item_query': ' {paths[0]}/ ', 'type':'item','item_type':'path'}}}}"
+        assert parse_wildcard(gc, variant, cache) == item_ids[0]
+        assert n_lookups() == 4
+
+        # Threads resolving the same wildcard wait on one lookup
+        cache = WildcardCache()
+        with ThreadPoolExecutor(max_workers = 8) as executor:
+            values = list(executor.map(lambda _: parse_wildcard(gc, item_wildcard(paths[1]), cache), range(8)))
+        assert values == [item_ids[1]]*8
+        assert (cache.misses, cache.hits) == (1, 7)
+        assert n_lookups() == 5
+
+        # Failed lookups are not cached
+        missing = '/collection/test/folder_4/image.svs'
+        for _ in range(2):
+            try:
+                parse_wildcard(gc, item_wildcard(missing), cache)
+                assert False
+            except WildcardNotFound:
+                pass
+        assert n_lookups() == 7
+        item_id = mock.add_item(missing)
+        assert parse_wildcard(gc, item_wildcard(missing), cache) == item_id
+
+        # Jobs of a sequence share one cache for the run
+        mock.latency = 0
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        n_requests = n_lookups()
+        job_sequence = from_list(gc, [
+            {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': item_wildcard(paths[2])}]}
+            for _ in range(3)
+        ])
+        assert job_sequence.start(check_interval = 0.05, prefetch_wildcards = False) == ['SUCCESS']*3
+        assert [mock.jobs[j.job_id]['kwargs']['inputs']['input_image'] for j in job_sequence.jobs] == [item_ids[2]]*3
+        assert n_lookups() - n_requests == 1
+
+def test_result_cache():
+
+    with MockDSA(job_duration = 0.1) as mock, tempfile.TemporaryDirectory() as tmp_dir:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+        cache_path = os.path.join(tmp_dir, 'results.json')
+
+        def run(thresholds):
+            job_sequence = Sequence(gc, [
+                from_dict(gc, {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': 'image_1'}, {'name': 'threshold', 'value': t}]})
+                for t in thresholds
+            ], result_cache = ResultCache(cache_path))
+            assert job_sequence.start(check_interval = 0.05) == ['SUCCESS']*len(thresholds)
+            return job_sequence
+
+        first = run([10, 20])
+        assert len(mock.jobs) == 2
+
+        # A second run (here with the cache read from disk) reuses both jobs
+        second = run([10, 20])
+        assert len(mock.jobs) == 2
+        assert [j.reused for j in second.jobs] == [True, True]
+        assert [j.job_id for j in second.jobs] == [j.job_id for j in first.jobs]
+        assert (second.result_cache.hits, second.result_cache.misses) == (2, 0)
+
+        # Only jobs with different inputs are submitted
+        third = run([10, 30])
+        assert [j.reused for j in third.jobs] == [True, False]
+        assert len(mock.jobs) == 3
+
+        # Previous jobs that no longer exist are not reused
+        del mock.jobs[first.jobs[0].job_id]
+        fourth = run([10])
+        assert [j.reused for j in fourth.jobs] == [False]
+        assert len(mock.jobs) == 3
+
+def test_schema():
+
+    with MockDSA() as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+        jobs = [from_dict(gc, {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': f'image_{i}'}]}) for i in range(2)]
+
+        # Compiled once per plugin specification and shared by its jobs
+        schema = jobs[0].schema
+        assert jobs[1].schema is schema
+        assert get_schema(jobs[0].executable_dict) is schema
+        assert [p.name for p in schema.parameters] == ['input_image','threshold','mode','scale','analysis_roi','flag']
+        assert schema.find('threshold').default == '50'
+        assert (schema.find('threshold').minimum, schema.find('threshold').maximum) == (0, 255)
+        assert schema.find('missing') is None
+        assert jobs[0].find_input('mode')['default'] == 'fast'
+
+        # Defaults of vectors and regions are formatted as JSON lists
+        assert jobs[0].get_defaults() == schema.defaults()
+        assert schema.find('analysis_roi').default == '[-1.0, -1.0, -1.0, -1.0]'
+
+        # User values replace defaults (the first of a repeated name), None removes an input, and unknown inputs are passed through
+        merged = schema.merge(
+            [
+                {'name': 'input_image', 'value': 'image_1'},
+                {'name': 'threshold', 'value': 7},
+                {'name': 'threshold', 'value': 9},
+                {'name': 'mode', 'value': None},
+                {'name': 'extra', 'value': 'e'}
+            ],
+            extra_inputs = [{'name': 'girderToken', 'value': 'token'}]
+        )
+        assert merged == [
+            {'name': 'input_image', 'value': 'image_1'},
+            {'name': 'threshold', 'value': 7},
+            {'name': 'scale', 'value': '[1.0, 1.0]'},
+            {'name': 'analysis_roi', 'value': '[-1.0, -1.0, -1.0, -1.0]'},
+            {'name': 'flag', 'value': 'false'},
+            {'name': 'extra', 'value': 'e'},
+            {'name': 'girderToken', 'value': 'token'}
+        ]
+
+def test_validation_errors():
+
+    with MockDSA() as mock:
+        plugin_id = mock.add_plugin('dsarchive/mock:latest', 'MockPlugin')
+        gc = mock.client()
+        with contextlib.redirect_stdout(io.StringIO()):
+            job_sequence = from_list(gc, [
+                {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': 'image_1'}, {'name': 'threshold', 'value': 300}, {'name': 'mode', 'value': 'medium'}]},
+                {'plugin_id': plugin_id, 'input_args': [{'name': 'threshold', 'value': '1.5'}, {'name': 'analysis_roi', 'value': '1,2,3'}, {'name': 'flag', 'value': 'yes'}, {'name': 'scale', 'value': '1,a'}]},
+                # Wildcards are only checked when they are resolved
+                {'plugin_id': plugin_id, 'input_args': [{'name': 'input_image', 'value': "{{'type':'item','item_type':'path','item_query':'/collection/missing'}}"}]},
+                {'plugin_id': 'missing_plugin', 'input_args': []}
+            ])
+
+        # Every problem in every job is reported before anything is submitted
+        try:
+            job_sequence.start(check_interval = 0.05)
+            assert False
+        except ValidationError as e:
+            assert e.errors == [
+                'Job 0 (MockPlugin) threshold: 300 is more than the maximum of 255',
+                "Job 0 (MockPlugin) mode: 'medium' is not one of ['fast', 'slow']",
+                'Job 1 (MockPlugin) input_image: required input is missing',
+                "Job 1 (MockPlugin) threshold: expected an integer, got '1.5'",
+                "Job 1 (MockPlugin) scale: expected a number, got 'a'",
+                'Job 1 (MockPlugin) analysis_roi: expected 4 or 6 values for a region, got 3',
+                "Job 1 (MockPlugin) flag: expected true or false, got 'yes'",
+                'Job 3 (missing_plugin) Plugin not found: missing_plugin'
+            ]
+            assert all([err in str(e) for err in e.errors])
+        assert len(mock.jobs) == 0
+
+        assert job_sequence.jobs[2].validate() == []
+        try:
+            job_sequence.jobs[0].validate(raise_error = True)
+            assert False
+        except ValidationError as e:
+            assert len(e.errors) == 2
+
+if __name__=='__main__':
+    test_sequence_runs()
+    test_failure_cancels_sequence()
+    test_wildcard_cache()
+    test_metrics()
+    test_lazy_construction()
+    test_manifest()
+    test_priority_scheduler()
+    test_adaptive_concurrency()
+    test_wildcard_readiness()
+    test_item_index()
+    test_batched_paths()
+    test_pipeline()
+    test_supervisor()
+    test_status_check_cost()
+    test_shared_poller_errors()
+    test_supervisor_resume()
+    test_wildcard_timeout_scope()
+    test_mixed_endpoint_latency()
+    test_journal_resume()
+    test_async_status()
+    test_cli_catalog()
+    test_transport()
+    test_wait_strategies()
+    test_dag_mode()
+    test_batch_runner()
+    test_bulk_status_and_cancel()
+    test_log_tailing()
+    test_concurrent_wildcards()
+    test_result_cache()
+    test_schema()
+    test_validation_errors()